@@ -4,13 +4,34 @@ import argparse
 import os
 import sys
 
+from functools import partial
 from pathlib import Path
 
 
 from src.parsers import (parse_fof, get_pfams_from_db, get_pfams_from_interpro_query, 
                          parse_TEsort_output, classify_pfams, create_summary, write_summary,
-                         get_stats)
-from src.run import run_gffread, run_TEsorter, remove_stop_codons, run_interpro, run_agat
+                         get_stats, iter_pfams_from_interpro_query, parse_TEsort_output_compact,
+                         iter_summary_rows, write_summary_rows, iter_summary_tuples, iter_inferred_rows,
+                         SUMMARY_HEADER, SUMMARY_HEADER_INFERRED)
+from src.cache import ResultCache, get_tool_version
+from src.fastparse import get_pfams_from_interpro_file, parse_TEsort_file
+from src.store import ResultStore
+from src.metrics import MetricsCollector
+from src.journal import StageJournal
+from src.compression import open_file, get_output_name, is_gzipped, get_stem
+from src.domains import DOMAIN_BACKENDS, write_te_hmms, run_te_prefilter, run_stub_search
+from src.matrix import PfamCounter, read_status_counts, write_pfam_matrix
+from src.filter import TE_STATUSES, run_filter_label
+from src.annotation import REPRESENTATIVE_RULES, read_representatives
+from src.planner import (read_history, record_throughput, plan_run, format_plan, get_chunk_size,
+                         get_recorded_runs)
+from src.dedup import deduplicate_proteins, expand_interpro_tsv
+from src.run import (run_gffread_label, run_TEsorter_label, remove_stop_codons,
+                     run_interpro_label, run_interpro_deduplicated, run_stats_label,
+                     run_TEsorter_cached, run_interpro_cached, run_interpro_streaming,
+                     run_representatives_label, run_interpro_pooled)
+from src.scheduler import Scheduler, Task
+from src.workers import WorkerPool, DEFAULT_WORKER, BATCH_TIMEOUT
 
 REXDB_PFAMS = {"rexdb-plant": Path(os.path.dirname(os.path.realpath(__file__))) / "data" / "Viridiplantae_2.0_pfams.txt",
                "rexdb-metazoa": Path(os.path.dirname(os.path.realpath(__file__))) / "data" / "Metazoa_3.1_pfams.txt",
@@ -22,6 +43,16 @@ CATEGORIES = {"No_TE(PcpM0)": "PcpM0", "Protein_TE_only(PteM0)": "PteM0",
               "Protein_and_mRNA_TE(PteMte)": "PteMte", "Chimeric_Protein_and_mRNA_TE(PchMte)": "PchMte",
               "No_Protein_Domains_mRNA_TE(P0Mte)": "P0Mte"}
 
+
+STEPS = {"gffread": "##STEP 1: Retrive sequences with gffread\n",
+         "tesorter": "##STEP 2: Analyze mRNA transposable elements with TEsorter\n",
+         "stop_codons": "##STEP 3: Remove internal stop codons from proteins\n",
+         "dedup": "##STEP 3b: Collapse identical proteins from every label\n",
+         "interpro": "##STEP 4: Analyze protein transposable elements with interproscan\n",
+         "summary": "##STEP 5: merging evidences from interpro and TEsorter\n",
+         "stats": "##STEP 6: Running stats on annotation files\n",
+         "filter": "##STEP 7: Writing annotations without TE transcripts\n"}
+
 #Generating program options
 def parse_arguments():
     desc = "Pipeline to identify Transposable Elments (TE) in annotated genes"
@@ -46,6 +77,172 @@ def parse_arguments():
     help_database = "(Optional) database for TEsorter. rexdb-plant by default"
     parser.add_argument("--tesorter_database", "-d", type=str,
                         help=help_database, default="rexdb-plant")
+
+    help_extractor = '''(Optional) how mRNAs and proteins are extracted from the assembly: gffread or
+                        native (indexed and memory-mapped genome, no external tools). gffread by default'''
+    parser.add_argument("--extractor", type=str, choices=["gffread", "native"],
+                        help=help_extractor, default="gffread")
+
+    help_stats = '''(Optional) how transcripts are counted in the annotation: native (single streaming
+                    pass), agat (agat_sp_statistics.pl) or both (AGAT as a cross-check). native by default'''
+    parser.add_argument("--stats", type=str, choices=["native", "agat", "both"],
+                        help=help_stats, default="native")
+
+    help_merge = '''(Optional) how interproscan and TEsorter results are merged: memory or streaming
+                    (interproscan hits are read one transcript at a time, bounded memory). memory by default'''
+    parser.add_argument("--merge", type=str, choices=["memory", "streaming"],
+                        help=help_merge, default="memory")
+
+    help_parser = '''(Optional) parser used for interproscan and TEsorter outputs in memory merges: python,
+                     fast (memory-mapped, Pfam rows pre-filtered, big files parsed in parallel) or
+                     validate (runs both and fails if they differ). python by default'''
+    parser.add_argument("--parser", type=str, choices=["python", "fast", "validate"],
+                        help=help_parser, default="python")
+
+    help_store = '''(Optional) sqlite file where every summary is stored, indexed by label, transcript,
+                    DeTEnGA status and Pfam ID. It can be queried with DeTEnGA_query.py'''
+    parser.add_argument("--store", type=str, help=help_store, default=None)
+
+    help_metrics_collector = '''(Optional) URL where every metrics event is also sent as a JSON POST request
+                                (e.g. a local collector). Metrics are always written in metrics.jsonl'''
+    parser.add_argument("--metrics_collector", type=str, help=help_metrics_collector, default=None)
+
+    help_resume = '''(Optional) resume a previous run in the same output dir: only stages that did not
+                     finish, or whose inputs or outputs changed, are run again'''
+    parser.add_argument("--resume", action="store_true", help=help_resume)
+
+    help_stream = '''(Optional) stream proteins from the extractor through stop codon trimming to
+                     interproscan chunks of --interpro_chunk_size residues (1000000 by default), so
+                     interproscan starts before extraction ends. Not compatible with --dedup or --cache'''
+    parser.add_argument("--stream", action="store_true", help=help_stream)
+
+    help_keep_intermediates = '''(Optional) with --stream, also write the protein, trimmed protein and
+                                 interproscan chunk files, which are not needed by later stages'''
+    parser.add_argument("--keep_intermediates", action="store_true", help=help_keep_intermediates)
+
+    help_compress_outputs = '''(Optional) write proteins and summaries compressed with gzip (pigz if it is
+                               installed). mRNAs are not compressed, TEsorter reads them'''
+    parser.add_argument("--compress_outputs", action="store_true", help=help_compress_outputs)
+
+    help_domain_backend = '''(Optional) how Pfam domains of proteins are found: interproscan, te_prefilter
+                             (hmmsearch with the TE Pfam profiles first, only proteins with TE domains or
+                             TEsorter hits go to interproscan, PcpM0 is not reported) or stub (hits copied from
+                             --stub_hits, for tests). interproscan by default'''
+    parser.add_argument("--domain_backend", type=str, choices=DOMAIN_BACKENDS,
+                        help=help_domain_backend, default="interproscan")
+
+    help_te_hmms = "(Optional) Pfam-A.hmm file with the TE Pfam profiles, needed by --domain_backend te_prefilter"
+    parser.add_argument("--te_hmms", type=str, help=help_te_hmms, default=None)
+
+    help_stub_hits = "(Optional) interproscan TSV whose hits are used by --domain_backend stub. No hits by default"
+    parser.add_argument("--stub_hits", type=str, help=help_stub_hits, default=None)
+
+    help_pfam_matrix = '''(Optional) count transcripts per Pfam and DeTEnGA status of every label while
+                          summaries are written, and write them as a sparse matrix in pfam_status_counts.tsv'''
+    parser.add_argument("--pfam_matrix", action="store_true", help=help_pfam_matrix)
+
+    help_filter_annotation = '''(Optional) write the annotation of every label without the transcripts whose
+                                 DeTEnGA status is in --filter_statuses, in a single pass over the annotation'''
+    parser.add_argument("--filter_annotation", action="store_true", help=help_filter_annotation)
+
+    help_filter_statuses = "(Optional) comma separated DeTEnGA statuses removed by --filter_annotation. {} by default".format(",".join(TE_STATUSES))
+    parser.add_argument("--filter_statuses", type=str, help=help_filter_statuses, default=",".join(TE_STATUSES))
+
+    help_te_annotation = '''(Optional) with --filter_annotation, also write the removed transcripts, their
+                            children and genes with their status in a detenga_status attribute'''
+    parser.add_argument("--te_annotation", action="store_true", help=help_te_annotation)
+
+    help_representatives = '''(Optional) analyze only one transcript per gene: none, longest_cds or
+                              longest_transcript. Statuses of the rest of the transcripts of every gene
+                              are copied from it and marked in the Inferred_from field of the summary.
+                              none by default'''
+    parser.add_argument("--representatives", type=str, choices=["none"] + REPRESENTATIVE_RULES,
+                        help=help_representatives, default="none")
+
+    help_throughput_history = '''(Optional) JSON file where the throughput of every TEsorter and interproscan
+                                 run is recorded, used by --adaptive_threads and --dry_run'''
+    parser.add_argument("--throughput_history", type=str, help=help_throughput_history, default=None)
+
+    help_adaptive_threads = '''(Optional) split the threads of every label between TEsorter and interproscan,
+                               which run at the same time, and size their chunks from the throughput history'''
+    parser.add_argument("--adaptive_threads", action="store_true", help=help_adaptive_threads)
+
+    help_dry_run = "(Optional) print the threads and predicted time of every label and exit"
+    parser.add_argument("--dry_run", action="store_true", help=help_dry_run)
+
+    help_task_threads = '''(Optional) threads given to each TEsorter and interproscan run.
+                           Runs from different labels share the --threads budget. --threads divided
+                           by the number of labels by default'''
+    parser.add_argument("--task_threads", type=int,
+                        help=help_task_threads, default=None)
+
+    help_memory = "(Optional) memory budget in GB shared by concurrent runs. Unlimited by default"
+    parser.add_argument("--memory", "-m", type=float,
+                        help=help_memory, default=None)
+
+    help_interpro_memory = "(Optional) memory in GB reserved for each interproscan run. 4 by default"
+    parser.add_argument("--interpro_memory", type=float,
+                        help=help_interpro_memory, default=4)
+
+    help_dedup = '''(Optional) run interproscan only once for identical proteins: none, label (within
+                    each label) or fof (across every label in the file of files). none by default'''
+    parser.add_argument("--dedup", type=str, choices=["none", "label", "fof"],
+                        help=help_dedup, default="none")
+
+    help_cache = '''(Optional) sqlite file used as a cache of TEsorter and interproscan results by
+                    sequence, so only new sequences are analyzed in later runs. Disabled by default'''
+    parser.add_argument("--cache", type=str,
+                        help=help_cache, default=None)
+
+    help_cache_size = "(Optional) maximum size of the cache in MB, least recently used results are removed first. 1024 by default"
+    parser.add_argument("--cache_size", type=int,
+                        help=help_cache_size, default=1024)
+
+    help_interpro_chunk = '''(Optional) split proteins in chunks of this number of residues and run
+                             interproscan on them concurrently. Disabled by default'''
+    parser.add_argument("--interpro_chunk_size", type=int,
+                        help=help_interpro_chunk, default=None)
+
+    help_interpro_workers = "(Optional) concurrent interproscan runs per label when using chunks. Same as --task_threads by default"
+    parser.add_argument("--interpro_workers", type=int,
+                        help=help_interpro_workers, default=None)
+
+    help_tesorter_chunk = '''(Optional) split mRNAs in chunks of this number of bases and run
+                             TEsorter on them concurrently. Disabled by default'''
+    parser.add_argument("--tesorter_chunk_size", type=int,
+                        help=help_tesorter_chunk, default=None)
+
+    help_tesorter_workers = "(Optional) concurrent TEsorter runs per label when using chunks. Same as --task_threads by default"
+    parser.add_argument("--tesorter_workers", type=int,
+                        help=help_tesorter_workers, default=None)
+
+    help_tesorter_retries = "(Optional) number of times a failed TEsorter chunk is retried. 1 by default"
+    parser.add_argument("--tesorter_retries", type=int,
+                        help=help_tesorter_retries, default=1)
+
+    help_interpro_retries = "(Optional) number of times a failed interproscan chunk is retried. 1 by default"
+    parser.add_argument("--interpro_retries", type=int,
+                        help=help_interpro_retries, default=1)
+
+    help_interpro_pool = '''(Optional) number of long lived interproscan workers shared by every label. Proteins
+                            are queued to them in batches of --interpro_chunk_size residues (200000 by default)
+                            and each worker uses --task_threads threads. With the default --interpro_worker the
+                            JVM startup of interproscan is still paid on every batch, only a worker that keeps
+                            InterProScan loaded avoids it. Disabled by default'''
+    parser.add_argument("--interpro_pool", type=int,
+                        help=help_interpro_pool, default=0)
+
+    help_interpro_worker = '''(Optional) command that starts one worker of --interpro_pool, see src/workers.py
+                              for the protocol. By default src/interpro_worker.py, which runs interproscan.sh
+                              on every batch and so gives no startup amortization. A worker of an InterProScan
+                              service that stays loaded (e.g. a local InterProScan web service) avoids it'''
+    parser.add_argument("--interpro_worker", type=str,
+                        help=help_interpro_worker, default=DEFAULT_WORKER)
+
+    help_interpro_batch_timeout = '''(Optional) seconds a batch of --interpro_pool can take before its worker is
+                                     killed and the batch retried. {} by default'''.format(BATCH_TIMEOUT)
+    parser.add_argument("--interpro_batch_timeout", type=float,
+                        help=help_interpro_batch_timeout, default=BATCH_TIMEOUT)
     
     if len(sys.argv)==1:
         parser.print_help()
@@ -55,11 +252,67 @@ def parse_arguments():
 def get_arguments():
     parser = parse_arguments()
     output = Path(parser.output)
-    if not output.exists():
+    if parser.stream and (parser.dedup != "none" or parser.cache):
+        raise RuntimeError("--stream can not be used with --dedup or --cache, proteins are not written")
+    if parser.stream and parser.domain_backend != "interproscan":
+        raise RuntimeError("--stream only works with the interproscan domain backend")
+    if parser.domain_backend == "te_prefilter" and not parser.te_hmms:
+        raise RuntimeError("--domain_backend te_prefilter needs the Pfam profiles given with --te_hmms")
+    if parser.domain_backend != "interproscan" and parser.dedup == "fof":
+        raise RuntimeError("--dedup fof only works with the interproscan domain backend")
+    if parser.domain_backend == "stub" and parser.cache:
+        raise RuntimeError("Stub hits can not be cached, do not use --cache with --domain_backend stub")
+    filter_statuses = tuple(status.strip() for status in parser.filter_statuses.split(",") if status.strip())
+    unknown_statuses = set(filter_statuses) - set(CATEGORIES.values())
+    if unknown_statuses:
+        raise RuntimeError("Unknown DeTEnGA statuses in --filter_statuses: {}".format(",".join(sorted(unknown_statuses))))
+    if parser.te_annotation and not parser.filter_annotation:
+        raise RuntimeError("--te_annotation needs --filter_annotation")
+    if parser.interpro_pool and (parser.stream or parser.cache or parser.dedup == "label"):
+        raise RuntimeError("--interpro_pool can not be used with --stream, --cache or --dedup label")
+    if parser.interpro_pool and parser.domain_backend == "stub":
+        raise RuntimeError("--interpro_pool needs the interproscan or te_prefilter domain backends")
+    if not output.exists() and not parser.dry_run:
         output.mkdir(parents=True)
     return {"input": parser.input,
             "out": output,
             "threads": parser.threads,
+            "task_threads": parser.task_threads,
+            "memory": parser.memory,
+            "interpro_memory": parser.interpro_memory,
+            "tesorter_chunk_size": parser.tesorter_chunk_size,
+            "tesorter_workers": parser.tesorter_workers,
+            "tesorter_retries": parser.tesorter_retries,
+            "dedup": parser.dedup,
+            "cache": Path(parser.cache) if parser.cache else None,
+            "cache_size": parser.cache_size,
+            "interpro_chunk_size": parser.interpro_chunk_size,
+            "interpro_workers": parser.interpro_workers,
+            "interpro_retries": parser.interpro_retries,
+            "interpro_pool": parser.interpro_pool,
+            "interpro_worker": parser.interpro_worker,
+            "interpro_batch_timeout": parser.interpro_batch_timeout,
+            "extractor": parser.extractor,
+            "stats": parser.stats,
+            "merge": parser.merge,
+            "parser": parser.parser,
+            "store": Path(parser.store) if parser.store else None,
+            "metrics_collector": parser.metrics_collector,
+            "resume": parser.resume,
+            "stream": parser.stream,
+            "keep_intermediates": parser.keep_intermediates,
+            "compress_outputs": parser.compress_outputs,
+            "domain_backend": parser.domain_backend,
+            "pfam_matrix": parser.pfam_matrix,
+            "filter_annotation": parser.filter_annotation,
+            "filter_statuses": filter_statuses,
+            "te_annotation": parser.te_annotation,
+            "representatives": parser.representatives if parser.representatives != "none" else None,
+            "throughput_history": Path(parser.throughput_history) if parser.throughput_history else None,
+            "adaptive_threads": parser.adaptive_threads,
+            "dry_run": parser.dry_run,
+            "te_hmms": Path(parser.te_hmms) if parser.te_hmms else None,
+            "stub_hits": Path(parser.stub_hits) if parser.stub_hits else None,
             "tesorter_database": parser.tesorter_database}
 
 
@@ -76,8 +329,11 @@ def create_header():
 def get_row(label, genome, annotation, stats):
     inverse_categories = {value: key for key, value in CATEGORIES.items()}
     categories = ["T"] + [key for key in inverse_categories]
-    values = [str(stats["num_transcripts"])] + [str(stats[key]) for key in inverse_categories]
-    per_values = [str(stats["num_transcripts"])] + [str(round(float(stats[key]/stats["num_transcripts"])*100, 2)) for key in inverse_categories]
+    #Categories that were not counted (None) are written as NA
+    values = [str(stats["num_transcripts"])] + [str(stats[key]) if stats[key] is not None else "NA"
+                                                for key in inverse_categories]
+    per_values = [str(stats["num_transcripts"])] + [str(round(float(stats[key]/stats["num_transcripts"])*100, 2))
+                                                    if stats[key] is not None else "NA" for key in inverse_categories]
     summary = "{0}: {1};{2}: {3};{4}: {5};{6}: {7};{8}: {9};{10}: {11};{12}: {13}"
     row = [label, genome, annotation]
     row += values
@@ -87,9 +343,445 @@ def get_row(label, genome, annotation, stats):
     return "\t".join(row)+"\n"
 
 
-def main():
+def log_step(stage, state, log_fhand):
+    if stage not in state["logged_steps"]:
+        state["logged_steps"].add(stage)
+        msg = STEPS[stage]
+        print(msg)
+        log_fhand.write(msg)
+        log_fhand.flush()
+
+
+def gffread_done(task, values, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    if not isinstance(values["command"], dict):
+        #Errors raised by the task have a single command
+        values = {"command": {"error": values["command"]}, "msg": {"error": values["msg"].rstrip("\n")},
+                  "returncode": {"error": values["returncode"]}}
+    for kind in values["command"]:
+        log_fhand.write("{} | {}\n".format(values["command"][kind], values["msg"][kind]))
+        log_fhand.flush()
+    if 1 in values["returncode"].values():
+        log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(task.label))
+        log_fhand.flush()
+        return True
+    state["sequences"][task.label] = values
+    return False
+
+
+def tesorter_done(task, values, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    log_fhand.write("{} | {}\n".format(values["command"], values["msg"]))
+    log_fhand.flush()
+    if values["returncode"] == 1:
+        log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(task.label))
+        log_fhand.flush()
+        return True
+    state["TEsorter_results"][task.label] = values
+    return False
+
+
+def stop_codons_done(task, results, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    log_fhand.write("{} | {}\n".format(results["command"], results["msg"]))
+    log_fhand.flush()
+    if results.get("returncode") == 1:
+        log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(task.label))
+        log_fhand.flush()
+        return True
+    state["no_stop_codons_sequences"][task.label] = results
+    return False
+
+
+def interpro_done(task, values, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    if values["returncode"] == 1:
+        log_fhand.write("{} | {}\n".format(values["command"], values["msg"]))
+        log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(task.label))
+        log_fhand.flush()
+        return True
+    log_fhand.write("{} | {}\n".format(values["command"], values["msg"]))
+    log_fhand.flush()
+    state["interpro_results"][task.label] = values
+    return False
+
+
+def summary_done(task, results, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    if results["returncode"] == 1:
+        log_fhand.write("{} | {}".format(results["command"], results["msg"]))
+        log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(task.label))
+        log_fhand.flush()
+        return True
+    state["summaries"][task.label] = results["out_fpath"]
+    if "pfam_counts" in results:
+        state["pfam_counts"][task.label] = results["pfam_counts"]
+    log_fhand.write("{} | {}\n".format(results["command"], results["msg"]))
+    msg = "TE Summary for {} written in {}\n".format(task.label, results["out_fpath"])
+    log_fhand.write(msg)
+    log_fhand.flush()
+    return False
+
+
+def stats_done(task, values, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    log_fhand.write("{} | {}\n".format(values["command"], values["msg"]))
+    log_fhand.flush()
+    if "num_transcripts" not in values:
+        return True
+    state["stats_results"][task.label] = values
+    return False
+
+
+def filter_done(task, results, state, log_fhand):
+    #The summary is still valid, so the label is kept in the pipeline
+    log_step(task.stage, state, log_fhand)
+    log_fhand.write("{} | {}\n".format(results["command"], results["msg"]))
+    if results["returncode"] == 1:
+        log_fhand.write("Filtered annotation of {} not written, please check the error message\n\n".format(task.label))
+    else:
+        state["filtered_annotations"][task.label] = results["out_fpath"]
+    log_fhand.flush()
+    return False
+
+
+def parse_evidences(label, state, parser="python", threads=1):
+    TEsorter_fpath = state["TEsorter_results"][label]["out_fpath"]
+    interpro_fpath = state["interpro_results"][label]["out_fpath"]
+    if parser == "fast":
+        return (parse_TEsort_file(TEsorter_fpath, threads=threads),
+                get_pfams_from_interpro_file(interpro_fpath, threads=threads))
+    with open_file(TEsorter_fpath) as TEsorter_fhand:
+        te_sorter_output = parse_TEsort_output(TEsorter_fhand)
+    with open_file(interpro_fpath) as interpro_fhand:
+        interpro = get_pfams_from_interpro_query(interpro_fhand)
+    if parser == "validate":
+        #Both parsers are run and they must agree
+        if parse_TEsort_file(TEsorter_fpath, threads=threads) != te_sorter_output:
+            raise ValueError("Fast and python parsers differ for {}".format(TEsorter_fpath))
+        if get_pfams_from_interpro_file(interpro_fpath, threads=threads) != interpro:
+            raise ValueError("Fast and python parsers differ for {}".format(interpro_fpath))
+    return te_sorter_output, interpro
+
+
+def merge_evidences(label, state, TE_pfams, out_dir, mode="memory", parser="python", threads=1,
+                    compressed=False, pfam_counts=False):
+    out_fpath = get_output_name(out_dir / label / "{}_TE_summary.csv".format(label), compressed=compressed)
+    representatives = None
+    if get_representatives_fpath(label, state) is not None:
+        representatives = read_representatives(get_representatives_fpath(label, state))
+    store = state["store"]
+    if store is not None:
+        #Rows of a previous run of this label are replaced
+        store.clear_label(label)
+    counter = PfamCounter() if pfam_counts else None
+    try:
+        results = merge_evidences_to(label, state, TE_pfams, out_fpath, store, mode=mode,
+                                     parser=parser, threads=threads, counter=counter,
+                                     representatives=representatives)
+    except Exception:
+        if store is not None:
+            store.clear_label(label)
+        raise
+    if counter is not None and results["returncode"] == 0:
+        results["pfam_counts"] = counter.write(out_dir / label / "{}.pfam_counts.tsv".format(label))
+    return results
+
+
+def merge_evidences_to(label, state, TE_pfams, out_fpath, store, mode="memory", parser="python", threads=1,
+                       counter=None, representatives=None):
+    if mode == "streaming":
+        try:
+            return merge_evidences_streaming(label, state, TE_pfams, out_fpath, store=store, counter=counter,
+                                             representatives=representatives)
+        except ValueError as error:
+            #Rows stored or counted before the error would be added twice by the memory merge
+            if store is not None:
+                store.clear_label(label)
+            if counter is not None:
+                counter.reset()
+            mode = "memory (streaming failed: {})".format(error)
+    try:
+        te_sorter_output, interpro = parse_evidences(label, state, parser=parser, threads=threads)
+    except ValueError as error:
+        return {"command": "Merge evidences for {}".format(label), "returncode": 1,
+                "msg": "{}\n".format(error), "out_fpath": out_fpath}
+    classified_pfams = classify_pfams(interpro, TE_pfams)
+    te_summary = create_summary(classified_pfams, te_sorter_output)
+
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    if representatives is not None:
+        rows = list(iter_inferred_rows(iter_summary_tuples(te_summary), representatives))
+    with open_file(tmp_fpath, "w") as out_fhand:
+        if representatives is not None:
+            write_summary_rows(rows, out_fhand, header=SUMMARY_HEADER_INFERRED)
+        else:
+            write_summary(te_summary, out_fhand)
+    os.replace(tmp_fpath, out_fpath)
+    if store is not None:
+        store.add_rows(label, rows if representatives is not None else iter_summary_tuples(te_summary))
+    if counter is not None:
+        counter.add_rows(rows if representatives is not None else iter_summary_tuples(te_summary))
+    return {"command": "Merge evidences for {} in {}".format(label, mode), "returncode": 0,
+            "msg": "Done", "out_fpath": out_fpath}
+
+
+def merge_evidences_streaming(label, state, TE_pfams, out_fpath, store=None, counter=None,
+                              representatives=None):
+    #Only TEsorter hits are kept in memory, interproscan hits are merged and
+    #written one transcript at a time
+    with open_file(state["TEsorter_results"][label]["out_fpath"]) as TEsorter_fhand:
+        te_sorter_output = parse_TEsort_output_compact(TEsorter_fhand)
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open_file(state["interpro_results"][label]["out_fpath"]) as interpro_fhand:
+        with open_file(tmp_fpath, "w") as out_fhand:
+            rows = iter_summary_rows(iter_pfams_from_interpro_query(interpro_fhand),
+                                     te_sorter_output, TE_pfams)
+            header = SUMMARY_HEADER_INFERRED if representatives is not None else SUMMARY_HEADER
+            if representatives is not None:
+                rows = iter_inferred_rows(rows, representatives)
+            if store is not None:
+                rows = store.tee_rows(label, rows)
+            if counter is not None:
+                rows = counter.tee_rows(rows)
+            write_summary_rows(rows, out_fhand, header=header)
+    os.replace(tmp_fpath, out_fpath)
+    return {"command": "Merge evidences for {} in streaming".format(label), "returncode": 0,
+            "msg": "Done", "out_fpath": out_fpath}
+
+
+def deduplicate_fof(files, state, out_dir):
+    #Labels in fof order, not in the order their proteins were trimmed, so
+    #the unique proteins are the same in every run
+    sequences = state["no_stop_codons_sequences"]
+    fastas = {label: sequences[label]["out_fpath"] for label in files if label in sequences}
+    dedup_dir = out_dir / "deduplicated_proteins"
+    dedup_dir.mkdir(exist_ok=True)
+    unique_fpath = dedup_dir / "proteins.unique.fasta"
+    map_fpaths = {label: Path("{}.unique.map.tsv".format(fasta)) for label, fasta in fastas.items()}
+    counts = deduplicate_proteins(fastas, unique_fpath, map_fpaths)
+    state["dedup"] = {"out_fpath": unique_fpath, "map_fpaths": map_fpaths}
+    return {"command": "Collapse identical proteins from {} labels".format(len(fastas)),
+            "returncode": 0, "out_fpath": unique_fpath,
+            "msg": "Done, {} unique proteins out of {}".format(counts["num_unique"],
+                                                                counts["num_sequences"])}
+
+
+def expand_fof_hits(label, state):
+    unique_results = state["interpro_results"][None]
+    out_fpath = Path("{}.tsv".format(state["no_stop_codons_sequences"][label]["out_fpath"]))
+    expand_interpro_tsv(unique_results["out_fpath"], state["dedup"]["map_fpaths"][label], out_fpath)
+    return {"command": unique_results["command"], "returncode": 0, "out_fpath": out_fpath,
+            "msg": "Hits from unique proteins written in {}".format(out_fpath)}
+
+
+def shared_task_done(task, results, state, log_fhand):
+    log_step(task.stage, state, log_fhand)
+    log_fhand.write("{} | {}\n".format(results["command"], results["msg"]))
+    if results["returncode"] == 1:
+        log_fhand.write("Removed every label from pipeline, please check the error message\n\n")
+        log_fhand.flush()
+        return True
+    log_fhand.flush()
+    if task.stage == "interpro":
+        state["interpro_results"][None] = results
+    return False
+
+
+def get_interpro_options(label, state, interpro_options):
+    if state["domain_backend"] == "te_prefilter":
+        return dict(interpro_options, tesorter_fpath=state["TEsorter_results"][label]["out_fpath"])
+    return interpro_options
+
+
+def get_representatives_fpath(label, state):
+    #Only written with --representatives, the streamed interpro task does not
+    #wait for the extraction of mRNAs otherwise
+    if label not in state["sequences"]:
+        return None
+    return state["sequences"][label]["out_fpath"].get("representatives")
+
+
+def get_extractor(label, values, args, threads, log_fhand):
+    #gffread can not read compressed assemblies or annotations
+    extractor = args["extractor"]
+    if extractor == "gffread" and (is_gzipped(values["assembly"]) or is_gzipped(values["annotation"])):
+        log_fhand.write("#Compressed inputs for {}, using the native extractor instead of gffread\n".format(label))
+        extractor = "native"
+    return extractor, threads if extractor == "native" else 1
+
+
+def get_label_resources(label, args, state, threads):
+    #Threads, chunk sizes and chunk workers of TEsorter and interproscan. With
+    #a plan, threads are split between both and chunks are sized from the
+    #throughput history when workers are given without a chunk size
+    resources = {}
+    for stage in ("tesorter", "interpro"):
+        stage_threads = threads
+        chunk_size = args["{}_chunk_size".format(stage)]
+        workers = args["{}_workers".format(stage)]
+        if state["plan"] is not None:
+            plan = state["plan"]["labels"][label]
+            stage_threads = plan["{}_threads".format(stage)]
+            if not chunk_size and workers:
+                chunk_size = get_chunk_size(state["plan"]["throughputs"][stage][0], stage_threads, workers,
+                                            plan[stage])
+        #Every interproscan chunk worker is a JVM of its own
+        if chunk_size or (stage == "interpro" and args["stream"]):
+            workers = workers if workers else stage_threads
+        else:
+            workers = 1
+        resources[stage] = {"threads": stage_threads, "chunk_size": chunk_size, "workers": workers}
+    return resources
+
+
+def build_tasks(scheduler, files, args, state, log_fhand):
+    out_dir = args["out"]
+    threads = min(args["task_threads"], args["threads"])
+    if args["adaptive_threads"]:
+        state["plan"] = plan_run(files, args["threads"], args["task_threads"],
+                                 read_history(args["throughput_history"]), representatives=args["representatives"])
+        log_fhand.write("#Threads of every label split between TEsorter and interproscan:\n")
+        log_fhand.write(format_plan(state["plan"]))
+    #Every interproscan chunk worker is a JVM of its own
+    interpro_workers = 1
+    if args["interpro_chunk_size"] or args["stream"]:
+        interpro_workers = args["interpro_workers"] if args["interpro_workers"] else threads
+    interpro_options = {"chunk_size": args["interpro_chunk_size"], "workers": interpro_workers,
+                        "retries": args["interpro_retries"]}
+    run_interpro = run_interpro_deduplicated if args["dedup"] == "label" else run_interpro_label
+    run_TEsorter = run_TEsorter_label
+    #Pooled interproscan tasks only queue batches to the workers
+    pooled = state["pool"] is not None
+    if pooled:
+        run_interpro = partial(run_interpro_pooled, pool=state["pool"])
+        interpro_workers = 0
+    if state["cache"] is not None:
+        #Results are cached by sequence digest, which already removes duplicates
+        run_interpro = partial(run_interpro_cached, cache=state["cache"],
+                               version=state["versions"]["interproscan"])
+        run_TEsorter = partial(run_TEsorter_cached, cache=state["cache"],
+                               version=state["versions"]["TEsorter"])
+    database = REXDB_PFAMS[args["tesorter_database"]]
+    TE_pfams = get_pfams_from_db(database)
+    interpro_requires = []
+    if args["domain_backend"] == "stub":
+        run_interpro = partial(run_stub_search, hits=args["stub_hits"])
+    elif args["domain_backend"] == "te_prefilter":
+        #Only proteins with TE domains or TEsorter hits are sent to interproscan
+        te_hmms = out_dir / "TE_pfams.{}.hmm".format(args["tesorter_database"])
+        num_profiles = write_te_hmms(args["te_hmms"], TE_pfams, te_hmms)
+        log_fhand.write("#{} of {} TE Pfam profiles found in {}\n".format(num_profiles, len(TE_pfams),
+                                                                       args["te_hmms"]))
+        run_interpro = partial(run_te_prefilter, te_hmms=te_hmms, run_interpro=run_interpro)
+        interpro_requires = ["tesorter"]
+    if args["dedup"] == "fof":
+        #A single interproscan run on the proteins of every label
+        stop_codons_tasks = [(label, "stop_codons") for label in files]
+        scheduler.add(Task(None, "dedup", partial(deduplicate_fof, files, state, out_dir),
+                           after=stop_codons_tasks,
+                           callback=partial(shared_task_done, state=state, log_fhand=log_fhand)))
+        scheduler.add(Task(None, "interpro",
+                           lambda: run_interpro(None, state["dedup"], threads, **interpro_options),
+                           requires=[(None, "dedup")], threads=1 if pooled else threads,
+                           memory=args["interpro_memory"] * interpro_workers,
+                           callback=partial(shared_task_done, state=state, log_fhand=log_fhand)))
+    run_gffread = run_gffread_label
+    if args["representatives"] is not None:
+        #Only one transcript per gene is kept in the extracted sequences
+        run_gffread = partial(run_representatives_label, rule=args["representatives"])
+    for label, values in files.items():
+        extractor, extractor_threads = get_extractor(label, values, args, threads, log_fhand)
+        resources = get_label_resources(label, args, state, threads)
+        tesorter = resources["tesorter"]
+        interpro = resources["interpro"]
+        label_interpro_options = dict(interpro_options, chunk_size=interpro["chunk_size"],
+                                      workers=interpro["workers"])
+        scheduler.add(Task(label, "gffread",
+                           partial(run_gffread, label, values, out_dir,
+                                   extractor=extractor, threads=extractor_threads,
+                                   proteins=not args["stream"], compressed=args["compress_outputs"]),
+                           threads=extractor_threads,
+                           callback=partial(gffread_done, state=state, log_fhand=log_fhand)))
+        scheduler.add(Task(label, "tesorter",
+                           lambda label=label, tesorter=tesorter: run_TEsorter(label, state["sequences"][label],
+                                                                               args["tesorter_database"],
+                                                                               tesorter["threads"],
+                                                                               chunk_size=tesorter["chunk_size"],
+                                                                               workers=tesorter["workers"],
+                                                                               retries=args["tesorter_retries"]),
+                           requires=[(label, "gffread")], threads=tesorter["threads"],
+                           callback=partial(tesorter_done, state=state, log_fhand=log_fhand)))
+        if not args["stream"]:
+            #With a plan, proteins are trimmed with the threads of interproscan,
+            #so they do not wait for TEsorter
+            trim_threads = interpro["threads"] if state["plan"] is not None else 1
+            scheduler.add(Task(label, "stop_codons",
+                               lambda label=label, trim_threads=trim_threads:
+                                   remove_stop_codons(state["sequences"][label]["out_fpath"]["protein"],
+                                                      threads=trim_threads),
+                               requires=[(label, "gffread")], threads=trim_threads,
+                               callback=partial(stop_codons_done, state=state, log_fhand=log_fhand)))
+        if args["stream"]:
+            #Proteins are extracted again and searched while they are trimmed
+            scheduler.add(Task(label, "interpro",
+                               lambda label=label, values=values, extractor=extractor, interpro=interpro:
+                                   run_interpro_streaming(label, values, out_dir, interpro["threads"],
+                                                          chunk_size=interpro["chunk_size"],
+                                                          workers=interpro["workers"],
+                                                          retries=args["interpro_retries"], extractor=extractor,
+                                                          keep_intermediates=args["keep_intermediates"],
+                                                          representatives=get_representatives_fpath(label, state)),
+                               requires=[(label, "gffread")] if args["representatives"] is not None else [],
+                               threads=interpro["threads"], memory=args["interpro_memory"] * interpro["workers"],
+                               callback=partial(interpro_done, state=state, log_fhand=log_fhand)))
+        elif args["dedup"] == "fof":
+            scheduler.add(Task(label, "interpro", partial(expand_fof_hits, label, state),
+                               requires=[(label, "stop_codons"), (None, "interpro")],
+                               callback=partial(interpro_done, state=state, log_fhand=log_fhand)))
+        else:
+            scheduler.add(Task(label, "interpro",
+                               lambda label=label, interpro=interpro, options=label_interpro_options:
+                                   run_interpro(label, state["no_stop_codons_sequences"][label], interpro["threads"],
+                                                **get_interpro_options(label, state, options)),
+                               requires=[(label, "stop_codons")] + [(label, stage) for stage in interpro_requires],
+                               threads=1 if pooled else interpro["threads"],
+                               memory=0 if pooled else args["interpro_memory"] * interpro["workers"],
+                               callback=partial(interpro_done, state=state, log_fhand=log_fhand)))
+        scheduler.add(Task(label, "summary",
+                           partial(merge_evidences, label, state, TE_pfams, out_dir, mode=args["merge"],
+                                   parser=args["parser"], threads=threads, compressed=args["compress_outputs"],
+                                   pfam_counts=args["pfam_matrix"]),
+                           threads=threads if args["parser"] != "python" else 1,
+                           requires=[(label, "tesorter"), (label, "interpro")],
+                           callback=partial(summary_done, state=state, log_fhand=log_fhand)))
+        scheduler.add(Task(label, "stats",
+                           lambda label=label: run_stats_label(label, state["summaries"][label], files,
+                                                               mode=args["stats"]),
+                           requires=[(label, "summary")],
+                           callback=partial(stats_done, state=state, log_fhand=log_fhand)))
+        if args["filter_annotation"]:
+            scheduler.add(Task(label, "filter",
+                               lambda label=label, values=values: run_filter_label(label, values,
+                                                                                   state["summaries"][label], out_dir,
+                                                                                   statuses=args["filter_statuses"],
+                                                                                   te_annotation=args["te_annotation"],
+                                                                                   compressed=args["compress_outputs"]),
+                               requires=[(label, "summary")],
+                               callback=partial(filter_done, state=state, log_fhand=log_fhand)))
+
+
+def main(wrap_task=None):
+    #wrap_task(function, (label, stage)) wraps every task and final step, e.g.
+    #to time them in benchmarks/run_benchmarks.py. Returns the scheduler results
     args = get_arguments()
     files = parse_fof(args["input"])
+    args["task_threads"] = get_task_threads(args, files)
+    if args["dry_run"]:
+        plan = plan_run(files, args["threads"], args["task_threads"], read_history(args["throughput_history"]),
+                        representatives=args["representatives"])
+        print(format_plan(plan), end="")
+        return
     out_dir = args["out"]
     if not out_dir.exists():
         out_dir.mkdir(parents=True, exist_ok=True)
@@ -97,113 +789,254 @@ def main():
     log = out_dir / "log.txt"
     log_fhand = open(log, "a")
     log_fhand.write("#Command used: {}\n".format(" ".join(sys.argv)))
-    
 
-    #Retrieve sequences
-    msg = "##STEP 1: Retrive sequences with gffread\n"
-    print(msg)
-    log_fhand.write(msg)
-    sequences = run_gffread(files, args["out"])
-    failed_runs = []
-    for label, values in sequences.items():
-        for kind in ["mrna", "protein"]:
-            log_fhand.write("{} | {}\n".format(values["command"][kind], values["msg"][kind]))
-            log_fhand.flush()
-        if values["returncode"]["mrna"] == 1 or values["returncode"]["protein"] == 1:
-            failed_runs.append(label)
-            log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(label))
-            log_fhand.flush()
-    for key in failed_runs:
-        sequences.pop(key)
-
-    #Create TEsorter input
-    msg = "##STEP 2: Analyze mRNA transposable elements with TEsorter\n"
-    print(msg)
-    log_fhand.write(msg)
+    #Every (label, stage) pair is a task. Independent tasks run concurrently
+    #within the --threads budget and a label is removed from the pipeline
+    #as soon as one of its tasks fails
+    state = create_state(args, log_fhand)
+    scheduler = Scheduler(*get_scheduler_budget(args), stages=list(STEPS))
+    build_tasks(scheduler, files, args, state, log_fhand)
+    journal_tasks(scheduler, files, state, resume=args["resume"])
+    measure_tasks(scheduler, files, state)
+    if wrap_task is not None:
+        for task in scheduler.tasks.values():
+            task.function = wrap_task(task.function, task.key)
+    results = scheduler.run()
+    if state["pool"] is not None:
+        state["pool"].close()
+        log_fhand.write("#interproscan workers restarted {} times\n".format(state["pool"].get_restarts()))
+    log_reruns(state, log_fhand)
+    if args["throughput_history"] is not None:
+        record_history(scheduler, args, state, log_fhand)
+    if state["cache"] is not None:
+        state["cache"].close()
+    run_step(partial(write_combined_summaries, files, state, args["out"] / "combined_summaries.tsv"),
+             "combined_summaries", state, wrap_task=wrap_task)
+    if state["pfam_counts"]:
+        run_step(partial(write_pfam_counts, files, state, args["out"] / "pfam_status_counts.tsv", log_fhand),
+                 "pfam_matrix", state, wrap_task=wrap_task)
+    if state["store"] is not None:
+        state["store"].close()
+    write_metrics(state, args["out"], log_fhand)
+    return results
+
+
+def run_step(function, stage, state, wrap_task=None):
+    #Steps run once every task has finished
+    function = state["metrics"].wrap(function, None, stage)
+    if wrap_task is not None:
+        function = wrap_task(function, (None, stage))
+    return function()
+
+
+def get_task_threads(args, files):
+    #By default the budget is shared by the labels, so their tasks run concurrently
+    if args["task_threads"]:
+        return args["task_threads"]
+    return max(1, args["threads"] // max(1, len(files)))
+
+
+def get_scheduler_budget(args):
+    #Threads and memory of the interproscan workers are not available to the
+    #tasks, pooled interproscan tasks only wait for them
+    threads = args["threads"]
+    memory = args["memory"]
+    if args["interpro_pool"]:
+        threads = max(1, threads - args["interpro_pool"] * args["task_threads"])
+        if memory is not None:
+            memory = max(0, memory - args["interpro_pool"] * args["interpro_memory"])
+    return threads, memory
+
+
+def create_state(args, log_fhand):
+    state = {"logged_steps": set(), "sequences": {}, "TEsorter_results": {},
+             "no_stop_codons_sequences": {}, "interpro_results": {},
+             "summaries": {}, "stats_results": {}, "pfam_counts": {},
+             "filtered_annotations": {}, "cache": None, "store": None, "plan": None, "pool": None}
+    state["journal"] = StageJournal(args["out"] / "journal.jsonl")
+    state["domain_backend"] = args["domain_backend"]
+    #Residues are only needed to record the throughput, counting them reads
+    #every FASTA input again
+    state["metrics"] = MetricsCollector(args["out"] / "metrics.jsonl", url=args["metrics_collector"],
+                                        count_residues=args["throughput_history"] is not None)
+    if args["store"] is not None:
+        state["store"] = ResultStore(args["store"])
+        log_fhand.write("#Writing summaries in {}\n".format(args["store"]))
+    if args["cache"] is not None:
+        state["cache"] = ResultCache(args["cache"], max_size=args["cache_size"])
+        state["versions"] = {"TEsorter": get_tool_version("TEsorter --version"),
+                             "interproscan": get_tool_version("interproscan.sh -version")}
+        log_fhand.write("#Using cache {} for {}\n".format(args["cache"], state["versions"]))
+    if args["interpro_pool"]:
+        state["pool"] = WorkerPool(args["interpro_worker"], args["interpro_pool"], threads=args["task_threads"],
+                                   retries=args["interpro_retries"], timeout=args["interpro_batch_timeout"],
+                                   log_fpath=args["out"] / "interpro_workers.log")
+        log_fhand.write("#{} interproscan workers started by {}\n".format(args["interpro_pool"],
+                                                                       args["interpro_worker"]))
+    return state
+
+
+def get_task_input(task, state, files):
+    #File processed by each task, to account its throughput
+    label = task.label
+    if task.stage in ("gffread", "stats", "filter"):
+        return files[label]["annotation"]
+    if task.stage == "tesorter":
+        return state["sequences"][label]["out_fpath"]["mrna"]
+    if task.stage == "stop_codons":
+        return state["sequences"][label]["out_fpath"]["protein"]
+    if task.stage == "interpro":
+        if label is None:
+            return state["dedup"]["out_fpath"]
+        if label not in state["no_stop_codons_sequences"]:
+            #Streamed proteins
+            return files[label]["annotation"]
+        return state["no_stop_codons_sequences"][label]["out_fpath"]
+    if task.stage == "summary":
+        return state["interpro_results"][label]["out_fpath"]
+    return None
+
+
+def get_task_inputs(task, state, files):
+    label = task.label
+    if task.stage == "gffread" or (task.stage == "interpro" and label is not None
+                                   and label not in state["no_stop_codons_sequences"]):
+        return [files[label]["assembly"], files[label]["annotation"]]
+    if task.stage == "dedup":
+        return [values["out_fpath"] for values in state["no_stop_codons_sequences"].values()]
+    if task.stage == "interpro" and label is not None and state.get("dedup"):
+        return [state["no_stop_codons_sequences"][label]["out_fpath"], state["interpro_results"][None]["out_fpath"]]
+    if task.stage == "summary":
+        return [state["TEsorter_results"][label]["out_fpath"], state["interpro_results"][label]["out_fpath"]]
+    if task.stage == "filter":
+        return [state["summaries"][label], files[label]["annotation"]]
+    if task.stage == "interpro" and state["domain_backend"] == "te_prefilter":
+        return [state["no_stop_codons_sequences"][label]["out_fpath"], state["TEsorter_results"][label]["out_fpath"]]
+    fpath = get_task_input(task, state, files)
+    return [fpath] if fpath is not None else []
+
+
+def get_task_outputs(results):
+    #Only outputs of finished tasks are recorded
+    returncodes = results.get("returncode", 0)
+    if not isinstance(returncodes, dict):
+        returncodes = {None: returncodes}
+    if any(returncode not in (0, 99) for returncode in returncodes.values()):
+        return None
+    outputs = results.get("out_fpath")
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    elif outputs is not None:
+        outputs = [outputs]
+    if not outputs or not all(Path(fpath).exists() for fpath in outputs):
+        return None
+    return outputs
+
+
+def journaled(function, task, state, files, resume=False):
+    #With resume, outputs of stages whose inputs or outputs changed since
+    #they were recorded are removed, so they are not taken as complete
+    journal = state["journal"]
+
+    def wrapped():
+        inputs = get_task_inputs(task, state, files)
+        if resume:
+            reason = journal.get_stale_reason(task.label, task.stage, inputs)
+            if reason is not None:
+                journal.invalidate(task.label, task.stage, reason)
+        results = function()
+        outputs = get_task_outputs(results)
+        if outputs is not None:
+            journal.record(task.label, task.stage, inputs, outputs)
+        return results
+    return wrapped
+
+
+def journal_tasks(scheduler, files, state, resume=False):
+    for task in scheduler.tasks.values():
+        task.function = journaled(task.function, task, state, files, resume=resume)
+
+
+def log_reruns(state, log_fhand):
+    for label, stage, reason in state["journal"].reruns:
+        log_fhand.write("#{} of {} was run again: {}\n".format(stage, label if label is not None else "every label",
+                                                              reason))
     log_fhand.flush()
-    TEsorter_results = run_TEsorter(sequences, args["tesorter_database"], args["threads"])
-    failed_runs = []
-    for label, values in TEsorter_results.items():
-        log_fhand.write("{} | {}\n".format(values["command"], values["msg"]))
+    state["journal"].close()
+
+
+def measure_tasks(scheduler, files, state):
+    for task in scheduler.tasks.values():
+        task.function = state["metrics"].wrap(task.function, task.label, task.stage,
+                                              get_input=partial(get_task_input, task, state, files))
+
+
+def record_history(scheduler, args, state, log_fhand):
+    #Cached, deduplicated or prefiltered runs analyze fewer sequences than
+    #their input, their throughput would be too high
+    #Pooled runs wait for free workers
+    if (state["cache"] is not None or args["dedup"] != "none" or args["domain_backend"] != "interproscan"
+            or args["interpro_pool"]):
+        log_fhand.write("#Throughput not recorded, only runs without --cache, --dedup, --interpro_pool and other domain backends are\n")
         log_fhand.flush()
-        if values["returncode"] == 1:
-            failed_runs.append(label)
-            log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(label))
-            log_fhand.flush()
-
-    for key in failed_runs:
-        sequences.pop(key)
-        TEsorter_results.pop(key)
-    #Trim Sequences with internal stop codons
-    msg = "##STEP 3: Remove internal stop codons from proteins\n"
-    print(msg)
-    log_fhand.write(msg)
+        return
+    with state["metrics"].lock:
+        tasks = list(state["metrics"].tasks.items())
+    runs = get_recorded_runs(tasks, {key: task.threads for key, task in scheduler.tasks.items()})
+    if runs:
+        record_throughput(args["throughput_history"], runs)
+    log_fhand.write("#Throughput of {} runs recorded in {}\n".format(len(runs), args["throughput_history"]))
     log_fhand.flush()
-    no_stop_codons_sequences = {}
-    for key, values in sequences.items():
-        protein_seqs = values["out_fpath"]["protein"]
-        results = remove_stop_codons(protein_seqs)
-        log_fhand.write("{} | {}\n".format(results["command"], results["msg"]))
-        no_stop_codons_sequences[key] = results
-    
 
-    #Run interproscan
-    msg = "##STEP 4: Analyze protein transposable elements with interproscan\n"
-    print(msg)
-    log_fhand.write(msg)
-    log_fhand.flush()
-    interpro_results = run_interpro(no_stop_codons_sequences, args["threads"])
-    failed_runs = []
-    for label, values in interpro_results.items():
-         if values["returncode"] == 1:
-            failed_runs.append(label)
-            log_fhand.write("Removed {} from pipeline, please check the error message\n\n".format(label))
-         else:
-            log_fhand.write("{} | {}\n".format(values["command"], values["msg"]))
-    for label in failed_runs:
-        interpro_results.pop(label)
-
-
-    msg = "##STEP 5: merging evidences from interpro and TEsorter\n"
-    print(msg)
-    log_fhand.write(msg)
-    log_fhand.flush()
-    database = REXDB_PFAMS[args["tesorter_database"]]
-    TE_pfams = get_pfams_from_db(database)
-    summaries = {}
-    for label in sequences:
-        if label in interpro_results and label in TEsorter_results:
-            with open(TEsorter_results[label]["out_fpath"]) as TEsorter_fhand:
-                te_sorter_output = parse_TEsort_output(TEsorter_fhand)
-        
-            with open(interpro_results[label]["out_fpath"]) as interpro_fhand:
-                interpro = get_pfams_from_interpro_query(interpro_fhand)
-                classified_pfams = classify_pfams(interpro, TE_pfams)
-    
-            te_summary = create_summary(classified_pfams, te_sorter_output)
-    
-            out_fpath = Path(out_dir / label / "{}_TE_summary.csv".format(label))
-            with open(out_fpath, "w") as out_fhand:
-                write_summary(te_summary, out_fhand)
-                summaries[label] = out_fpath
-                msg = "TE Summary for {} written in {}\n".format(label, out_fpath)
-                log_fhand.write(msg)
-                log_fhand.flush()
-    
-    msg = "##STEP 6: Running stats on annotation files\n"
-    print(msg)
-    log_fhand.write(msg)
+
+def write_metrics(state, out_dir, log_fhand):
+    metrics = state["metrics"]
+    table = metrics.write_throughput(out_dir / "metrics_summary.tsv")
+    log_fhand.write("#Time and resources used by every step, also in {}:\n".format(metrics.fpath))
+    log_fhand.write(table)
+    if metrics.url_error is not None:
+        log_fhand.write("#Metrics could not be sent to {}: {}\n".format(metrics.url, metrics.url_error))
     log_fhand.flush()
-    agat_results = run_agat(summaries, files)
-    with open(args["out"]/ "combined_summaries.tsv", "w") as combined_summaries_fhand:
+    metrics.close()
+
+
+def write_combined_summaries(files, state, out_fpath):
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as combined_summaries_fhand:
         header = create_header()
         combined_summaries_fhand.write(header)
-        for label, results in agat_results.items():
-            stats = get_stats(results["out_fpath"], summaries[label])
-            genome = files[label]["assembly"].stem
-            annotation = files[label]["annotation"].stem
+        for label in files:
+            if label not in state["stats_results"]:
+                continue
+            results = state["stats_results"][label]
+            genome = get_stem(files[label]["assembly"])
+            annotation = get_stem(files[label]["annotation"])
+            if state["store"] is not None:
+                #Counts come from an aggregate query instead of the summary file
+                state["store"].set_run(label, genome, annotation, results["num_transcripts"])
+                stats = state["store"].get_stats(label)
+            elif label in state["pfam_counts"]:
+                #Counted while the summary was written
+                stats = read_status_counts(state["pfam_counts"][label])
+                stats["num_transcripts"] = results["num_transcripts"]
+            else:
+                stats = get_stats(results["num_transcripts"], state["summaries"][label])
+            if state["domain_backend"] == "te_prefilter":
+                #Proteins without TE domains or TEsorter hits were not analyzed
+                stats["PcpM0"] = None
             row = get_row(label, genome, annotation, stats)
             combined_summaries_fhand.write(row)
+    os.replace(tmp_fpath, out_fpath)
+
+
+def write_pfam_counts(files, state, out_fpath, log_fhand):
+    #Labels in the same order as in combined_summaries.tsv
+    counts_fpaths = {label: state["pfam_counts"][label] for label in files
+                     if label in state["pfam_counts"] and label in state["stats_results"]}
+    num_cells = write_pfam_matrix(counts_fpaths, out_fpath)
+    log_fhand.write("#Pfam x status counts of {} labels ({} cells) written in {}\n".format(len(counts_fpaths),
+                                                                                          num_cells, out_fpath))
+    log_fhand.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import argparse
+import sys
+
+from pathlib import Path
+
+from src.store import ResultStore, STATUSES
+
+
+#Generating program options
+def parse_arguments():
+    desc = "Query the summaries stored by DeTEnGA.py --store across every run"
+    parser = argparse.ArgumentParser(description=desc)
+
+    help_store = "(Required) sqlite file written by DeTEnGA.py --store"
+    parser.add_argument("--store", "-s", type=str,
+                        help=help_store, required=True)
+
+    help_pfam = "(Optional) only transcripts with this Pfam domain (e.g. PF00078)"
+    parser.add_argument("--pfam", "-p", type=str,
+                        help=help_pfam, default=None)
+
+    help_status = "(Optional) only transcripts with this DeTEnGA status (e.g. PchMte)"
+    parser.add_argument("--status", type=str, choices=STATUSES,
+                        help=help_status, default=None)
+
+    help_label = "(Optional) only transcripts of this run"
+    parser.add_argument("--label", "-l", type=str,
+                        help=help_label, default=None)
+
+    help_transcript = "(Optional) only transcripts with this ID"
+    parser.add_argument("--transcript", type=str,
+                        help=help_transcript, default=None)
+
+    help_count = "(Optional) write the number of matching transcripts per run instead of the transcripts"
+    parser.add_argument("--count", "-c", action="store_true",
+                        help=help_count)
+
+    help_runs = "(Optional) write the runs in the store and their stats"
+    parser.add_argument("--runs", action="store_true",
+                        help=help_runs)
+
+    return parser
+
+
+def get_arguments():
+    parser = parse_arguments().parse_args()
+    store = Path(parser.store)
+    if not store.exists():
+        raise RuntimeError("Store {} does not exist".format(store))
+    return {"store": store,
+            "pfam": parser.pfam,
+            "status": parser.status,
+            "label": parser.label,
+            "transcript": parser.transcript,
+            "count": parser.count,
+            "runs": parser.runs}
+
+
+def main():
+    args = get_arguments()
+    store = ResultStore(args["store"])
+    out_fhand = sys.stdout
+    if args["runs"]:
+        out_fhand.write("\t".join(["Run", "Genome", "Annotation", "Annotated_transcripts"] + list(STATUSES)) + "\n")
+        for label, genome, annotation, num_transcripts in store.get_runs():
+            stats = store.get_stats(label)
+            row = [label, genome, annotation, str(num_transcripts)] + [str(stats[key]) for key in STATUSES]
+            out_fhand.write("\t".join(row) + "\n")
+    elif args["count"]:
+        out_fhand.write("Run\tTranscripts\n")
+        for label, count in store.count_labels(pfam=args["pfam"], status=args["status"],
+                                               label=args["label"], transcript=args["transcript"]):
+            out_fhand.write("{}\t{}\n".format(label, count))
+    else:
+        out_fhand.write("Run\tTranscript_ID\tDeTEnGA_status\tInterpro_status\tTEsort_class\tPFAM_domains\n")
+        for row in store.query(pfam=args["pfam"], status=args["status"],
+                               label=args["label"], transcript=args["transcript"]):
+            out_fhand.write("\t".join(str(value) if value is not None else "NA" for value in row) + "\n")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import argparse
+import random
+
+from pathlib import Path
+
+
+#Synthetic assemblies and annotations to benchmark DeTEnGA without real data.
+#Every gene has three exons, and one in ISOFORM_EVERY genes has a second
+#isoform without the middle exon
+EXONS = 3
+EXON_LENGTH = (60, 150)
+INTRON_LENGTH = 50
+INTERGENIC_LENGTH = 100
+ISOFORM_EVERY = 5
+LINE_LENGTH = 60
+NUCLEOTIDES = bytes(b"ACGT"[idx % 4] for idx in range(256))
+NON_TE_PFAMS = ["PF{:05d}".format(idx) for idx in range(1, 400)]
+
+
+def get_te_pfams(database):
+    pfams = []
+    with open(database) as fhand:
+        for line in fhand:
+            if not line.startswith("#") and line.strip():
+                pfams.append(line.split()[0])
+    return pfams
+
+
+def write_assembly(fpath, length, rng, seqid="chr1"):
+    #Random bytes translated to nucleotides, written in 60 bp lines
+    with open(fpath, "wb") as out_fhand:
+        out_fhand.write(">{}\n".format(seqid).encode())
+        block_size = LINE_LENGTH * 100000
+        for start in range(0, length, block_size):
+            block = rng.randbytes(min(block_size, length - start)).translate(NUCLEOTIDES)
+            lines = [block[idx:idx + LINE_LENGTH] for idx in range(0, len(block), LINE_LENGTH)]
+            out_fhand.write(b"\n".join(lines) + b"\n")
+
+
+def write_annotation(fpath, num_transcripts, rng, seqid="chr1"):
+    #Returns the IDs of the transcripts and the length of the assembly needed
+    transcripts = []
+    position = INTERGENIC_LENGTH
+    lines = ["##gff-version 3\n"]
+    with open(fpath, "w") as out_fhand:
+        gene_idx = 0
+        while len(transcripts) < num_transcripts:
+            gene = "gene{}".format(gene_idx)
+            exons = []
+            start = position
+            for _ in range(EXONS):
+                length = rng.randint(*EXON_LENGTH) // 3 * 3
+                exons.append((position, position + length - 1))
+                position += length + INTRON_LENGTH
+            end = exons[-1][1]
+            strand = "+" if gene_idx % 2 == 0 else "-"
+            lines.append("{}\tbench\tgene\t{}\t{}\t.\t{}\t.\tID={}\n".format(seqid, start, end, strand, gene))
+            isoforms = [exons]
+            if gene_idx % ISOFORM_EVERY == 0 and len(transcripts) + 1 < num_transcripts:
+                isoforms.append([exons[0], exons[-1]])
+            for isoform_idx, isoform in enumerate(isoforms, 1):
+                transcript = "{}.t{}".format(gene, isoform_idx)
+                transcripts.append(transcript)
+                lines.append("{}\tbench\tmRNA\t{}\t{}\t.\t{}\t.\tID={};Parent={}\n".format(seqid, start, end,
+                                                                                       strand, transcript, gene))
+                for exon_idx, (exon_start, exon_end) in enumerate(isoform, 1):
+                    lines.append("{}\tbench\texon\t{}\t{}\t.\t{}\t.\tID={}.exon{};Parent={}\n".format(seqid, exon_start, exon_end,
+                                                                                                   strand, transcript, exon_idx,
+                                                                                                   transcript))
+                    lines.append("{}\tbench\tCDS\t{}\t{}\t.\t{}\t0\tID={}.cds;Parent={}\n".format(seqid, exon_start, exon_end,
+                                                                                               strand, transcript, transcript))
+            position += INTERGENIC_LENGTH
+            gene_idx += 1
+            if len(lines) > 50000:
+                out_fhand.write("".join(lines))
+                lines = []
+        out_fhand.write("".join(lines))
+    return transcripts, position + INTERGENIC_LENGTH
+
+
+def write_interpro_output(fpath, transcripts, te_pfams, rng):
+    #Four in five transcripts have Pfam hits, some of them from TE domains,
+    #mixed with hits of other databases like real interproscan outputs
+    lines = []
+    with open(fpath, "w") as out_fhand:
+        for transcript in transcripts:
+            if rng.random() < 0.2:
+                continue
+            num_hits = rng.randint(1, 4)
+            for _ in range(num_hits):
+                pfam = rng.choice(te_pfams) if rng.random() < 0.3 else rng.choice(NON_TE_PFAMS)
+                start = rng.randint(1, 200)
+                lines.append("{}\tmd5\t300\tPfam\t{}\t{} domain\t{}\t{}\t1.2E-10\tT\t01-01-2024\n".format(transcript, pfam, pfam,
+                                                                                                       start, start + rng.randint(20, 100)))
+                lines.append("{}\tmd5\t300\tGene3D\tG3DSA:1.10.10.10\t-\t{}\t{}\t3.4E-5\tT\t01-01-2024\n".format(transcript, start,
+                                                                                                             start + 50))
+            if len(lines) > 50000:
+                out_fhand.write("".join(lines))
+                lines = []
+        out_fhand.write("".join(lines))
+
+
+def write_tesorter_output(fpath, transcripts, rng):
+    with open(fpath, "w") as out_fhand:
+        out_fhand.write("#TE\tOrder\tSuperfamily\tClade\tComplete\tStrand\tDomains\n")
+        lines = []
+        for transcript in transcripts:
+            if rng.random() < 0.25:
+                lines.append("{}\tLTR\tCopia\tAle\t{}\t+\tGAG|Ale PROT|Ale RT|Ale\n".format(transcript,
+                                                                                     rng.choice(["yes", "no"])))
+        out_fhand.write("".join(lines))
+
+
+def write_proteins(fpath, transcripts, rng):
+    #Proteins with stop codons, some of them in the middle of the sequence
+    aminoacids = "ACDEFGHIKLMNPQRSTVWY"
+    with open(fpath, "w") as out_fhand:
+        lines = []
+        for transcript in transcripts:
+            seq = "M" + "".join(rng.choices(aminoacids, k=rng.randint(50, 400)))
+            if rng.random() < 0.1:
+                position = rng.randint(1, len(seq) - 1)
+                seq = seq[:position] + "." + seq[position:]
+            seq += "."
+            lines.append(">{}\n{}\n".format(transcript, "\n".join(seq[idx:idx + LINE_LENGTH]
+                                                                 for idx in range(0, len(seq), LINE_LENGTH))))
+            if len(lines) > 10000:
+                out_fhand.write("".join(lines))
+                lines = []
+        out_fhand.write("".join(lines))
+
+
+def write_agat_output(fpath, num_transcripts):
+    with open(fpath, "w") as out_fhand:
+        out_fhand.write("Number of gene                               {}\n".format(num_transcripts))
+        out_fhand.write("Number of mrna                               {}\n".format(num_transcripts))
+
+
+def write_pfam_hmms(fpath, pfams):
+    #Only the fields read by DeTEnGA and the hmmsearch stand-in
+    with open(fpath, "w") as out_fhand:
+        for pfam in pfams:
+            out_fhand.write("HMMER3/f [3.1b2 | February 2015]\nNAME  {}\nACC   {}.1\nLENG  100\n"
+                            "GA    25.00 25.00;\n//\n".format(pfam, pfam))
+
+
+def get_label_paths(out_dir, label):
+    out_dir = Path(out_dir)
+    return {"assembly": out_dir / "{}.fasta".format(label),
+            "annotation": out_dir / "{}.gff3".format(label),
+            "interpro": out_dir / "{}.interpro.tsv".format(label),
+            "tesorter": out_dir / "{}.cls.tsv".format(label),
+            "proteins": out_dir / "{}.pep.fasta".format(label),
+            "agat": out_dir / "{}.agat.stats.txt".format(label)}
+
+
+def generate(out_dir, num_transcripts, num_labels=1, seed=1, database=None):
+    #Returns the file of files and the fake tool outputs of every label
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    if database is None:
+        database = Path(__file__).absolute().parents[1] / "data" / "Viridiplantae_2.0_pfams.txt"
+    te_pfams = get_te_pfams(database)
+    fof = out_dir / "fof.txt"
+    write_pfam_hmms(out_dir / "Pfam-A.hmm", te_pfams + NON_TE_PFAMS)
+    outputs = {}
+    with open(fof, "w") as fof_fhand:
+        for label_idx in range(num_labels):
+            label = "bench{}".format(label_idx)
+            paths = get_label_paths(out_dir, label)
+            transcripts, length = write_annotation(paths["annotation"], num_transcripts, rng)
+            write_assembly(paths["assembly"], length, rng)
+            write_interpro_output(paths["interpro"], transcripts, te_pfams, rng)
+            write_tesorter_output(paths["tesorter"], transcripts, rng)
+            write_proteins(paths["proteins"], transcripts, rng)
+            write_agat_output(paths["agat"], len(transcripts))
+            fof_fhand.write("{}\t{}\t{}\n".format(label, paths["assembly"].absolute(),
+                                                  paths["annotation"].absolute()))
+            outputs[label] = paths
+    return fof, outputs
+
+
+#Generating program options
+def parse_arguments():
+    desc = "Generate synthetic assemblies, annotations and tool outputs for benchmarks"
+    parser = argparse.ArgumentParser(description=desc)
+
+    help_output_dir = "(Required) Output dir"
+    parser.add_argument("--output", "-o", type=str,
+                        help=help_output_dir, required=True)
+
+    help_transcripts = "(Optional) number of transcripts per annotation. 10000 by default"
+    parser.add_argument("--transcripts", "-n", type=int,
+                        help=help_transcripts, default=10000)
+
+    help_labels = "(Optional) number of assemblies and annotations. 1 by default"
+    parser.add_argument("--labels", "-l", type=int,
+                        help=help_labels, default=1)
+
+    help_seed = "(Optional) random seed. 1 by default"
+    parser.add_argument("--seed", type=int,
+                        help=help_seed, default=1)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    fof, _ = generate(args.output, args.transcripts, num_labels=args.labels, seed=args.seed)
+    print("File of files written in {}".format(fof))
+
+
+if __name__ == "__main__":
+    main()
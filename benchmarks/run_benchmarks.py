@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+from functools import partial
+from pathlib import Path
+from subprocess import run
+
+BENCHMARKS_DIR = Path(__file__).absolute().parents[0]
+sys.path.insert(0, str(BENCHMARKS_DIR.parents[0]))
+
+import DeTEnGA
+
+from generate_data import generate, get_label_paths
+from src.annotation import count_features
+from src.extract import extract_transcripts
+from src.fasta import trim_fasta
+from src.fastparse import get_pfams_from_interpro_file, parse_TEsort_file
+from src.parsers import (get_pfams_from_db, get_pfams_from_interpro_query, parse_TEsort_output,
+                         classify_pfams, create_summary, write_summary, get_stats,
+                         iter_pfams_from_interpro_query, parse_TEsort_output_compact,
+                         iter_summary_rows, write_summary_rows, get_num_transcripts_from_agat)
+from src.matrix import PfamCounter
+
+
+STUBS_DIR = BENCHMARKS_DIR / "stubs"
+TE_PFAMS = get_pfams_from_db(BENCHMARKS_DIR.parents[0] / "data" / "Viridiplantae_2.0_pfams.txt")
+
+
+def measure(function, repeat=1, trace_memory=True):
+    #Best wall time of repeat runs. Peak memory is measured with tracemalloc
+    #in an extra run, so it does not slow down the timed ones
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    results = {"seconds": min(times), "runs": repeat}
+    if trace_memory:
+        tracemalloc.start()
+        function()
+        results["peak_python_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        tracemalloc.stop()
+    return results
+
+
+def merge_in_memory(outputs, out_fpath):
+    with open(outputs["tesorter"]) as TEsorter_fhand:
+        te_sorter_output = parse_TEsort_output(TEsorter_fhand)
+    with open(outputs["interpro"]) as interpro_fhand:
+        interpro = get_pfams_from_interpro_query(interpro_fhand)
+    with open(out_fpath, "w") as out_fhand:
+        write_summary(create_summary(classify_pfams(interpro, TE_PFAMS), te_sorter_output), out_fhand)
+
+
+def merge_streaming(outputs, out_fpath):
+    with open(outputs["tesorter"]) as TEsorter_fhand:
+        te_sorter_output = parse_TEsort_output_compact(TEsorter_fhand)
+    with open(outputs["interpro"]) as interpro_fhand, open(out_fpath, "w") as out_fhand:
+        write_summary_rows(iter_summary_rows(iter_pfams_from_interpro_query(interpro_fhand),
+                                             te_sorter_output, TE_PFAMS), out_fhand)
+
+
+def count_pfams(summary):
+    counter = PfamCounter()
+    with open(summary) as fhand:
+        fhand.readline()
+        counter.add_rows(line.rstrip("\n").split(";") for line in fhand)
+    return counter.get_stats(0)
+
+
+def read_with(function, fpath):
+    with open(fpath) as fhand:
+        result = function(fhand)
+        if not isinstance(result, dict):
+            #Generators have to be consumed
+            for _ in result:
+                pass
+
+
+def get_parser_benchmarks(outputs, work_dir):
+    summary = work_dir / "summary.csv"
+    return [("get_pfams_from_interpro_query", partial(read_with, get_pfams_from_interpro_query, outputs["interpro"])),
+            ("iter_pfams_from_interpro_query", partial(read_with, iter_pfams_from_interpro_query, outputs["interpro"])),
+            ("get_pfams_from_interpro_file", partial(get_pfams_from_interpro_file, outputs["interpro"])),
+            ("parse_TEsort_output", partial(read_with, parse_TEsort_output, outputs["tesorter"])),
+            ("parse_TEsort_output_compact", partial(read_with, parse_TEsort_output_compact, outputs["tesorter"])),
+            ("parse_TEsort_file", partial(parse_TEsort_file, outputs["tesorter"])),
+            ("merge_in_memory", partial(merge_in_memory, outputs, summary)),
+            ("merge_streaming", partial(merge_streaming, outputs, work_dir / "summary.streaming.csv")),
+            ("get_stats", partial(get_stats, 0, summary)),
+            ("PfamCounter", partial(count_pfams, summary)),
+            ("count_features", partial(read_with, count_features, outputs["annotation"])),
+            ("get_num_transcripts_from_agat", partial(get_num_transcripts_from_agat, outputs["agat"])),
+            ("trim_fasta", partial(trim_fasta, outputs["proteins"], work_dir / "trimmed.fasta",
+                                   work_dir / "trimmed.log")),
+            ("extract_transcripts", partial(extract_transcripts, outputs["assembly"], outputs["annotation"],
+                                            work_dir / "mrna.fasta", work_dir / "pep.fasta"))]
+
+
+def benchmark_parsers(outputs, work_dir, repeat=1, trace_memory=True, only=None):
+    results = {}
+    for name, function in get_parser_benchmarks(outputs, work_dir):
+        if only and name not in only:
+            continue
+        results[name] = measure(function, repeat=repeat, trace_memory=trace_memory)
+        print("  {:<32}{:>10.3f} s".format(name, results[name]["seconds"]), file=sys.stderr)
+    return results
+
+
+def timed_task(function, key, timings, trace_memory):
+    def wrapped():
+        if trace_memory:
+            tracemalloc.reset_peak()
+        times = os.times()
+        start = time.perf_counter()
+        result = function()
+        end = time.perf_counter()
+        end_times = os.times()
+        timing = {"label": key[0], "stage": key[1], "seconds": end - start,
+                  "cpu_seconds": sum(end_times[:4]) - sum(times[:4]),
+                  #Maximum resident set of any external tool run so far
+                  "children_max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 2)}
+        if trace_memory:
+            timing["peak_python_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        timings.append(timing)
+        return result
+    return wrapped
+
+
+def run_pipeline(fof, out_dir, options, trace_memory=False):
+    #DeTEnGA.main() is run in this process with one thread, so tasks run one
+    #at a time and time and memory can be assigned to each (label, stage)
+    sys_argv = sys.argv
+    sys.argv = ["DeTEnGA.py", "-i", str(fof), "-o", str(out_dir), "-t", "1"] + options
+    timings = []
+    start = time.perf_counter()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        scheduled = DeTEnGA.main(wrap_task=partial(timed_task, timings=timings, trace_memory=trace_memory))
+    finally:
+        sys.argv = sys_argv
+        if trace_memory:
+            tracemalloc.stop()
+    return {"seconds": time.perf_counter() - start, "tasks": timings,
+            "failed": sorted(str(label) for label in scheduled["failed"])}
+
+
+def benchmark_pipeline(fof, out_dir, options, trace_memory=True):
+    #tracemalloc slows python code down a lot, so peak memory is measured
+    #in a second run and the times are the ones of the first
+    results = run_pipeline(fof, out_dir, options)
+    if trace_memory:
+        traced = run_pipeline(fof, Path("{}_memory".format(out_dir)), options, trace_memory=True)
+        peaks = {(timing["label"], timing["stage"]): timing.get("peak_python_mb") for timing in traced["tasks"]}
+        for timing in results["tasks"]:
+            if peaks.get((timing["label"], timing["stage"])) is not None:
+                timing["peak_python_mb"] = peaks[(timing["label"], timing["stage"])]
+    stages = {}
+    for timing in results["tasks"]:
+        stage = stages.setdefault(timing["stage"], {"seconds": 0, "tasks": 0})
+        stage["seconds"] += timing["seconds"]
+        stage["tasks"] += 1
+        if "peak_python_mb" in timing:
+            stage["peak_python_mb"] = max(stage.get("peak_python_mb", 0), timing["peak_python_mb"])
+    for stage, values in stages.items():
+        print("  {:<32}{:>10.3f} s".format(stage, values["seconds"]), file=sys.stderr)
+    results["stages"] = stages
+    return results
+
+
+def benchmark_end_to_end(fof, out_dir, options, threads):
+    #DeTEnGA.py as users run it. Peak memory is the resident set of the
+    #process, external tools are measured on their own
+    cmd = [sys.executable, str(BENCHMARKS_DIR.parents[0] / "DeTEnGA.py"), "-i", str(fof), "-o", str(out_dir),
+           "-t", str(threads)] + options
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.execv(sys.executable, cmd)
+    _, status, rusage = os.wait4(pid, 0)
+    seconds = time.perf_counter() - start
+    results = {"seconds": seconds, "returncode": os.waitstatus_to_exitcode(status),
+               "max_rss_mb": round(rusage.ru_maxrss / 1024, 2),
+               "cpu_seconds": rusage.ru_utime + rusage.ru_stime, "threads": threads}
+    print("  {:<32}{:>10.3f} s".format("DeTEnGA.py", seconds), file=sys.stderr)
+    return results
+
+
+def get_commit():
+    run_ = run("git rev-parse HEAD", shell=True, capture_output=True, cwd=BENCHMARKS_DIR)
+    return run_.stdout.decode().strip() if run_.returncode == 0 else "unknown"
+
+
+def compare(results, previous):
+    #Ratio of every time against a previous results file, > 1 means slower
+    lines = ["Scale\tBenchmark\tPrevious_s\tCurrent_s\tRatio\n"]
+    for scale, values in results["scales"].items():
+        old_values = previous["scales"].get(scale)
+        if old_values is None:
+            continue
+        pairs = []
+        for name, bench in values.get("parsers", {}).items():
+            pairs.append((name, old_values.get("parsers", {}).get(name, {}).get("seconds"), bench["seconds"]))
+        for stage, bench in values.get("pipeline", {}).get("stages", {}).items():
+            old_stage = old_values.get("pipeline", {}).get("stages", {}).get(stage, {})
+            pairs.append(("stage:" + stage, old_stage.get("seconds"), bench["seconds"]))
+        if "end_to_end" in values:
+            pairs.append(("DeTEnGA.py", old_values.get("end_to_end", {}).get("seconds"),
+                          values["end_to_end"]["seconds"]))
+        for name, old, new in pairs:
+            if old:
+                lines.append("{}\t{}\t{:.3f}\t{:.3f}\t{:.2f}\n".format(scale, name, old, new, new / old))
+    return "".join(lines)
+
+
+#Generating program options
+def parse_arguments():
+    desc = "Benchmark DeTEnGA parsers and pipeline stages with synthetic data and stand-in tools"
+    parser = argparse.ArgumentParser(description=desc)
+
+    help_output_dir = "(Required) Output dir for data, pipeline outputs and results"
+    parser.add_argument("--output", "-o", type=str,
+                        help=help_output_dir, required=True)
+
+    help_scales = "(Optional) comma separated numbers of transcripts. 10000 by default"
+    parser.add_argument("--scales", "-s", type=str,
+                        help=help_scales, default="10000")
+
+    help_labels = "(Optional) number of annotations in the file of files. 1 by default"
+    parser.add_argument("--labels", "-l", type=int,
+                        help=help_labels, default=1)
+
+    help_threads = "(Optional) threads for the end to end run. 1 by default"
+    parser.add_argument("--threads", "-t", type=int,
+                        help=help_threads, default=1)
+
+    help_repeat = "(Optional) timed runs of every parser, the best one is kept. 3 by default"
+    parser.add_argument("--repeat", "-r", type=int,
+                        help=help_repeat, default=3)
+
+    help_only = "(Optional) comma separated parser benchmarks to run. All by default"
+    parser.add_argument("--only", type=str,
+                        help=help_only, default=None)
+
+    help_options = '''(Optional) extra DeTEnGA.py options for pipeline runs,
+                      e.g. "--merge streaming --extractor native"'''
+    parser.add_argument("--options", type=str,
+                        help=help_options, default="")
+
+    help_skip = "(Optional) benchmarks not run: parsers, pipeline and/or end_to_end"
+    parser.add_argument("--skip", type=str, nargs="*", choices=["parsers", "pipeline", "end_to_end"],
+                        help=help_skip, default=[])
+
+    help_no_memory = "(Optional) do not measure python memory with tracemalloc"
+    parser.add_argument("--no_memory", action="store_true",
+                        help=help_no_memory)
+
+    help_real_tools = "(Optional) use gffread, TEsorter, interproscan and AGAT from PATH instead of the stand-ins"
+    parser.add_argument("--real_tools", action="store_true",
+                        help=help_real_tools)
+
+    help_compare = "(Optional) previous results file to compare with"
+    parser.add_argument("--compare", "-c", type=str,
+                        help=help_compare, default=None)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    out_dir = Path(args.output).absolute()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if not args.real_tools:
+        os.environ["PATH"] = "{}{}{}".format(STUBS_DIR, os.pathsep, os.environ["PATH"])
+    options = args.options.split()
+    only = args.only.split(",") if args.only else None
+    results = {"commit": get_commit(), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": platform.python_version(), "platform": platform.platform(),
+               "cpus": os.cpu_count(), "options": options, "labels": args.labels, "scales": {}}
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        print("{} transcripts".format(scale), file=sys.stderr)
+        scale_dir = out_dir / "{}_transcripts".format(scale)
+        data_dir = scale_dir / "data_{}_labels".format(args.labels)
+        if (data_dir / "fof.txt").exists():
+            #Data is generated only once for every scale
+            fof = data_dir / "fof.txt"
+            outputs = {"bench0": get_label_paths(data_dir, "bench0")}
+        else:
+            fof, outputs = generate(data_dir, scale, num_labels=args.labels)
+        scale_results = {}
+        if "parsers" not in args.skip:
+            work_dir = scale_dir / "parsers"
+            work_dir.mkdir(exist_ok=True)
+            scale_results["parsers"] = benchmark_parsers(outputs["bench0"], work_dir, repeat=args.repeat,
+                                                         trace_memory=not args.no_memory, only=only)
+        if "pipeline" not in args.skip:
+            pipeline_dir = scale_dir / "pipeline_{}".format(time.strftime("%Y%m%d%H%M%S"))
+            scale_results["pipeline"] = benchmark_pipeline(fof, pipeline_dir, options,
+                                                           trace_memory=not args.no_memory)
+        if "end_to_end" not in args.skip:
+            end_to_end_dir = scale_dir / "end_to_end_{}".format(time.strftime("%Y%m%d%H%M%S"))
+            scale_results["end_to_end"] = benchmark_end_to_end(fof, end_to_end_dir, options, args.threads)
+        results["scales"][str(scale)] = scale_results
+
+    out_fpath = out_dir / "results_{}_{}.json".format(results["commit"][:10], time.strftime("%Y%m%d%H%M%S"))
+    with open(out_fpath, "w") as out_fhand:
+        json.dump(results, out_fhand, indent=2)
+    print("Results written in {}".format(out_fpath), file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as previous_fhand:
+            print(compare(results, json.load(previous_fhand)), end="")
+
+
+if __name__ == "__main__":
+    main()
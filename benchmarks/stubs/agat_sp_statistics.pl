@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+#Stand-in for agat_sp_statistics.pl, only genes and mRNAs are counted
+import sys
+
+
+def main():
+    args = sys.argv[1:]
+    annotation = args[args.index("--gff") + 1]
+    out_fpath = args[args.index("-o") + 1]
+    counts = {"gene": 0, "mrna": 0}
+    with open(annotation) as fhand:
+        for line in fhand:
+            fields = line.split("\t")
+            if len(fields) > 2 and fields[2].lower() in counts:
+                counts[fields[2].lower()] += 1
+    with open(out_fpath, "w") as out_fhand:
+        for kind, count in counts.items():
+            out_fhand.write("Number of {:<35}{}\n".format(kind, count))
+
+
+if __name__ == "__main__":
+    main()
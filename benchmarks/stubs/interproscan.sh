@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#Stand-in for interproscan.sh: Pfam and Gene3D hits are made up from the
+#sequences, some of them from TE domains of the rexdb databases
+import os
+import sys
+import time
+import zlib
+
+
+TE_PFAMS = ["PF00075", "PF00077", "PF00078", "PF00385", "PF00665", "PF03732", "PF07727"]
+NON_TE_PFAMS = ["PF{:05d}".format(idx) for idx in range(1, 60)]
+
+
+def read_fasta(fpath):
+    header = None
+    seq = []
+    with open(fpath) as fhand:
+        for line in fhand:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(seq)
+                header = line[1:].split()[0]
+                seq = []
+            else:
+                seq.append(line.strip())
+    if header is not None:
+        yield header, "".join(seq)
+
+
+def get_hit_lines(in_fpath):
+    #Also used by the stand-in worker of --interpro_pool
+    lines = []
+    for header, seq in read_fasta(in_fpath):
+        digest = zlib.crc32(seq.encode())
+        if digest % 5 == 0:
+            continue
+        for idx in range(digest % 3 + 1):
+            pfams = TE_PFAMS if (digest >> idx) % 4 == 0 else NON_TE_PFAMS
+            pfam = pfams[(digest >> (idx + 2)) % len(pfams)]
+            start = 1 + idx * 30
+            lines.append("{}\tmd5\t{}\tPfam\t{}\t{} domain\t{}\t{}\t1.2E-10\tT\t01-01-2024\n".format(header, len(seq), pfam, pfam,
+                                                                                                start, start + 25))
+        lines.append("{}\tmd5\t{}\tGene3D\tG3DSA:1.10.10.10\t-\t1\t20\t3.4E-5\tT\t01-01-2024\n".format(header, len(seq)))
+    return lines
+
+
+def main():
+    args = sys.argv[1:]
+    if "-version" in args or "--version" in args:
+        print("InterProScan version benchmark-stub")
+        return
+    #Seconds taken to load member databases, as every interproscan.sh run does
+    time.sleep(float(os.environ.get("STUB_INTERPRO_STARTUP", 0)))
+    in_fpath = args[args.index("-i") + 1]
+    formats = args[args.index("-f") + 1].lower().split(",") if "-f" in args else ["tsv", "xml", "json", "gff3"]
+    if "-o" in args:
+        out_fpaths = {"tsv": args[args.index("-o") + 1]}
+    else:
+        base = args[args.index("-b") + 1] if "-b" in args else in_fpath
+        out_fpaths = {fmt: "{}.{}".format(base, fmt) for fmt in formats}
+    lines = get_hit_lines(in_fpath)
+    #Only the TSV has hits, the rest of the formats are empty
+    for fmt, out_fpath in out_fpaths.items():
+        with open(out_fpath, "w") as out_fhand:
+            out_fhand.write("".join(lines) if fmt == "tsv" else "")
+    print("InterProScan stub: {} hits".format(len(lines)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import os
+
+from pathlib import Path
+
+
+def parse_attributes(text):
+    attributes = {}
+    if "=" in text:
+        for item in text.strip().strip(";").split(";"):
+            if "=" in item:
+                key, value = item.split("=", 1)
+                attributes[key.strip()] = value.strip()
+    else:
+        for item in text.strip().strip(";").split(";"):
+            item = item.strip().split(" ", 1)
+            if len(item) == 2:
+                attributes[item[0]] = item[1].strip('"')
+    return attributes
+
+
+def count_features(fhand):
+    #Single pass over a GFF/GTF. Only GTF files without transcript features
+    #need to keep the transcript IDs seen to count them
+    counts = {}
+    lengths = {}
+    transcript_ids = set()
+    for line in fhand:
+        if line.startswith("#") or not line.strip():
+            continue
+        fields = line.split("\t", 9)
+        if len(fields) < 9:
+            continue
+        kind = fields[2]
+        counts[kind] = counts.get(kind, 0) + 1
+        lengths[kind] = lengths.get(kind, 0) + int(fields[4]) - int(fields[3]) + 1
+        if "transcript_id" in fields[8] and "=" not in fields[8]:
+            if not counts.get("mRNA") and not counts.get("transcript"):
+                transcript_ids.add(parse_attributes(fields[8]).get("transcript_id"))
+    if counts.get("mRNA"):
+        num_transcripts = counts["mRNA"]
+    elif counts.get("transcript"):
+        num_transcripts = counts["transcript"]
+    else:
+        num_transcripts = len(transcript_ids)
+    return {"num_transcripts": num_transcripts, "counts": counts, "lengths": lengths}
+
+
+def write_feature_counts(features, out_fpath):
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        out_fhand.write("Feature\tNumber\tTotal_length\n")
+        out_fhand.write("transcripts\t{}\tNA\n".format(features["num_transcripts"]))
+        for kind, count in features["counts"].items():
+            out_fhand.write("{}\t{}\t{}\n".format(kind, count, features["lengths"][kind]))
+    os.replace(tmp_fpath, out_fpath)
+
+
+def read_feature_counts(fpath):
+    features = {"num_transcripts": 0, "counts": {}, "lengths": {}}
+    with open(fpath) as fhand:
+        fhand.readline()
+        for line in fhand:
+            kind, count, length = line.rstrip("\n").split("\t")
+            if kind == "transcripts":
+                features["num_transcripts"] = int(count)
+            else:
+                features["counts"][kind] = int(count)
+                features["lengths"][kind] = int(length)
+    return features
+
+
+TRANSCRIPT_TYPES = ("mrna", "transcript")
+REPRESENTATIVE_RULES = ["longest_cds", "longest_transcript"]
+
+
+def get_transcript_lengths(fhand):
+    #[gene, exon length, CDS length] of every transcript, in the order in
+    #which transcripts appear in the GFF/GTF. gene is None if unknown
+    transcripts = {}
+    for line in fhand:
+        if line.startswith("#") or not line.strip():
+            continue
+        fields = line.split("\t")
+        if len(fields) < 9:
+            continue
+        kind = fields[2].lower()
+        attributes = parse_attributes(fields[8])
+        if "=" not in fields[8]:
+            if "transcript_id" not in attributes:
+                continue
+            transcript = transcripts.setdefault(attributes["transcript_id"], [None, 0, 0])
+            transcript[0] = attributes.get("gene_id")
+            parents = [attributes["transcript_id"]]
+        elif kind in TRANSCRIPT_TYPES and "ID" in attributes:
+            transcript = transcripts.setdefault(attributes["ID"], [None, 0, 0])
+            transcript[0] = attributes["Parent"].split(",")[0] if "Parent" in attributes else None
+            continue
+        else:
+            parents = attributes["Parent"].split(",") if "Parent" in attributes else []
+        if kind not in ("exon", "cds"):
+            continue
+        length = int(fields[4]) - int(fields[3]) + 1
+        for parent in parents:
+            transcripts.setdefault(parent, [None, 0, 0])[1 if kind == "exon" else 2] += length
+    return transcripts
+
+
+def choose_representatives(transcripts, rule="longest_cds"):
+    #Representative of every transcript, the one of its gene with the longest
+    #CDS (then the longest exons) or the other way round. The first one in
+    #the annotation wins ties
+    genes = {}
+    for name, (gene, exon_length, cds_length) in transcripts.items():
+        #Transcripts without exons are only their CDSs
+        exon_length = exon_length if exon_length else cds_length
+        key = (cds_length, exon_length) if rule == "longest_cds" else (exon_length, cds_length)
+        gene = gene if gene is not None else name
+        if gene not in genes or key > genes[gene][0]:
+            genes[gene] = (key, name)
+    return {name: genes[gene if gene is not None else name][1]
+            for name, (gene, _, _) in transcripts.items()}
+
+
+def write_representatives(representatives, out_fpath):
+    #Only transcripts that are not representatives are written
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        out_fhand.write("Transcript\tRepresentative\n")
+        out_fhand.write("".join("{}\t{}\n".format(name, representative)
+                                for name, representative in representatives.items() if name != representative))
+    os.replace(tmp_fpath, out_fpath)
+    return out_fpath
+
+
+def read_representatives(fpath):
+    representatives = {}
+    with open(fpath) as fhand:
+        fhand.readline()
+        for line in fhand:
+            name, representative = line.rstrip("\n").split("\t")
+            representatives[name] = representative
+    return representatives
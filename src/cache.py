@@ -0,0 +1,95 @@
+import sqlite3
+import time
+
+from subprocess import run
+from threading import Lock
+
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS results (tool TEXT, database TEXT, version TEXT,
+                                                 digest TEXT, payload TEXT, size INTEGER,
+                                                 last_used REAL,
+                                                 PRIMARY KEY (tool, database, version, digest));
+            CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+            CREATE TABLE IF NOT EXISTS headers (tool TEXT, database TEXT, version TEXT, header TEXT,
+                                                PRIMARY KEY (tool, database, version));"""
+BATCH_SIZE = 500
+
+
+def get_tool_version(cmd):
+    run_ = run(cmd, shell=True, capture_output=True)
+    if run_.returncode != 0:
+        return "unknown"
+    output = (run_.stdout.decode() + run_.stderr.decode()).strip().splitlines()
+    for line in output:
+        if "version" in line.lower():
+            return line.strip()
+    return output[0].strip() if output else "unknown"
+
+
+class ResultCache:
+    '''Results of every tool by sequence digest, so only new sequences are
+    analyzed again. Least recently used results are removed when the
+    cache grows bigger than max_size (in MB)'''
+    def __init__(self, fpath, max_size=1024):
+        self.fpath = fpath
+        self.max_size = max_size * 1024 * 1024
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(fpath), check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def lookup(self, key, digests):
+        tool, database, version = key
+        digests = list(set(digests))
+        found = {}
+        now = time.time()
+        with self.lock:
+            for idx in range(0, len(digests), BATCH_SIZE):
+                batch = digests[idx:idx + BATCH_SIZE]
+                query = "SELECT digest, payload FROM results WHERE tool=? AND database=? AND version=? AND digest IN ({})"
+                query = query.format(",".join("?" * len(batch)))
+                for digest, payload in self.conn.execute(query, [tool, database, version] + batch):
+                    found[digest] = payload
+            self.conn.executemany("UPDATE results SET last_used=? WHERE tool=? AND database=? AND version=? AND digest=?",
+                                  [(now, tool, database, version, digest) for digest in found])
+            self.conn.commit()
+        return found
+
+    def store(self, key, results):
+        tool, database, version = key
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(tool, database, version, digest, payload, len(payload) + len(digest), now)
+                                   for digest, payload in results.items()])
+            self.conn.commit()
+            self.evict()
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_size:
+            return
+        to_remove = total - self.max_size
+        removed = 0
+        digests = []
+        for tool, database, version, digest, size in self.conn.execute("SELECT tool, database, version, digest, size FROM results ORDER BY last_used"):
+            digests.append((tool, database, version, digest))
+            removed += size
+            if removed >= to_remove:
+                break
+        self.conn.executemany("DELETE FROM results WHERE tool=? AND database=? AND version=? AND digest=?",
+                              digests)
+        self.conn.commit()
+
+    def get_header(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT header FROM headers WHERE tool=? AND database=? AND version=?",
+                                    key).fetchone()
+        return row[0] if row else None
+
+    def set_header(self, key, header):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", list(key) + [header])
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,217 @@
+import gzip
+import io
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import zlib
+
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+from subprocess import Popen, PIPE
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_SUFFIXES = (".gz", ".bgz")
+COMPRESS_LEVEL = 6
+BUFFER_SIZE = 4 * 1024 * 1024
+#Decompressed BGZF blocks kept by each reader, 64 KB at most each
+BGZF_CACHE_BLOCKS = 256
+
+
+def is_gzipped(fpath):
+    #Missing files fail in the task that reads them, only their label is removed
+    if not os.path.exists(fpath):
+        return False
+    with open(fpath, "rb") as fhand:
+        return fhand.read(2) == GZIP_MAGIC
+
+
+def read_bgzf_header(fhand):
+    #Size of the BGZF block that starts at the current position, None at the
+    #end of the file or if it is not a BGZF block (e.g. plain gzip)
+    header = fhand.read(12)
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        return None
+    extra = fhand.read(struct.unpack("<H", header[10:12])[0])
+    position = 0
+    while position + 4 <= len(extra):
+        length = struct.unpack("<H", extra[position + 2:position + 4])[0]
+        if extra[position:position + 2] == b"BC" and length == 2:
+            return struct.unpack("<H", extra[position + 4:position + 6])[0] + 1
+        position += 4 + length
+    return None
+
+
+def is_bgzf(fpath):
+    with open(fpath, "rb") as fhand:
+        return read_bgzf_header(fhand) is not None
+
+
+def get_stem(fpath):
+    #Stem of the uncompressed file name: genome.fa.gz -> genome
+    fpath = Path(fpath)
+    if fpath.suffix in GZIP_SUFFIXES:
+        fpath = fpath.with_suffix("")
+    return fpath.stem
+
+
+def get_output_name(fpath, compressed=False):
+    return Path("{}.gz".format(fpath)) if compressed else Path(fpath)
+
+
+class PipedFile:
+    '''File object reading the output of pigz, the process is waited for when
+    it is closed and an OSError is raised if it failed'''
+    def __init__(self, cmd, mode):
+        self.cmd = cmd
+        #stderr goes to a file, a full pipe would block pigz
+        self.stderr = tempfile.TemporaryFile()
+        self.process = Popen(cmd, stdout=PIPE, stderr=self.stderr)
+        self.fhand = self.process.stdout if "b" in mode else io.TextIOWrapper(self.process.stdout)
+
+    def __getattr__(self, name):
+        return getattr(self.fhand, name)
+
+    def __iter__(self):
+        return iter(self.fhand)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fhand.close()
+        #pigz is killed by SIGPIPE when the file is not read to the end
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        error = self.stderr.read().decode(errors="replace").strip()
+        self.stderr.close()
+        if returncode not in (0, -signal.SIGPIPE):
+            raise OSError("{} failed with code {}: {}".format(" ".join(self.cmd), returncode, error))
+
+
+def open_file(fpath, mode="rt", threads=1):
+    #Plain and gzip/BGZF files are read the same way, with pigz when it is
+    #installed. Files are written compressed when their name (without a
+    #.tmp suffix) ends with .gz
+    if "b" not in mode and "t" not in mode:
+        mode += "t"
+    if "r" in mode:
+        if not is_gzipped(fpath):
+            return open(fpath, mode)
+        pigz = shutil.which("pigz")
+        if pigz is not None:
+            return PipedFile([pigz, "-dc", "-p", str(max(1, threads)), str(fpath)], mode)
+        return gzip.open(fpath, mode)
+    name = str(fpath)[:-4] if str(fpath).endswith(".tmp") else str(fpath)
+    if name.endswith(GZIP_SUFFIXES):
+        return gzip.open(fpath, mode, compresslevel=COMPRESS_LEVEL)
+    return open(fpath, mode)
+
+
+def compress_file(in_fpath, out_fpath, threads=1):
+    #in_fpath is removed once it is compressed, with pigz when it is installed
+    pigz = shutil.which("pigz")
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "wb") as out_fhand:
+        if pigz is not None:
+            process = Popen([pigz, "-c", "-{}".format(COMPRESS_LEVEL), "-p", str(max(1, threads)), str(in_fpath)],
+                            stdout=out_fhand)
+            if process.wait() != 0:
+                raise OSError("pigz could not compress {}".format(in_fpath))
+        else:
+            with open(in_fpath, "rb") as in_fhand, gzip.GzipFile(fileobj=out_fhand, mode="wb",
+                                                                 compresslevel=COMPRESS_LEVEL) as gz_fhand:
+                shutil.copyfileobj(in_fhand, gz_fhand, BUFFER_SIZE)
+    os.replace(tmp_fpath, out_fpath)
+    os.remove(in_fpath)
+    return out_fpath
+
+
+def decompress_file(in_fpath, out_fpath, threads=1):
+    with open_file(in_fpath, "rb", threads=threads) as in_fhand, open(out_fpath, "wb") as out_fhand:
+        shutil.copyfileobj(in_fhand, out_fhand, BUFFER_SIZE)
+    return out_fpath
+
+
+def build_gzi_index(fpath):
+    #(compressed, uncompressed) offsets of every BGZF block, only headers and
+    #footers are read. Written in the .gzi format of bgzip, an existing and
+    #up to date index is reused
+    gzi_fpath = Path("{}.gzi".format(fpath))
+    if gzi_fpath.exists() and gzi_fpath.stat().st_mtime >= Path(fpath).stat().st_mtime:
+        return read_gzi_index(gzi_fpath)
+    offsets = []
+    compressed = 0
+    uncompressed = 0
+    with open(fpath, "rb") as fhand:
+        while True:
+            fhand.seek(compressed)
+            block_size = read_bgzf_header(fhand)
+            if block_size is None:
+                break
+            fhand.seek(compressed + block_size - 4)
+            offsets.append((compressed, uncompressed))
+            uncompressed += struct.unpack("<I", fhand.read(4))[0]
+            compressed += block_size
+    if not offsets:
+        raise ValueError("{} is not BGZF compressed, use bgzip instead of gzip".format(fpath))
+    gzi_tmp = Path("{}.tmp".format(gzi_fpath))
+    with open(gzi_tmp, "wb") as gzi_fhand:
+        #The first block always starts at 0, 0 and is not written
+        gzi_fhand.write(struct.pack("<Q", len(offsets) - 1))
+        for offset in offsets[1:]:
+            gzi_fhand.write(struct.pack("<QQ", *offset))
+    os.replace(gzi_tmp, gzi_fpath)
+    return offsets
+
+
+def read_gzi_index(gzi_fpath):
+    with open(gzi_fpath, "rb") as fhand:
+        num_blocks = struct.unpack("<Q", fhand.read(8))[0]
+        values = struct.unpack("<{}Q".format(num_blocks * 2), fhand.read(num_blocks * 16))
+    return [(0, 0)] + [(values[idx], values[idx + 1]) for idx in range(0, len(values), 2)]
+
+
+class BgzfReader:
+    '''Random access to the uncompressed bytes of a BGZF file, only the
+    blocks needed are decompressed'''
+    def __init__(self, fpath, offsets):
+        self.fhand = open(fpath, "rb")
+        self.offsets = offsets
+        self.starts = [offset[1] for offset in offsets]
+        self.blocks = OrderedDict()
+
+    def get_block(self, idx):
+        if idx in self.blocks:
+            self.blocks.move_to_end(idx)
+            return self.blocks[idx]
+        start = self.offsets[idx][0]
+        end = self.offsets[idx + 1][0] if idx + 1 < len(self.offsets) else None
+        self.fhand.seek(start)
+        data = self.fhand.read(end - start if end is not None else -1)
+        block = zlib.decompressobj(31).decompress(data)
+        self.blocks[idx] = block
+        if len(self.blocks) > BGZF_CACHE_BLOCKS:
+            self.blocks.popitem(last=False)
+        return block
+
+    def read(self, start, end):
+        #Uncompressed bytes from start to end, end not included
+        chunks = []
+        idx = bisect_right(self.starts, start) - 1
+        while start < end and idx < len(self.offsets):
+            block = self.get_block(idx)
+            block_start = self.starts[idx]
+            chunks.append(block[start - block_start:end - block_start])
+            start = block_start + len(block)
+            idx += 1
+        return b"".join(chunks)
+
+    def close(self):
+        self.fhand.close()
@@ -0,0 +1,73 @@
+import filecmp
+import hashlib
+import os
+
+from pathlib import Path
+
+from src.fasta import read_fasta
+
+
+def get_digest(seq):
+    #Same kind of digest used by interproscan to identify proteins
+    return hashlib.md5(seq.upper().encode()).hexdigest()
+
+
+def deduplicate_proteins(fastas, out_fpath, map_fpaths):
+    #fastas and map_fpaths are dicts by label. Only one copy of every protein
+    #is written in out_fpath, named by its digest, and every label gets a
+    #digest -> transcript table to recover its own transcripts afterwards
+    seen = set()
+    num_sequences = 0
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        for label, fasta in fastas.items():
+            map_tmp = Path("{}.tmp".format(map_fpaths[label]))
+            with open(map_tmp, "w") as map_fhand:
+                for name, seq in read_fasta(fasta):
+                    num_sequences += 1
+                    #Proteins without residues can not have any domain
+                    if not seq:
+                        continue
+                    digest = get_digest(seq)
+                    map_fhand.write("{}\t{}\n".format(digest, name.split()[0]))
+                    if digest not in seen:
+                        seen.add(digest)
+                        out_fhand.write(">{}\n{}\n".format(digest, seq))
+            os.replace(map_tmp, map_fpaths[label])
+    #Results from a previous run are only valid for the very same proteins
+    if out_fpath.exists() and not filecmp.cmp(tmp_fpath, out_fpath, shallow=False):
+        stale_fpath = Path("{}.tsv".format(out_fpath))
+        if stale_fpath.exists():
+            os.remove(stale_fpath)
+    os.replace(tmp_fpath, out_fpath)
+    return {"num_sequences": num_sequences, "num_unique": len(seen)}
+
+
+def expand_interpro_tsv(unique_tsv, map_fpath, out_fpath):
+    #Every hit of a unique protein is written once per transcript sharing it
+    transcripts = {}
+    with open(map_fpath) as map_fhand:
+        for line in map_fhand:
+            digest, transcript = line.rstrip("\n").split("\t")
+            transcripts.setdefault(digest, []).append(transcript)
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(unique_tsv) as in_fhand, open(tmp_fpath, "w") as out_fhand:
+        group = []
+        for line in in_fhand:
+            digest, rest = line.split("\t", 1)
+            if group and group[0][0] != digest:
+                write_group(group, transcripts, out_fhand)
+                group = []
+            group.append((digest, rest))
+        write_group(group, transcripts, out_fhand)
+    os.replace(tmp_fpath, out_fpath)
+    return out_fpath
+
+
+def write_group(group, transcripts, out_fhand):
+    #Hits of the same protein are kept together for every transcript
+    if not group:
+        return
+    for transcript in transcripts.get(group[0][0], []):
+        for _, rest in group:
+            out_fhand.write("{}\t{}".format(transcript, rest))
@@ -0,0 +1,141 @@
+import os
+
+from pathlib import Path
+
+from src.compression import open_file
+from src.fasta import read_fasta
+from src.run import run_atomic
+
+
+#Backends that find the Pfam domains of the proteins of a label. All of them
+#write an interproscan TSV, so evidences are merged the same way
+DOMAIN_BACKENDS = ["interproscan", "te_prefilter", "stub"]
+
+
+def write_te_hmms(pfam_hmms, te_pfams, out_fpath):
+    #Profiles of the TE Pfam domains taken from a Pfam-A.hmm file. Accessions
+    #are compared without their version (PF00078.30 -> PF00078). An existing
+    #and up to date file is reused. Returns the number of profiles written
+    out_fpath = Path(out_fpath)
+    if out_fpath.exists() and out_fpath.stat().st_mtime >= Path(pfam_hmms).stat().st_mtime:
+        with open(out_fpath) as fhand:
+            return sum(1 for line in fhand if line.startswith("ACC "))
+    num_profiles = 0
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open_file(pfam_hmms) as in_fhand, open(tmp_fpath, "w") as out_fhand:
+        record = []
+        keep = False
+        for line in in_fhand:
+            record.append(line)
+            if line.startswith("ACC "):
+                keep = line.split()[1].split(".")[0] in te_pfams
+            elif line.startswith("//"):
+                if keep:
+                    out_fhand.write("".join(record))
+                    num_profiles += 1
+                record = []
+                keep = False
+    os.replace(tmp_fpath, out_fpath)
+    return num_profiles
+
+
+def get_hmmsearch_cmd(sequences, hmms, out_fpath, threads):
+    #Pfam gathering thresholds, as used by interproscan. Written in a
+    #temporary file, see run_atomic
+    return "hmmsearch --cut_ga --noali --cpu {} -o /dev/null --domtblout {}.tmp {} {}".format(threads, out_fpath,
+                                                                                           hmms, sequences)
+
+
+def read_domtblout(fpath):
+    #IDs of the proteins with at least one hit
+    proteins = set()
+    with open(fpath) as fhand:
+        for line in fhand:
+            if line.startswith("#") or not line.strip():
+                continue
+            proteins.add(line.split()[0])
+    return proteins
+
+
+def read_TEsorter_ids(fpath):
+    ids = set()
+    with open_file(fpath) as fhand:
+        for line in fhand:
+            if line.startswith("#") or not line.strip():
+                continue
+            ids.add(line.split("\t", 1)[0])
+    return ids
+
+
+def write_selected(sequences, selected, out_fpath):
+    #Returns the number of proteins written and the number of proteins read
+    num_selected = 0
+    num_sequences = 0
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        for name, seq in read_fasta(sequences):
+            num_sequences += 1
+            if name.split()[0] in selected:
+                out_fhand.write(">{}\n{}\n".format(name, seq))
+                num_selected += 1
+    os.replace(tmp_fpath, out_fpath)
+    return num_selected, num_sequences
+
+
+def run_te_prefilter(label, values, threads, te_hmms, run_interpro, tesorter_fpath=None, **options):
+    #Proteins are searched only for TE Pfam domains with hmmsearch first.
+    #Only proteins with a TE domain or a TEsorter hit, whose status depends on
+    #the rest of their Pfam domains, are analyzed by run_interpro. The rest
+    #are left out of the summary instead of being counted as PcpM0
+    sequences = values["out_fpath"]
+    out_fpath = Path("{}.tsv".format(sequences))
+    hmm_out = sequences.parents[0] / "{}.te_domains.domtbl.txt".format(sequences.name)
+    cmd = get_hmmsearch_cmd(sequences, te_hmms, hmm_out, threads)
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists".format(str(out_fpath))}
+    run_ = run_atomic(cmd, [hmm_out])
+    if run_.returncode != 0:
+        return {"command": cmd, "returncode": 1, "out_fpath": out_fpath,
+                "msg": run_.stderr.decode()}
+    selected = read_domtblout(hmm_out)
+    num_te = len(selected)
+    if tesorter_fpath is not None:
+        selected |= read_TEsorter_ids(tesorter_fpath)
+    selected_fpath = sequences.parents[0] / "{}.prefiltered.fasta".format(sequences.stem)
+    num_selected, num_sequences = write_selected(sequences, selected, selected_fpath)
+    msg = "{} proteins with TE domains, {} of {} proteins analyzed".format(num_te, num_selected, num_sequences)
+    if num_selected == 0:
+        open(out_fpath, "w").close()
+        return {"command": cmd, "returncode": 0, "out_fpath": out_fpath, "msg": msg}
+    results = run_interpro(label, {"out_fpath": selected_fpath}, threads, **options)
+    if results["returncode"] not in (0, 99):
+        return {"command": "{} and {}".format(cmd, results["command"]), "returncode": 1,
+                "out_fpath": out_fpath, "msg": results["msg"]}
+    os.replace(results["out_fpath"], out_fpath)
+    return {"command": "{} and {}".format(cmd, results["command"]), "returncode": 0,
+            "out_fpath": out_fpath, "msg": "{}. {}".format(msg, results["msg"])}
+
+
+def run_stub_search(label, values, threads, hits=None, **options):
+    #No search: hits of the proteins of the label are copied from an
+    #interproscan TSV (e.g. of a previous run), or none at all. For tests
+    sequences = values["out_fpath"]
+    out_fpath = Path("{}.tsv".format(sequences))
+    cmd = "Stub domain search on {} with hits from {}".format(sequences, hits)
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists".format(str(out_fpath))}
+    proteins = {name.split()[0] for name, _ in read_fasta(sequences)}
+    num_hits = 0
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        if hits is not None:
+            with open_file(hits) as hits_fhand:
+                for line in hits_fhand:
+                    if line.split("\t", 1)[0] in proteins:
+                        out_fhand.write(line)
+                        num_hits += 1
+    os.replace(tmp_fpath, out_fpath)
+    return {"command": cmd, "returncode": 0, "out_fpath": out_fpath,
+            "msg": "Done, {} hits for {} proteins".format(num_hits, len(proteins))}
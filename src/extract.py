@@ -0,0 +1,244 @@
+import mmap
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from src.annotation import parse_attributes
+from src.compression import open_file, is_gzipped, is_bgzf, build_gzi_index, BgzfReader
+from src.fasta import read_fasta, bounded_map
+
+
+BASES = "TCAG"
+AMINOACIDS = "FFLLSSSSYY..CC.WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+CODON_TABLE = {a + b + c: AMINOACIDS[idx * 16 + jdx * 4 + kdx]
+               for idx, a in enumerate(BASES)
+               for jdx, b in enumerate(BASES)
+               for kdx, c in enumerate(BASES)}
+COMPLEMENT = str.maketrans("ACGTRYKMBVDHNacgtrykmbvdhn", "TGCAYRMKVBHDNtgcayrmkvbhdn")
+TRANSCRIPT_TYPES = ["mrna", "transcript"]
+
+
+def build_fasta_index(fpath):
+    #Same format as samtools faidx, an existing and up to date .fai is reused.
+    #Offsets of BGZF files are positions in the uncompressed file
+    fai_fpath = Path("{}.fai".format(fpath))
+    if fai_fpath.exists() and fai_fpath.stat().st_mtime >= Path(fpath).stat().st_mtime:
+        return read_fasta_index(fai_fpath)
+    index = {}
+    with open_file(fpath, "rb") as fhand:
+        name = None
+        offset = 0
+        for line in fhand:
+            if line.startswith(b">"):
+                name = line[1:].split()[0].decode()
+                index[name] = [0, offset + len(line), 0, 0]
+            elif name is not None:
+                entry = index[name]
+                if entry[2] == 0:
+                    entry[2] = len(line.rstrip(b"\r\n"))
+                    entry[3] = len(line)
+                entry[0] += len(line.rstrip(b"\r\n"))
+            offset += len(line)
+    fai_tmp = Path("{}.tmp".format(fai_fpath))
+    with open(fai_tmp, "w") as fai_fhand:
+        for name, values in index.items():
+            fai_fhand.write("{}\t{}\n".format(name, "\t".join(str(value) for value in values)))
+    os.replace(fai_tmp, fai_fpath)
+    return {name: tuple(values) for name, values in index.items()}
+
+
+def read_fasta_index(fai_fpath):
+    index = {}
+    with open(fai_fpath) as fhand:
+        for line in fhand:
+            name, length, offset, linebases, linewidth = line.rstrip().split("\t")[:5]
+            index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+    return index
+
+
+class IndexedFasta:
+    def __init__(self, fpath, index):
+        self.index = index
+        if is_bgzf(fpath):
+            self.fhand = BgzfReader(fpath, build_gzi_index(fpath))
+            self.read = self.fhand.read
+        else:
+            self.fhand = open(fpath, "rb")
+            self.mmap = mmap.mmap(self.fhand.fileno(), 0, access=mmap.ACCESS_READ)
+            self.read = lambda first, last: self.mmap[first:last]
+
+    def fetch(self, name, start, end):
+        #1-based, both ends included, as in GFF/GTF coordinates
+        length, offset, linebases, linewidth = self.index[name]
+        start = max(start - 1, 0)
+        end = min(end, length)
+        if start >= end:
+            return ""
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases + 1
+        return self.read(first, last).replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def close(self):
+        if hasattr(self, "mmap"):
+            self.mmap.close()
+        self.fhand.close()
+
+
+class LoadedSequence:
+    '''A single sequence already read, with the same fetch as IndexedFasta'''
+    def __init__(self, name, seq):
+        self.name = name
+        self.seq = seq
+
+    def fetch(self, name, start, end):
+        return self.seq[max(start - 1, 0):end]
+
+
+def parse_transcripts(annotation):
+    #Coordinates of the exons and CDSs of every transcript, in the order in
+    #which transcripts appear in the GFF/GTF
+    transcripts = {}
+    with open_file(annotation) as fhand:
+        for line in fhand:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9:
+                continue
+            seqid, kind, start, end, strand, phase = (fields[0], fields[2].lower(), int(fields[3]),
+                                                      int(fields[4]), fields[6], fields[7])
+            attributes = parse_attributes(fields[8])
+            if "transcript_id" in attributes and "=" not in fields[8]:
+                parents = [attributes["transcript_id"]]
+            elif kind in TRANSCRIPT_TYPES and "ID" in attributes:
+                parents = [attributes["ID"]]
+            else:
+                parents = attributes.get("Parent", "").split(",") if "Parent" in attributes else []
+            if kind not in ("exon", "cds") and kind not in TRANSCRIPT_TYPES:
+                continue
+            for parent in parents:
+                if parent not in transcripts:
+                    transcripts[parent] = {"seqid": seqid, "strand": strand,
+                                           "exon": [], "cds": []}
+                if kind == "exon":
+                    transcripts[parent]["exon"].append((start, end))
+                elif kind == "cds":
+                    transcripts[parent]["cds"].append((start, end, 0 if phase == "." else int(phase)))
+    return transcripts
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def translate(seq):
+    seq = seq.upper()
+    return "".join(CODON_TABLE.get(seq[idx:idx + 3], "X") for idx in range(0, len(seq) - 2, 3))
+
+
+def splice(genome, seqid, strand, segments):
+    seq = "".join(genome.fetch(seqid, segment[0], segment[1]) for segment in sorted(segments))
+    return reverse_complement(seq) if strand == "-" else seq
+
+
+def extract_records(genome, seqid, transcripts):
+    mrnas = []
+    proteins = []
+    for name, transcript in transcripts:
+        if not transcript["exon"] and not transcript["cds"]:
+            continue
+        exons = transcript["exon"] if transcript["exon"] else [cds[:2] for cds in transcript["cds"]]
+        mrnas.append(">{}\n{}\n".format(name, splice(genome, seqid, transcript["strand"], exons)))
+        if transcript["cds"]:
+            #Phase of the first CDS in the direction of transcription
+            cdss = sorted(transcript["cds"], reverse=transcript["strand"] == "-")
+            cds = splice(genome, seqid, transcript["strand"], [cds[:2] for cds in cdss])
+            proteins.append(">{}\n{}\n".format(name, translate(cds[cdss[0][2]:])))
+    return "".join(mrnas), "".join(proteins)
+
+
+GENOME = {}
+
+
+def open_genome(fpath, index):
+    #Initializer of the worker processes, every worker gets the index and
+    #maps the genome only once
+    GENOME[fpath] = IndexedFasta(fpath, index)
+
+
+def extract_seqid(job):
+    #Runs in a worker process
+    fpath, seqid, transcripts = job
+    return extract_records(GENOME[fpath], seqid, transcripts)
+
+
+def extract_loaded(job):
+    seqid, seq, transcripts = job
+    return seqid, extract_records(LoadedSequence(seqid, seq), seqid, transcripts)
+
+
+def iter_extracted_from_gzip(assembly, by_seqid, threads=1):
+    #Plain gzip can not be read at random, so the assembly is read once and
+    #only one sequence is kept in memory at a time (a few more with threads).
+    #Results are yielded in the order of the annotation, as the indexed ones
+    jobs = ((name.split()[0], seq, by_seqid[name.split()[0]]) for name, seq in read_fasta(assembly)
+            if name.split()[0] in by_seqid)
+    seqids = list(by_seqid)
+    done = {}
+    if threads > 1:
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            for seqid, result in bounded_map(executor, extract_loaded, jobs, threads):
+                done[seqid] = result
+                while seqids and seqids[0] in done:
+                    yield done.pop(seqids.pop(0))
+    else:
+        for seqid, result in map(extract_loaded, jobs):
+            done[seqid] = result
+            while seqids and seqids[0] in done:
+                yield done.pop(seqids.pop(0))
+    if seqids:
+        raise ValueError("Sequences not found in {}: {}".format(assembly, ",".join(sorted(seqids))))
+
+
+def iter_extracted(assembly, annotation, threads=1):
+    #(mRNAs, proteins) FASTA text of every sequence of the assembly, as soon
+    #as they are extracted. Transcripts of every sequence are run in parallel
+    transcripts = parse_transcripts(annotation)
+    by_seqid = {}
+    for name, transcript in transcripts.items():
+        by_seqid.setdefault(transcript["seqid"], []).append((name, transcript))
+    if is_gzipped(assembly) and not is_bgzf(assembly):
+        yield from iter_extracted_from_gzip(assembly, by_seqid, threads=threads)
+        return
+    index = build_fasta_index(assembly)
+    missing = set(by_seqid) - set(index)
+    if missing:
+        raise ValueError("Sequences not found in {}: {}".format(assembly, ",".join(sorted(missing))))
+    jobs = [(str(assembly), seqid, values) for seqid, values in by_seqid.items()]
+    if threads > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=threads, initializer=open_genome,
+                                 initargs=(str(assembly), index)) as executor:
+            yield from executor.map(extract_seqid, jobs)
+    else:
+        genome = IndexedFasta(assembly, index)
+        for job in jobs:
+            yield extract_records(genome, job[1], job[2])
+        genome.close()
+
+
+def extract_transcripts(assembly, annotation, mrna_out, pep_out, threads=1):
+    #mRNA and proteins are written in a single pass over the annotation.
+    #Returns the number of transcripts written
+    mrna_tmp = Path("{}.tmp".format(mrna_out))
+    pep_tmp = Path("{}.tmp".format(pep_out)) if pep_out is not None else None
+    num_transcripts = 0
+    with open_file(mrna_tmp, "w") as mrna_fhand, open_file(pep_tmp if pep_tmp else os.devnull, "w") as pep_fhand:
+        for mrnas, proteins in iter_extracted(assembly, annotation, threads=threads):
+            mrna_fhand.write(mrnas)
+            pep_fhand.write(proteins)
+            num_transcripts += mrnas.count(">")
+    os.replace(mrna_tmp, mrna_out)
+    if pep_tmp is not None:
+        os.replace(pep_tmp, pep_out)
+    return num_transcripts
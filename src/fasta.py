@@ -0,0 +1,178 @@
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from src.compression import open_file
+
+
+BUFFER_SIZE = 4 * 1024 * 1024
+STOP_SYMBOLS = (".", "*")
+
+
+def read_fasta(fpath, buffer_size=BUFFER_SIZE):
+    with open_file(fpath) as fhand:
+        yield from parse_fasta(fhand, buffer_size=buffer_size)
+
+
+def parse_fasta(fhand, buffer_size=BUFFER_SIZE):
+    #Yields (header, sequence), header without ">" and sequence unwrapped
+    for block in iter_blocks(fhand, buffer_size=buffer_size):
+        yield from parse_block(block)
+
+
+def iter_blocks(fhand, buffer_size=BUFFER_SIZE):
+    #Big blocks of text that always end at the end of a record, so they can
+    #be parsed on their own (e.g. by other processes)
+    pending = []
+    while True:
+        block = fhand.read(buffer_size)
+        if not block:
+            break
+        tail = pending[-1][-1:] if pending else ""
+        idx = block.rfind("\n>")
+        if idx == -1:
+            if tail == "\n" and block.startswith(">"):
+                idx = -1
+            else:
+                pending.append(block)
+                continue
+        pending.append(block[:idx + 1])
+        yield "".join(pending)
+        pending = [block[idx + 1:]]
+    if pending and "".join(pending).strip():
+        yield "".join(pending)
+
+
+def parse_block(block):
+    if not block.startswith(">"):
+        #Anything before the first header is ignored
+        idx = block.find("\n>")
+        if idx == -1:
+            return
+        block = block[idx + 1:]
+    for record in block[1:].split("\n>"):
+        yield parse_record(record)
+
+
+def parse_record(record):
+    header, _, seq = record.partition("\n")
+    if "\n" in seq:
+        seq = seq.replace("\n", "")
+    if "\r" in seq:
+        seq = seq.replace("\r", "")
+    return header.rstrip(), seq
+
+
+def exclude_block(block, excluded):
+    #Records of a block whose ID (first word of the header) is not in excluded
+    return "".join(">{}\n{}\n".format(header, seq) for header, seq in parse_block(block)
+                   if header.split(" ", 1)[0] not in excluded)
+
+
+def exclude_records(fpath, excluded, buffer_size=BUFFER_SIZE):
+    #fpath is replaced by a copy without the records in excluded. Returns the
+    #number of records removed
+    tmp_fpath = Path("{}.tmp".format(fpath))
+    num_removed = 0
+    with open_file(fpath) as in_fhand, open_file(tmp_fpath, "w") as out_fhand:
+        for block in iter_blocks(in_fhand, buffer_size=buffer_size):
+            records = []
+            for header, seq in parse_block(block):
+                if header.split(" ", 1)[0] in excluded:
+                    num_removed += 1
+                else:
+                    records.append((header, seq))
+            out_fhand.write(format_fasta(records))
+    os.replace(tmp_fpath, fpath)
+    return num_removed
+
+
+def format_fasta(records):
+    return "".join(">{}\n{}\n".format(header, seq) for header, seq in records)
+
+
+def write_fasta(records, fpath, chunk_records=20000):
+    #Written to a temporary file that replaces fpath once it is complete
+    tmp_fpath = Path("{}.tmp".format(fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_records:
+                out_fhand.write(format_fasta(chunk))
+                chunk = []
+        out_fhand.write(format_fasta(chunk))
+    os.replace(tmp_fpath, fpath)
+    return fpath
+
+
+def trim_at_stop(seq, symbols=STOP_SYMBOLS):
+    end = len(seq)
+    for symbol in symbols:
+        position = seq.find(symbol, 0, end)
+        if position != -1:
+            end = position
+    return seq[:end]
+
+
+def trim_block(block):
+    #Returns the trimmed FASTA text and the log text for a block of records.
+    #This is the hot loop, so parse_record and trim_at_stop are inlined
+    fasta = []
+    log = []
+    if not block.startswith(">"):
+        idx = block.find("\n>")
+        if idx == -1:
+            return "", ""
+        block = block[idx + 1:]
+    if "\r" in block:
+        block = block.replace("\r", "")
+    for record in block[1:].split("\n>"):
+        header, _, seq = record.partition("\n")
+        if "\n" in seq:
+            seq = seq.replace("\n", "")
+        header = header.rstrip()
+        trimmed = seq
+        if "." in seq or "*" in seq:
+            trimmed = trim_at_stop(seq)
+        if seq:
+            fasta.append(">%s\n%s\n" % (header, trimmed))
+        else:
+            fasta.append(">%s\n" % header)
+        log.append("%s\t%d\t%d\n" % (header, len(seq), len(trimmed)))
+    return "".join(fasta), "".join(log)
+
+
+def bounded_map(executor, function, iterable, window):
+    #Like executor.map, but only window items are read ahead of the results
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(function, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def trim_fasta(in_fpath, out_fpath, log_fpath, threads=1, buffer_size=BUFFER_SIZE):
+    #Blocks of records are trimmed in parallel and written in their original
+    #order. The log is streamed, so nothing is kept in memory
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    log_tmp = Path("{}.tmp".format(log_fpath))
+    with open_file(in_fpath, threads=threads) as in_fhand, open(tmp_fpath, "w") as out_fhand, \
+            open(log_tmp, "w") as log_fhand:
+        blocks = iter_blocks(in_fhand, buffer_size=buffer_size)
+        if threads > 1:
+            with ProcessPoolExecutor(max_workers=threads) as executor:
+                for fasta, log in bounded_map(executor, trim_block, blocks, threads * 2):
+                    out_fhand.write(fasta)
+                    log_fhand.write(log)
+        else:
+            for fasta, log in map(trim_block, blocks):
+                out_fhand.write(fasta)
+                log_fhand.write(log)
+    os.replace(log_tmp, log_fpath)
+    os.replace(tmp_fpath, out_fpath)
+    return out_fpath
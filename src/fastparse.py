@@ -0,0 +1,110 @@
+import mmap
+import os
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from src.compression import open_file, is_gzipped
+from src.parsers import get_pfams_from_interpro_query, parse_TEsort_output
+
+
+MIN_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def get_line_ranges(fpath, num_chunks, start=0):
+    #Byte ranges of similar size that start and end at line boundaries
+    size = os.path.getsize(fpath)
+    if size <= start:
+        return []
+    num_chunks = max(1, min(num_chunks, (size - start) // MIN_CHUNK_SIZE + 1))
+    step = (size - start) // num_chunks
+    ranges = []
+    with open(fpath, "rb") as fhand:
+        mapped = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+        begin = start
+        for idx in range(1, num_chunks):
+            end = mapped.find(b"\n", start + idx * step)
+            if end == -1 or end + 1 <= begin:
+                continue
+            ranges.append((begin, end + 1))
+            begin = end + 1
+        if begin < size:
+            ranges.append((begin, size))
+        mapped.close()
+    return ranges
+
+
+def map_ranges(function, fpath, ranges, threads):
+    if threads > 1 and len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=min(threads, len(ranges))) as executor:
+            return list(executor.map(function, [fpath] * len(ranges), ranges))
+    return [function(fpath, byte_range) for byte_range in ranges]
+
+
+def scan_pfam_hits(fpath, byte_range):
+    #Only lines with a Pfam field are split, the rest of the chunk is skipped
+    #by searching the mapped bytes
+    start, end = byte_range
+    hits = []
+    with open(fpath, "rb") as fhand:
+        mapped = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+        position = mapped.find(b"\tPfam\t", start, end)
+        while position != -1:
+            line_start = mapped.rfind(b"\n", start, position) + 1
+            if line_start == 0:
+                line_start = start
+            line_end = mapped.find(b"\n", position, end)
+            if line_end == -1:
+                line_end = end
+            line = mapped[line_start:line_end].decode().split("\t")
+            if len(line) > 7 and line[3] == "Pfam":
+                hits.append((line[0], [line[4], line[5], line[6], line[7]]))
+            position = mapped.find(b"\tPfam\t", line_end, end)
+        mapped.close()
+    return hits
+
+
+def get_pfams_from_interpro_file(fpath, threads=1):
+    #Same output as parsers.get_pfams_from_interpro_query. Compressed files
+    #can not be memory-mapped, so they are read by it
+    if is_gzipped(fpath):
+        with open_file(fpath, threads=threads) as fhand:
+            return get_pfams_from_interpro_query(fhand)
+    genes = defaultdict(list)
+    for hits in map_ranges(scan_pfam_hits, fpath, get_line_ranges(fpath, threads), threads):
+        for gen, hit in hits:
+            genes[gen].append(hit)
+    return {key: sorted(value, key=lambda x: int(x[2])) for key, value in genes.items()}
+
+
+def scan_TEsort_rows(fpath, byte_range):
+    start, end = byte_range
+    with open(fpath, "rb") as fhand:
+        fhand.seek(start)
+        text = fhand.read(end - start).decode()
+    return [line.split("\t") for line in text.split("\n") if line.rstrip("\r")]
+
+
+def parse_TEsort_file(fpath, threads=1):
+    #Same output as parsers.parse_TEsort_output
+    if is_gzipped(fpath):
+        with open_file(fpath, threads=threads) as fhand:
+            return parse_TEsort_output(fhand)
+    output = defaultdict(list)
+    with open(fpath, "rb") as fhand:
+        header_line = fhand.readline()
+    if not header_line:
+        return output
+    header = {name: idx for idx, name in enumerate(header_line.decode().rstrip("\r\n").split("\t"))}
+    ranges = get_line_ranges(fpath, threads, start=len(header_line))
+    for rows in map_ranges(scan_TEsort_rows, fpath, ranges, threads):
+        for row in rows:
+            row = [field.rstrip("\r") for field in row]
+            row += [None] * (len(header) - len(row))
+            output[row[header["#TE"]]] = {"domains": row[header["Domains"]],
+                                          "complete": row[header["Complete"]],
+                                          "classification": "{}|{}|{}".format(row[header["Order"]],
+                                                                              row[header["Superfamily"]],
+                                                                              row[header["Clade"]]),
+                                          "strand": row[header["Strand"]]}
+    return output
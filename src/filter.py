@@ -0,0 +1,202 @@
+import os
+import sys
+
+from csv import DictReader
+from pathlib import Path
+
+from src.annotation import parse_attributes, TRANSCRIPT_TYPES
+from src.compression import open_file, get_output_name, GZIP_SUFFIXES
+
+
+#Transcripts with TE evidence in their protein or only in their mRNA
+TE_STATUSES = ("PteM0", "PteMte", "P0Mte")
+#Lines of a gene are kept together to know whether every transcript of the
+#gene was removed, more than this are written without waiting for the rest
+MAX_BLOCK_LINES = 100000
+
+
+def read_flagged(summary, statuses):
+    #DeTEnGA status of the transcripts whose status is in statuses, the only
+    #thing kept in memory while the annotation is filtered
+    flagged = {}
+    with open_file(summary) as summary_fhand:
+        for row in DictReader(summary_fhand, delimiter=";"):
+            if row["DeTEnGA_status"] in statuses:
+                flagged[sys.intern(row["Transcript_ID"])] = sys.intern(row["DeTEnGA_status"])
+    return flagged
+
+
+def get_relations(fields):
+    #(ID, parents, gene) of a GFF3/GTF line. In GTF files transcripts are
+    #children of their gene and any other feature a child of its transcript.
+    #gene is the ID of the top level feature of the line, None if unknown
+    attributes = parse_attributes(fields[8])
+    if "=" in fields[8]:
+        parents = attributes["Parent"].split(",") if "Parent" in attributes else []
+        return attributes.get("ID"), parents, attributes.get("ID") if not parents else None
+    gene_id = attributes.get("gene_id")
+    transcript_id = attributes.get("transcript_id")
+    if transcript_id is None:
+        return gene_id, [], gene_id
+    if fields[2].lower() in TRANSCRIPT_TYPES:
+        return transcript_id, [gene_id] if gene_id else [], gene_id
+    return None, [transcript_id], gene_id
+
+
+def add_status(fields, status):
+    attributes = fields[8].rstrip()
+    if "=" in attributes:
+        attributes = "{};detenga_status={}".format(attributes.rstrip(";"), status)
+    else:
+        attributes = '{}{} detenga_status "{}";'.format(attributes, "" if attributes.endswith(";") else ";", status)
+    return "{}\t{}\n".format("\t".join(fields[:8]), attributes)
+
+
+def set_parents(fields, parents):
+    #Only used for GFF3 features shared by several transcripts
+    attributes = []
+    for item in fields[8].rstrip("\n").split(";"):
+        if item.strip().startswith("Parent="):
+            item = "Parent={}".format(",".join(parents))
+        attributes.append(item)
+    return "{}\t{}\n".format("\t".join(fields[:8]), ";".join(attributes))
+
+
+def filter_block(block, flagged, removed):
+    #Lines of one gene: (clean lines, TE lines). Flagged transcripts, every
+    #feature whose parents were all removed and genes left without any
+    #transcript are removed. removed is updated with the removed IDs, so
+    #children written apart from their parents are removed too. The TE
+    #annotation has the flagged transcripts, their children and their genes,
+    #and the directives of the annotation
+    records = []
+    children = {}
+    removed_children = {}
+    te_genes = set()
+    for line, fields in block:
+        if fields is None:
+            records.append((line, None, None, [], False))
+            continue
+        feature_id, parents, _ = get_relations(fields)
+        #GTF files may have no transcript lines, only their exons and CDSs
+        is_removed = feature_id in flagged or bool(parents) and all(parent in removed or parent in flagged
+                                                                    for parent in parents)
+        if is_removed:
+            removed.update(parent for parent in parents if parent in flagged)
+            if feature_id is not None:
+                removed.add(feature_id)
+        for parent in parents:
+            children[parent] = children.get(parent, 0) + 1
+            if is_removed:
+                removed_children[parent] = removed_children.get(parent, 0) + 1
+            if feature_id in flagged:
+                te_genes.add(parent)
+        records.append((line, fields, feature_id, parents, is_removed))
+    clean_lines = []
+    te_lines = []
+    for line, fields, feature_id, parents, is_removed in records:
+        if fields is None:
+            clean_lines.append(line)
+            if line.startswith("##") and not line.startswith("###"):
+                te_lines.append(line)
+            continue
+        if not parents and feature_id in children and removed_children.get(feature_id) == children[feature_id]:
+            #Every transcript of the gene was removed
+            removed.add(feature_id)
+            is_removed = True
+        is_gff3 = "=" in fields[8]
+        removed_parents = [parent for parent in parents if parent in removed or parent in flagged]
+        status = flagged.get(feature_id)
+        if status is None and not is_gff3 and removed_parents:
+            #Every GTF line has the attributes of its transcript
+            status = flagged.get(removed_parents[0])
+        if status is not None:
+            te_lines.append(add_status(fields, status))
+        elif feature_id in te_genes or is_removed:
+            te_lines.append(line)
+        elif removed_parents and is_gff3:
+            #Shared by flagged and kept transcripts
+            te_lines.append(set_parents(fields, removed_parents))
+        if is_removed:
+            continue
+        if removed_parents and is_gff3:
+            line = set_parents(fields, [parent for parent in parents if parent not in removed_parents])
+        clean_lines.append(line)
+    return clean_lines, te_lines
+
+
+def iter_blocks(fhand):
+    #Lines of the annotation grouped by gene, in the same order. Comments
+    #and directives are written in their place, ### closes the current gene
+    block = []
+    gene = None
+    for line in fhand:
+        if line.startswith("#") or not line.strip():
+            if line.startswith("###"):
+                yield block + [(line, None)]
+                block = []
+                gene = None
+            else:
+                block.append((line, None))
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < 9:
+            block.append((line, None))
+            continue
+        _, _, line_gene = get_relations(fields)
+        if (line_gene is not None and line_gene != gene) or len(block) >= MAX_BLOCK_LINES:
+            if block:
+                yield block
+            block = []
+            gene = line_gene if line_gene is not None else gene
+        block.append((line, fields))
+    if block:
+        yield block
+
+
+def filter_annotation(annotation, flagged, clean_out, te_out=None):
+    #Single pass over the annotation. Returns the number of transcripts
+    #removed and the number of lines written in the clean annotation
+    removed = set()
+    num_lines = 0
+    clean_tmp = Path("{}.tmp".format(clean_out))
+    te_tmp = Path("{}.tmp".format(te_out)) if te_out is not None else None
+    with open_file(annotation) as in_fhand, open_file(clean_tmp, "w") as clean_fhand, \
+         open_file(te_tmp if te_tmp else os.devnull, "w") as te_fhand:
+        for block in iter_blocks(in_fhand):
+            clean_lines, te_lines = filter_block(block, flagged, removed)
+            clean_fhand.write("".join(clean_lines))
+            te_fhand.write("".join(te_lines))
+            num_lines += len(clean_lines)
+    os.replace(clean_tmp, clean_out)
+    if te_tmp is not None:
+        os.replace(te_tmp, te_out)
+    return sum(1 for transcript in flagged if transcript in removed), num_lines
+
+
+def get_annotation_suffix(annotation):
+    name = Path(annotation)
+    if name.suffix in GZIP_SUFFIXES:
+        name = name.with_suffix("")
+    return name.suffix if name.suffix else ".gff"
+
+
+def run_filter_label(label, values, summary, out_dir, statuses=TE_STATUSES, te_annotation=False,
+                     compressed=False):
+    annotation = values["annotation"]
+    suffix = get_annotation_suffix(annotation)
+    clean_out = get_output_name(out_dir / label / "{}.filtered{}".format(label, suffix), compressed=compressed)
+    te_out = get_output_name(out_dir / label / "{}.TE{}".format(label, suffix), compressed=compressed)
+    out_fpath = {"clean": clean_out}
+    if te_annotation:
+        out_fpath["te"] = te_out
+    cmd = "Remove {} transcripts from {}".format(",".join(statuses), annotation)
+    if all(fpath.exists() for fpath in out_fpath.values()):
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists".format(clean_out)}
+    flagged = read_flagged(summary, statuses)
+    num_removed, num_lines = filter_annotation(annotation, flagged, clean_out,
+                                               te_out=te_out if te_annotation else None)
+    msg = "Done, {} of {} flagged transcripts removed, {} lines written in {}".format(num_removed, len(flagged),
+                                                                                    num_lines, clean_out)
+    return {"command": cmd, "returncode": 0, "out_fpath": out_fpath, "msg": msg}
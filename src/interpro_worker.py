@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#Default worker of --interpro_pool (see src/workers.py for the protocol).
+#interproscan.sh has no persistent mode, so every batch is still a run of
+#its own that pays the JVM startup: this worker gives no amortization over
+#--interpro_chunk_size runs. A worker of an InterProScan service that stays
+#loaded is the backend that avoids it, given with --interpro_worker
+import sys
+
+from pathlib import Path
+from subprocess import run, STDOUT, DEVNULL
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+
+from src.run import INTERPRO_EXCLUDE
+from src.workers import serve
+
+
+def run_batch(request):
+    out_fpath = Path(request["out"])
+    log_fpath = out_fpath.parents[0] / "interpro.log.txt"
+    cmd = ["interproscan.sh", "-i", request["sequences"], "-o", str(out_fpath), "-f", "TSV",
+           "-cpu", str(request.get("threads", 1)), "-exclappl", ",".join(INTERPRO_EXCLUDE), "--disable-precalc"]
+    with open(log_fpath, "a") as log_fhand:
+        #stdin is the request pipe of the pool, interproscan does not need it
+        process = run(cmd, stdin=DEVNULL, stdout=log_fhand, stderr=STDOUT, cwd=out_fpath.parents[0])
+    msg = "Done, check {} for details".format(log_fpath) if process.returncode == 0 else \
+        "interproscan.sh failed, check {} for details".format(log_fpath)
+    return process.returncode, msg
+
+
+if __name__ == "__main__":
+    serve(run_batch)
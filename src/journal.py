@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import time
+
+from pathlib import Path
+from threading import Lock
+
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def get_fingerprint(fpath):
+    stat = os.stat(fpath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_checksum(fpath):
+    md5 = hashlib.md5()
+    with open(fpath, "rb") as fhand:
+        for block in iter(lambda: fhand.read(BUFFER_SIZE), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class StageJournal:
+    '''Append-only record of every finished (label, stage) with the
+    fingerprints of its inputs and the checksums of its outputs. Each record
+    is a JSON line written and synced at once, so a run killed at any point
+    leaves, at most, an incomplete last line that is ignored'''
+    def __init__(self, fpath):
+        self.fpath = Path(fpath)
+        self.lock = Lock()
+        self.records = {}
+        self.checksums = {}
+        self.reruns = []
+        if self.fpath.exists():
+            self.load()
+        self.fhand = open(self.fpath, "a")
+
+    def load(self):
+        with open(self.fpath) as fhand:
+            for line in fhand:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                key = (record["label"], record["stage"])
+                if record.get("status") == "done":
+                    self.records[key] = record
+                else:
+                    self.records.pop(key, None)
+
+    def checksum(self, fpath):
+        #Files are only read again if their size or mtime changed
+        fingerprint = get_fingerprint(fpath)
+        key = (str(fpath), fingerprint[0], fingerprint[1])
+        if key not in self.checksums:
+            self.checksums[key] = get_checksum(fpath)
+        return self.checksums[key]
+
+    def describe(self, fpaths):
+        return {str(Path(fpath).absolute()): get_fingerprint(fpath) + [self.checksum(fpath)]
+                for fpath in fpaths}
+
+    def changed(self, fpath, description):
+        if not os.path.exists(fpath):
+            return "{} is missing".format(fpath)
+        if get_fingerprint(fpath) == description[:2]:
+            return None
+        if self.checksum(fpath) != description[2]:
+            return "{} has changed".format(fpath)
+        return None
+
+    def get_stale_reason(self, label, stage, inputs):
+        #None when the stage is up to date or it was not recorded: outputs
+        #are written atomically, so existing ones are complete
+        record = self.records.get((label, stage))
+        if record is None:
+            return None
+        inputs = {str(Path(fpath).absolute()) for fpath in inputs}
+        if inputs != set(record["inputs"]):
+            return "inputs are not the same"
+        for group in ("inputs", "outputs"):
+            for fpath, description in record[group].items():
+                reason = self.changed(fpath, description)
+                if reason is not None:
+                    return reason
+        return None
+
+    def get_outputs(self, label, stage):
+        record = self.records.get((label, stage))
+        return list(record["outputs"]) if record is not None else []
+
+    def write(self, record):
+        record["time"] = round(time.time(), 3)
+        with self.lock:
+            self.fhand.write(json.dumps(record) + "\n")
+            self.fhand.flush()
+            os.fsync(self.fhand.fileno())
+            key = (record["label"], record["stage"])
+            if record["status"] == "done":
+                self.records[key] = record
+            else:
+                self.records.pop(key, None)
+
+    def invalidate(self, label, stage, reason):
+        #Outputs of a stale stage are removed, so they are written again
+        for fpath in self.get_outputs(label, stage):
+            if os.path.exists(fpath):
+                os.remove(fpath)
+        self.write({"label": label, "stage": stage, "status": "invalid", "reason": reason})
+        with self.lock:
+            self.reruns.append((label, stage, reason))
+
+    def record(self, label, stage, inputs, outputs):
+        self.write({"label": label, "stage": stage, "status": "done",
+                    "inputs": self.describe(inputs), "outputs": self.describe(outputs)})
+
+    def close(self):
+        self.fhand.close()
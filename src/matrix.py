@@ -0,0 +1,144 @@
+import os
+
+from pathlib import Path
+
+from src.store import STATUSES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+#DeTEnGA status of every combination of evidences, indexed by
+#TE Pfam * 4 + non-TE Pfam * 2 + TEsorter domains, as in parsers.detenga_status
+STATUS_TABLE = ("NA", "P0Mte", "PcpM0", "PcpMte", "PteM0", "PteMte", "PchM0", "PchMte")
+INTERPRO_FLAGS = {"NA": 0, "coding_sequence": 2, "transposable_element": 4, "mixed": 6}
+BATCH_ROWS = 100000
+COUNTS_HEADER = "Pfam\tStatus\tTranscripts\n"
+
+
+class PfamCounter:
+    '''Transcripts of a label per DeTEnGA status and per (Pfam, status).
+    Summary rows are encoded as integer codes and classified and counted in
+    batches, with numpy when it is installed'''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        #Counts are removed, e.g. when a merge fails after some rows were counted
+        self.pfams = {}
+        self.status_counts = [0] * len(STATUS_TABLE)
+        self.pfam_counts = {}
+        self.flags = []
+        self.pair_rows = []
+        self.pair_pfams = []
+
+    def add_rows(self, rows):
+        #rows are summary tuples as yielded by parsers.iter_summary_rows
+        pfams = self.pfams
+        for row in rows:
+            if row[3] != "NA":
+                #A Pfam found twice in a protein counts once
+                for pfam in set(row[3].split("|")):
+                    if pfam not in pfams:
+                        pfams[pfam] = len(pfams)
+                    self.pair_rows.append(len(self.flags))
+                    self.pair_pfams.append(pfams[pfam])
+            self.flags.append(INTERPRO_FLAGS[row[1]] + (row[5] != "NA"))
+            if len(self.flags) >= BATCH_ROWS:
+                self.flush()
+        self.flush()
+
+    def tee_rows(self, rows, batch_rows=BATCH_ROWS):
+        #Yields rows while they are counted, so the summary file is written
+        #in the same pass
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                self.add_rows(batch)
+                batch = []
+            yield row
+        self.add_rows(batch)
+
+    def flush(self):
+        if not self.flags:
+            return
+        num_statuses = len(STATUS_TABLE)
+        if np is not None:
+            statuses = np.asarray(self.flags, dtype=np.int64)
+            status_counts = np.bincount(statuses, minlength=num_statuses)
+            keys = np.asarray(self.pair_pfams, dtype=np.int64) * num_statuses
+            keys += statuses[np.asarray(self.pair_rows, dtype=np.int64)]
+            keys, counts = np.unique(keys, return_counts=True)
+            pairs = zip(keys.tolist(), counts.tolist())
+            status_counts = status_counts.tolist()
+        else:
+            status_counts = [0] * num_statuses
+            for flag in self.flags:
+                status_counts[flag] += 1
+            pairs = {}
+            for row, pfam in zip(self.pair_rows, self.pair_pfams):
+                key = pfam * num_statuses + self.flags[row]
+                pairs[key] = pairs.get(key, 0) + 1
+            pairs = pairs.items()
+        for idx, count in enumerate(status_counts):
+            self.status_counts[idx] += count
+        for key, count in pairs:
+            self.pfam_counts[key] = self.pfam_counts.get(key, 0) + count
+        self.flags = []
+        self.pair_rows = []
+        self.pair_pfams = []
+
+    def get_stats(self, num_transcripts):
+        #Same dict as parsers.get_stats
+        stats = {STATUS_TABLE[idx]: count for idx, count in enumerate(self.status_counts)
+                 if STATUS_TABLE[idx] in STATUSES}
+        stats["num_transcripts"] = num_transcripts
+        return stats
+
+    def iter_counts(self):
+        #(Pfam, status, transcripts) sorted by Pfam and status
+        names = sorted(self.pfams, key=self.pfams.get)
+        num_statuses = len(STATUS_TABLE)
+        counts = [(names[key // num_statuses], STATUS_TABLE[key % num_statuses], count)
+                  for key, count in self.pfam_counts.items()]
+        return sorted(counts)
+
+    def write(self, out_fpath):
+        tmp_fpath = Path("{}.tmp".format(out_fpath))
+        with open(tmp_fpath, "w") as out_fhand:
+            out_fhand.write("#Status_counts\t{}\n".format("\t".join("{}={}".format(status, count)
+                                                                      for status, count in self.get_stats(0).items()
+                                                                      if status in STATUSES)))
+            out_fhand.write(COUNTS_HEADER)
+            out_fhand.write("".join("{}\t{}\t{}\n".format(*row) for row in self.iter_counts()))
+        os.replace(tmp_fpath, out_fpath)
+        return out_fpath
+
+
+def read_status_counts(fpath):
+    #Only the first line of a counts file, so stats are not counted again
+    with open(fpath) as fhand:
+        fields = fhand.readline().rstrip("\n").split("\t")[1:]
+    return {field.split("=")[0]: int(field.split("=")[1]) for field in fields}
+
+
+def write_pfam_matrix(counts_fpaths, out_fpath):
+    #Sparse run x Pfam x status matrix as one row per non-zero cell, written
+    #from the counts file of every label one at a time, so memory does not
+    #grow with the number of labels
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    num_cells = 0
+    with open(tmp_fpath, "w") as out_fhand:
+        out_fhand.write("Run\t{}".format(COUNTS_HEADER))
+        for label, counts_fpath in counts_fpaths.items():
+            with open(counts_fpath) as counts_fhand:
+                counts_fhand.readline()
+                counts_fhand.readline()
+                lines = ["{}\t{}".format(label, line) for line in counts_fhand]
+            out_fhand.write("".join(lines))
+            num_cells += len(lines)
+    os.replace(tmp_fpath, out_fpath)
+    return num_cells
@@ -0,0 +1,211 @@
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from subprocess import Popen, CompletedProcess
+from urllib.request import Request, urlopen
+
+from src.compression import open_file, GZIP_SUFFIXES
+
+
+#Label and stage of the task run by each thread, so commands can be
+#accounted to their task without passing them through every function
+CONTEXT = threading.local()
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def get_context():
+    return getattr(CONTEXT, "values", None)
+
+
+def bind(function):
+    #The task of the calling thread is kept when function is run in
+    #another thread (e.g. shards run in a thread pool)
+    values = get_context()
+
+    def bound(*args, **kwargs):
+        previous = get_context()
+        CONTEXT.values = values
+        try:
+            return function(*args, **kwargs)
+        finally:
+            CONTEXT.values = previous
+    return bound
+
+
+def run_command(cmd, cwd=None):
+    #Same as subprocess.run(cmd, shell=True, capture_output=True), but the
+    #child is waited with wait4 to get its CPU time and peak memory. Outputs
+    #go to temporary files so big outputs can not block the child
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stdout_fhand, tempfile.TemporaryFile() as stderr_fhand:
+        process = Popen(cmd, shell=True, cwd=cwd, stdout=stdout_fhand, stderr=stderr_fhand)
+        wait_command(cmd, process, start)
+        stdout_fhand.seek(0)
+        stderr_fhand.seek(0)
+        stdout = stdout_fhand.read()
+        stderr = stderr_fhand.read()
+    return CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def wait_command(cmd, process, start):
+    #Waits for a process started with Popen and records its resources
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    values = get_context()
+    if values is not None:
+        values["collector"].record({"event": "command", "label": values["label"], "stage": values["stage"],
+                                    "command": cmd, "returncode": process.returncode,
+                                    "wall_seconds": round(time.perf_counter() - start, 3),
+                                    "user_seconds": round(rusage.ru_utime, 3),
+                                    "sys_seconds": round(rusage.ru_stime, 3),
+                                    "max_rss_mb": round(rusage.ru_maxrss / 1024, 2)})
+    return process.returncode
+
+
+def get_input_sizes(fpath, count_residues=False):
+    #Bytes of the file, compressed bytes for compressed files. Counting the
+    #sequences and residues of a FASTA file reads it whole, so it is only
+    #done when count_residues is set
+    sizes = {"input": str(fpath), "input_bytes": os.stat(fpath).st_size}
+    if not count_residues:
+        return sizes
+    name = str(fpath)
+    for suffix in GZIP_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if not name.endswith((".fasta", ".fa", ".faa", ".fna")):
+        return sizes
+    sequences = 0
+    residues = 0
+    in_header = False
+    with open_file(fpath, "rb") as fhand:
+        while True:
+            block = fhand.read(BUFFER_SIZE)
+            if not block:
+                break
+            position = 0
+            for line in block.split(b"\n"):
+                #Headers may be split between blocks
+                if position == 0 and in_header:
+                    in_header = position + len(line) == len(block)
+                elif line.startswith(b">"):
+                    sequences += 1
+                    in_header = position + len(line) == len(block)
+                else:
+                    residues += len(line.rstrip(b"\r"))
+                position += len(line) + 1
+    sizes["sequences"] = sequences
+    sizes["residues"] = residues
+    return sizes
+
+
+class MetricsCollector:
+    '''Wall time, CPU and peak memory of every task and every command run by
+    it, written as JSON lines and optionally posted to a collector URL.
+    Sequences and residues of the task inputs are only counted with
+    count_residues'''
+    def __init__(self, fpath, url=None, count_residues=False):
+        self.fpath = fpath
+        self.url = url
+        self.count_residues = count_residues
+        self.url_error = None
+        self.lock = threading.Lock()
+        self.fhand = open(fpath, "a")
+        self.tasks = {}
+
+    def record(self, event):
+        event["time"] = round(time.time(), 3)
+        with self.lock:
+            if event["event"] == "command":
+                task = self.tasks.setdefault((event["label"], event["stage"]), {})
+                task["commands"] = task.get("commands", 0) + 1
+                task["user_seconds"] = task.get("user_seconds", 0) + event["user_seconds"]
+                task["sys_seconds"] = task.get("sys_seconds", 0) + event["sys_seconds"]
+                task["max_rss_mb"] = max(task.get("max_rss_mb", 0), event["max_rss_mb"])
+            self.fhand.write(json.dumps(event) + "\n")
+            self.fhand.flush()
+        self.push(event)
+
+    def push(self, event):
+        #Metrics are not worth failing a run: the collector is not used
+        #again after the first error
+        if self.url is None or self.url_error is not None:
+            return
+        request = Request(self.url, data=json.dumps(event).encode(),
+                          headers={"Content-Type": "application/json"})
+        try:
+            urlopen(request, timeout=2).close()
+        except Exception as error:
+            self.url_error = "{}: {}".format(type(error).__name__, error)
+
+    def wrap(self, function, label, stage, get_input=None):
+        #get_input() returns the file processed by the task once it starts
+        def wrapped():
+            previous = get_context()
+            CONTEXT.values = {"collector": self, "label": label, "stage": stage}
+            sizes = {}
+            if get_input is not None:
+                try:
+                    fpath = get_input()
+                    if fpath is not None and os.path.exists(fpath):
+                        sizes = get_input_sizes(fpath, count_residues=self.count_residues)
+                except (KeyError, TypeError):
+                    sizes = {}
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                result = function()
+            finally:
+                CONTEXT.values = previous
+            wall_seconds = time.perf_counter() - start
+            event = {"event": "task", "label": label, "stage": stage,
+                     "wall_seconds": round(wall_seconds, 3),
+                     "python_cpu_seconds": round(time.thread_time() - cpu_start, 3),
+                     "process_max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+                     "returncode": result.get("returncode") if isinstance(result, dict) else None}
+            with self.lock:
+                task = self.tasks.setdefault((label, stage), {})
+                task.update(sizes)
+                task["wall_seconds"] = wall_seconds
+                task["python_cpu_seconds"] = event["python_cpu_seconds"]
+                task["returncode"] = event["returncode"]
+                event.update({key: task[key] for key in ("commands", "user_seconds", "sys_seconds", "max_rss_mb")
+                              if key in task})
+            event.update(sizes)
+            self.record(event)
+            return result
+        return wrapped
+
+    def write_throughput(self, out_fpath):
+        #One row per label and stage, sorted as they were run
+        header = ["Label", "Stage", "Wall_s", "Python_CPU_s", "Children_user_s", "Children_sys_s",
+                  "Children_max_RSS_MB", "Sequences", "Residues", "Sequences_per_s", "Residues_per_s"]
+        lines = ["\t".join(header) + "\n"]
+        with self.lock:
+            tasks = list(self.tasks.items())
+        for (label, stage), task in tasks:
+            if "wall_seconds" not in task:
+                continue
+            wall_seconds = task["wall_seconds"]
+            row = [str(label) if label is not None else "all", stage, "{:.3f}".format(wall_seconds),
+                   "{:.3f}".format(task["python_cpu_seconds"]),
+                   "{:.3f}".format(task.get("user_seconds", 0)), "{:.3f}".format(task.get("sys_seconds", 0)),
+                   "{:.2f}".format(task.get("max_rss_mb", 0))]
+            for key in ("sequences", "residues"):
+                row.append(str(task[key]) if key in task else "NA")
+            for key in ("sequences", "residues"):
+                if key in task and wall_seconds > 0:
+                    row.append("{:.1f}".format(task[key] / wall_seconds))
+                else:
+                    row.append("NA")
+            lines.append("\t".join(row) + "\n")
+        with open(out_fpath, "w") as out_fhand:
+            out_fhand.write("".join(lines))
+        return "".join(lines)
+
+    def close(self):
+        self.fhand.close()
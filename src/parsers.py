@@ -1,10 +1,13 @@
 import os
 import re
+import sys
 
 from collections import defaultdict
 from csv import DictReader
 from pathlib import Path
 
+from src.compression import open_file
+
 
 
 def parse_fof(input):
@@ -131,11 +134,16 @@ def detenga_status(row):
     return status
 
 
+SUMMARY_HEADER = ("Transcript_ID;Interpro_status;TEsort_class;PFAM_domains;"
+                  "PFAM_descriptions;TEsort_domains;TEsort_completness;"
+                  "TEsort_strand;DeTEnGA_status\n")
+#With representative transcripts, rows of the rest of the transcripts of a
+#gene are copied from their representative, whose ID is in Inferred_from
+SUMMARY_HEADER_INFERRED = SUMMARY_HEADER.replace("\n", ";Inferred_from\n")
+
+
 def write_summary(summary, out_fhand):
-    out_fhand.write("Transcript_ID;Interpro_status;TEsort_class;PFAM_domains;")
-    out_fhand.write("PFAM_descriptions;TEsort_domains;TEsort_completness;")
-    out_fhand.write("TEsort_strand;DeTEnGA_status\n")
-    out_fhand.flush()
+    out_fhand.write(SUMMARY_HEADER)
     for row in summary:
         line_total = "" 
         line_total += "{};{};{};{};".format(row["transcript"], row["interpro_status"],
@@ -144,10 +152,114 @@ def write_summary(summary, out_fhand):
                                                 row["tesort_complete"], row["tesort_strand"],
                                                 row["detenga_status"])
         out_fhand.write(line_total)
-        out_fhand.flush()
 
 
-def get_stats(agat_stats, summary):
+def iter_summary_tuples(summary):
+    #create_summary rows in the same order as the ones of iter_summary_rows
+    for row in summary:
+        yield (row["transcript"], row["interpro_status"], row["tesort_class"], row["pfams_ids"],
+               row["pfams_descriptions"], row["tesort_domains"], row["tesort_complete"],
+               row["tesort_strand"], row["detenga_status"])
+
+
+#Streaming merge: same rows as create_summary/write_summary, but interproscan
+#hits are read one transcript at a time and TEsorter rows are kept as tuples
+DETENGA_STATUS = {("coding_sequence", False): "PcpM0", ("transposable_element", False): "PteM0",
+                  ("mixed", False): "PchM0", ("coding_sequence", True): "PcpMte",
+                  ("transposable_element", True): "PteMte", ("mixed", True): "PchMte",
+                  ("NA", True): "P0Mte", ("NA", False): "NA"}
+
+
+def iter_pfams_from_interpro_query(fhand):
+    #interproscan writes the hits of every protein together, if a transcript
+    #shows up again after other transcripts a ValueError is raised
+    closed = set()
+    transcript = None
+    hits = []
+    for line in fhand:
+        if "\tPfam\t" not in line:
+            continue
+        line = line.split("\t")
+        if line[3] != "Pfam":
+            continue
+        if line[0] != transcript:
+            if transcript is not None:
+                closed.add(transcript)
+                yield transcript, sorted(hits, key=lambda x: int(x[2]))
+            transcript = sys.intern(line[0])
+            if transcript in closed:
+                raise ValueError("Hits for {} are not together in the interproscan output".format(transcript))
+            hits = []
+        hits.append((sys.intern(line[4]), sys.intern(line[5]), line[6], line[7]))
+    if transcript is not None:
+        yield transcript, sorted(hits, key=lambda x: int(x[2]))
+
+
+def parse_TEsort_output_compact(fhand):
+    output = {}
+    for line in DictReader(fhand, delimiter="\t"):
+        output[line["#TE"]] = (line["Domains"], line["Complete"],
+                               "{}|{}|{}".format(line["Order"], line["Superfamily"], line["Clade"]),
+                               line["Strand"])
+    return output
+
+
+def iter_summary_rows(interpro_hits, tesort_output, te_pfams):
+    #Rows are (transcript, interpro_status, tesort_class, pfams_ids,
+    #pfams_descriptions, tesort_domains, tesort_complete, tesort_strand, status)
+    na_tesort = ("NA", "NA", "NA", "NA")
+    for transcript, hits in interpro_hits:
+        transposable = False
+        no_transposable = False
+        for hit in hits:
+            tag = "TE" if hit[0] in te_pfams else "NT"
+            if "TE" in hit or tag == "TE":
+                transposable = True
+            if "NT" in hit or tag == "NT":
+                no_transposable = True
+        if transposable and no_transposable:
+            status = "mixed"
+        elif transposable:
+            status = "transposable_element"
+        else:
+            status = "coding_sequence"
+        tesort = tesort_output.pop(transcript, None)
+        found = tesort is not None
+        if not found:
+            tesort = na_tesort
+        yield (transcript, status, tesort[2], "|".join(hit[0] for hit in hits),
+               "|".join(hit[1] for hit in hits), tesort[0], tesort[1], tesort[3],
+               DETENGA_STATUS[(status, found and tesort[0] != "NA")])
+    for transcript, tesort in tesort_output.items():
+        yield (transcript, "NA", tesort[2], "NA", "NA", tesort[0], tesort[1], tesort[3],
+               DETENGA_STATUS[("NA", tesort[0] != "NA")])
+
+
+def iter_inferred_rows(rows, representatives):
+    #representatives has the representative of every transcript that was not
+    #analyzed. Rows get an Inferred_from field, NA for analyzed transcripts
+    siblings = {}
+    for transcript, representative in representatives.items():
+        siblings.setdefault(representative, []).append(transcript)
+    for row in rows:
+        yield row + ("NA",)
+        for sibling in siblings.get(row[0], ()):
+            yield (sibling,) + row[1:9] + (row[0],)
+
+
+def write_summary_rows(rows, out_fhand, buffer_rows=10000, header=SUMMARY_HEADER):
+    out_fhand.write(header)
+    lines = []
+    for row in rows:
+        lines.append("{};{};{};{};{};{}\n".format(row[0], row[1], row[2], row[3],
+                                                 row[4].replace(";", ","), ";".join(row[5:])))
+        if len(lines) >= buffer_rows:
+            out_fhand.write("".join(lines))
+            lines = []
+    out_fhand.write("".join(lines))
+
+
+def get_num_transcripts_from_agat(agat_stats):
     with open(agat_stats) as agat_fhand:
         text = agat_fhand.read()
         try:
@@ -156,9 +268,14 @@ def get_stats(agat_stats, summary):
         except:
             match = re.search(r"Number of transcript\s+(\d+)", text, re.IGNORECASE)
             num_transcripts = int(match.group(1))
+    return num_transcripts
+
+
+def get_stats(num_transcripts, summary):
     stats = {"PcpM0": 0, "PteM0": 0, "PchM0": 0, 
              "PcpMte": 0, "PteMte": 0, "PchMte": 0, 
              "P0Mte":0, "num_transcripts": num_transcripts}
-    for row in DictReader(open(summary), delimiter=";"):
-        stats[row["DeTEnGA_status"]] += 1
+    with open_file(summary) as summary_fhand:
+        for row in DictReader(summary_fhand, delimiter=";"):
+            stats[row["DeTEnGA_status"]] += 1
     return stats
@@ -0,0 +1,156 @@
+import json
+import os
+import time
+
+from pathlib import Path
+
+from src.annotation import get_transcript_lengths, choose_representatives
+from src.compression import open_file
+
+
+#Residues (bases for TEsorter) analyzed per second and per thread, used
+#until a tool has been recorded in the history. Rough figures for plant
+#genomes, interproscan is several times slower per residue
+DEFAULT_THROUGHPUT = {"tesorter": 20000.0, "interpro": 1500.0}
+#Runs of every tool kept in the history, older ones are dropped
+HISTORY_RUNS = 50
+#Chunks are sized to last about this long, so workers stay balanced and a
+#failed chunk is cheap to retry
+CHUNK_SECONDS = 300
+
+
+def read_history(fpath):
+    if fpath is None or not Path(fpath).exists():
+        return {}
+    with open(fpath) as fhand:
+        return json.load(fhand)
+
+
+def get_throughput(history, stage):
+    #Residues per second and per thread of the runs recorded, None if there
+    #are none
+    runs = history.get(stage, [])
+    core_seconds = sum(run["seconds"] * run["threads"] for run in runs)
+    if not runs or core_seconds <= 0:
+        return None
+    return sum(run["residues"] for run in runs) / core_seconds
+
+
+def get_throughputs(history):
+    #(throughput, number of runs it comes from) of every stage
+    throughputs = {}
+    for stage, default in DEFAULT_THROUGHPUT.items():
+        throughput = get_throughput(history, stage)
+        throughputs[stage] = (throughput, len(history[stage])) if throughput else (default, 0)
+    return throughputs
+
+
+def record_throughput(fpath, runs):
+    #runs are dicts with label, stage, residues, seconds and threads. The
+    #history is rewritten atomically
+    history = read_history(fpath)
+    for run in runs:
+        stage_runs = history.setdefault(run["stage"], [])
+        stage_runs.append({"label": run["label"], "residues": run["residues"], "seconds": round(run["seconds"], 3),
+                           "threads": run["threads"], "time": round(time.time())})
+        del stage_runs[:-HISTORY_RUNS]
+    tmp_fpath = Path("{}.tmp".format(fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        json.dump(history, out_fhand, indent=1)
+    os.replace(tmp_fpath, fpath)
+    return history
+
+
+def estimate_sizes(annotation, representatives=None):
+    #mRNA bases and protein residues that will be extracted, from the exon and
+    #CDS lengths of the annotation
+    with open_file(annotation) as annot_fhand:
+        transcripts = get_transcript_lengths(annot_fhand)
+    if representatives is not None:
+        chosen = set(choose_representatives(transcripts, rule=representatives).values())
+        transcripts = {name: lengths for name, lengths in transcripts.items() if name in chosen}
+    bases = sum(exon_length if exon_length else cds_length for _, exon_length, cds_length in transcripts.values())
+    residues = sum(cds_length // 3 for _, _, cds_length in transcripts.values())
+    return {"transcripts": len(transcripts), "tesorter": bases, "interpro": residues}
+
+
+def split_threads(threads, tesorter_work, interpro_work):
+    #Threads of a label are split so TEsorter and interproscan, which run at
+    #the same time, finish at about the same time. Both get at least one
+    if threads < 2:
+        return 1, 1
+    total = tesorter_work + interpro_work
+    tesorter_threads = round(threads * tesorter_work / total) if total > 0 else threads // 2
+    tesorter_threads = min(max(1, tesorter_threads), threads - 1)
+    return tesorter_threads, threads - tesorter_threads
+
+
+def get_chunk_size(throughput, threads, workers, size):
+    #None if the work is too small to be split among the workers
+    if workers < 2:
+        return None
+    chunk_size = int(throughput * max(1, threads // workers) * CHUNK_SECONDS)
+    return chunk_size if chunk_size < size else None
+
+
+def plan_label(sizes, threads, throughputs):
+    tesorter_work = sizes["tesorter"] / throughputs["tesorter"][0]
+    interpro_work = sizes["interpro"] / throughputs["interpro"][0]
+    tesorter_threads, interpro_threads = split_threads(threads, tesorter_work, interpro_work)
+    plan = dict(sizes)
+    plan.update({"tesorter_threads": tesorter_threads, "interpro_threads": interpro_threads,
+                 "tesorter_seconds": tesorter_work / tesorter_threads,
+                 "interpro_seconds": interpro_work / interpro_threads,
+                 "core_seconds": tesorter_work + interpro_work})
+    plan["seconds"] = max(plan["tesorter_seconds"], plan["interpro_seconds"])
+    return plan
+
+
+def plan_run(files, threads, task_threads, history, representatives=None):
+    #Threads and predicted time of every label. Labels run at the same time
+    #as long as they fit in threads, so the run takes at least as long as
+    #its slowest label and as all the work spread over every thread
+    throughputs = get_throughputs(history)
+    plans = {}
+    for label, values in files.items():
+        sizes = estimate_sizes(values["annotation"], representatives=representatives)
+        plans[label] = plan_label(sizes, min(task_threads, threads), throughputs)
+    seconds = 0
+    if plans:
+        seconds = max(max(plan["seconds"] for plan in plans.values()),
+                      sum(plan["core_seconds"] for plan in plans.values()) / threads)
+    return {"labels": plans, "seconds": seconds, "throughputs": throughputs}
+
+
+def format_plan(plan):
+    lines = []
+    for stage, (throughput, runs) in plan["throughputs"].items():
+        source = "from {} recorded runs".format(runs) if runs else "default, no runs recorded"
+        lines.append("#{} throughput: {:.1f} residues/s per thread ({})\n".format(stage, throughput, source))
+    header = ["Label", "Transcripts", "mRNA_bases", "Protein_residues", "TEsorter_threads", "Interpro_threads",
+              "TEsorter_s", "Interpro_s", "Predicted_s"]
+    lines.append("\t".join(header) + "\n")
+    for label, values in plan["labels"].items():
+        row = [label, str(values["transcripts"]), str(values["tesorter"]), str(values["interpro"]),
+               str(values["tesorter_threads"]), str(values["interpro_threads"]),
+               "{:.0f}".format(values["tesorter_seconds"]), "{:.0f}".format(values["interpro_seconds"]),
+               "{:.0f}".format(values["seconds"])]
+        lines.append("\t".join(row) + "\n")
+    lines.append("#Predicted TEsorter and interproscan time for every label: {:.0f} s ({:.1f} h)\n".format(plan["seconds"],
+                                                                                                     plan["seconds"] / 3600))
+    return "".join(lines)
+
+
+def get_recorded_runs(tasks, task_threads):
+    #Finished TEsorter and interproscan tasks with a FASTA input, results that
+    #already existed (returncode 99) are not the throughput of the tool.
+    #task_threads has the threads given to every (label, stage)
+    runs = []
+    for (label, stage), task in tasks:
+        if stage not in DEFAULT_THROUGHPUT or label is None or (label, stage) not in task_threads:
+            continue
+        if task.get("returncode") != 0 or not task.get("residues") or not task.get("wall_seconds"):
+            continue
+        runs.append({"label": label, "stage": stage, "residues": task["residues"],
+                     "seconds": task["wall_seconds"], "threads": task_threads[(label, stage)]})
+    return runs
@@ -1,126 +1,298 @@
+import io
 import os
+import shutil
+import tempfile
+import time
 
 
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from subprocess import run
+from subprocess import CompletedProcess, Popen, PIPE
 
-def run_gffread(fof, output):
+from src.annotation import (count_features, write_feature_counts, read_feature_counts, get_transcript_lengths,
+                            choose_representatives, write_representatives, read_representatives)
+from src.dedup import deduplicate_proteins, expand_interpro_tsv, get_digest
+from src.extract import extract_transcripts, iter_extracted
+from src.parsers import get_num_transcripts_from_agat
+from src.fasta import read_fasta, trim_fasta, trim_block, iter_blocks, exclude_block, exclude_records
+from src.shards import split_fasta, run_shards, merge_files, close_shard, run_with_retries
+from src.metrics import run_command, wait_command, bind
+from src.compression import open_file, get_stem, get_output_name, compress_file, decompress_file, is_gzipped
+from src.workers import POOL_BATCH_SIZE
+
+def run_gffread(fof, output, extractor="gffread", threads=1):
     results_catalog = {}
     for label, values in fof.items():
-        out_dir = output / label
-        if not out_dir.exists():
-            out_dir.mkdir(parents=True, exist_ok=True)
-        prefix  = values["assembly"].stem
-        mrna_out = out_dir / "{}.mRNA.fasta".format(prefix)
-        pep_out = out_dir / "{}.pep.fasta".format(prefix)
-        
-        
-        cmd = "gffread -w {} -g {} {}".format(str(mrna_out), 
+        results_catalog[label] = run_gffread_label(label, values, output,
+                                                   extractor=extractor, threads=threads)
+    return results_catalog
+
+
+def get_sequence_paths(label, values, output, compressed=False):
+    #mRNAs are never compressed, TEsorter reads them as they are
+    prefix = get_stem(values["assembly"])
+    return (output / label / "{}.mRNA.fasta".format(prefix),
+            get_output_name(output / label / "{}.pep.fasta".format(prefix), compressed=compressed))
+
+
+def run_gffread_label(label, values, output, extractor="gffread", threads=1, proteins=True,
+                      compressed=False):
+    #Without proteins only mRNAs are extracted (proteins are streamed)
+    out_dir = output / label
+    if not out_dir.exists():
+        out_dir.mkdir(parents=True, exist_ok=True)
+    mrna_out, pep_out = get_sequence_paths(label, values, output, compressed=compressed)
+    if extractor == "native":
+        return run_native_extraction(values, mrna_out, pep_out if proteins else None, threads)
+    
+    
+    cmd = "gffread -w {}.tmp -g {} {}".format(str(mrna_out), 
                                               str(values["assembly"]),
                                               str(values["annotation"]))
-        if mrna_out.exists():
-            returncode = 99
-            msg = "File {} already exists\n".format(str(mrna_out))
-        else:
-            run_ = run(cmd, capture_output=True, shell=True)
-            msg = run_.stderr.decode()
-            returncode = run_.returncode
-        
-        results = {"command": {"mrna": cmd}, "returncode": {"mrna": returncode},
-                   "msg": {"mrna": msg}, "out_fpath": {"mrna": mrna_out.absolute()}}
-        
-        cmd = "gffread -y {} -g {} {}".format(str(pep_out), 
+    if mrna_out.exists():
+        returncode = 99
+        msg = "File {} already exists\n".format(str(mrna_out))
+    else:
+        run_ = run_atomic(cmd, [mrna_out])
+        msg = run_.stderr.decode()
+        returncode = run_.returncode
+    
+    results = {"command": {"mrna": cmd}, "returncode": {"mrna": returncode},
+               "msg": {"mrna": msg}, "out_fpath": {"mrna": mrna_out.absolute()}}
+    if not proteins:
+        return results
+    
+    gffread_out = get_sequence_paths(label, values, output)[1]
+    cmd = "gffread -y {}.tmp -g {} {}".format(str(gffread_out), 
                                               str(values["assembly"]),
                                               str(values["annotation"]))
-        if pep_out.exists():
-            returncode = 99
-            msg = "File {} already exists\n".format(str(pep_out))
-        else:
-            run_ = run(cmd, capture_output=True, shell=True)
-            msg = run_.stderr.decode()
-            returncode = run_.returncode
+    if pep_out.exists():
+        returncode = 99
+        msg = "File {} already exists\n".format(str(pep_out))
+    else:
+        run_ = run_atomic(cmd, [gffread_out])
+        msg = run_.stderr.decode()
+        returncode = run_.returncode
+        if returncode == 0 and compressed:
+            compress_file(gffread_out, pep_out, threads=threads)
 
-        results["command"]["protein"] = cmd
-        results["returncode"]["protein"] = returncode
-        results["msg"]["protein"] = msg
-        results["out_fpath"]["protein"] = pep_out.absolute()
-        results_catalog[label] = results
+    results["command"]["protein"] = cmd
+    results["returncode"]["protein"] = returncode
+    results["msg"]["protein"] = msg
+    results["out_fpath"]["protein"] = pep_out.absolute()
+    return results
 
-    return results_catalog
+
+def run_representatives_label(label, values, output, rule="longest_cds", **options):
+    #Sequences are extracted as usual and only one transcript per gene is
+    #kept. The rest are written with their representative in
+    #LABEL.representatives.tsv, their status is taken from it
+    results = run_gffread_label(label, values, output, **options)
+    if 1 in results["returncode"].values():
+        return results
+    map_out = output / label / "{}.representatives.tsv".format(label)
+    cmd = "Keep the transcript with the {} of every gene".format(rule.replace("_", " "))
+    if map_out.exists() and set(results["returncode"].values()) == {99}:
+        returncode = 99
+        msg = "File {} already exists".format(str(map_out))
+    else:
+        with open_file(values["annotation"]) as annot_fhand:
+            representatives = choose_representatives(get_transcript_lengths(annot_fhand), rule=rule)
+        excluded = {name for name, representative in representatives.items() if name != representative}
+        #Already filtered files are left as they are
+        num_removed = {kind: exclude_records(fpath, excluded) for kind, fpath in results["out_fpath"].items()}
+        write_representatives(representatives, map_out)
+        returncode = 0
+        msg = "Done, {} representatives of {} transcripts, {} sequences removed".format(len(representatives) - len(excluded),
+                                                                                    len(representatives),
+                                                                                    sum(num_removed.values()))
+    results["command"]["representatives"] = cmd
+    results["returncode"]["representatives"] = returncode
+    results["msg"]["representatives"] = msg
+    results["out_fpath"]["representatives"] = map_out.absolute()
+    return results
+
+
+def run_atomic(cmd, out_fpaths, cwd=None, tmp_fpaths=None):
+    #cmd writes every output in "{out_fpath}.tmp" (or in tmp_fpaths), outputs
+    #are only renamed to their final paths if it succeeds, so a killed or
+    #failed run never leaves a partial output that would be taken as complete
+    run_ = run_command(cmd, cwd=cwd)
+    if tmp_fpaths is None:
+        tmp_fpaths = [Path("{}.tmp".format(out_fpath)) for out_fpath in out_fpaths]
+    for out_fpath, tmp_fpath in zip(out_fpaths, tmp_fpaths):
+        if run_.returncode == 0 and tmp_fpath.exists():
+            os.replace(tmp_fpath, out_fpath)
+        elif tmp_fpath.exists():
+            os.remove(tmp_fpath)
+    return run_
+
+
+def run_in_tmp_dir(cmd, out_fpath, work_dir):
+    #For tools that write their outputs in the working dir: they are run in a
+    #temporary dir whose files are moved to work_dir when they succeed,
+    #out_fpath the last one
+    tmp_dir = Path(work_dir) / "{}.tmp_dir".format(Path(out_fpath).name)
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    run_ = run_command(cmd, cwd=tmp_dir)
+    if run_.returncode == 0 and (tmp_dir / Path(out_fpath).name).exists():
+        for path in sorted(tmp_dir.iterdir(), key=lambda path: path.name == Path(out_fpath).name):
+            target = Path(work_dir) / path.name
+            if target.is_dir():
+                shutil.rmtree(target)
+            os.replace(path, target)
+    elif run_.returncode == 0:
+        run_ = CompletedProcess(cmd, 1, run_.stdout, run_.stderr + "{} was not written\n".format(out_fpath).encode())
+    shutil.rmtree(tmp_dir)
+    return run_
+
+
+def run_native_extraction(values, mrna_out, pep_out, threads):
+    #Same IDs as gffread -w/-y, but the genome is indexed and read only once
+    cmd = "Native extraction of mRNAs and proteins from {} using {}".format(str(values["annotation"]),
+                                                                           str(values["assembly"]))
+    out_fpaths = {"mrna": mrna_out}
+    if pep_out is not None:
+        out_fpaths["protein"] = pep_out
+    if all(out_fpath.exists() for out_fpath in out_fpaths.values()):
+        returncode = 99
+        msg = {kind: "File {} already exists\n".format(str(out_fpath)) for kind, out_fpath in out_fpaths.items()}
+    else:
+        try:
+            num_transcripts = extract_transcripts(values["assembly"], values["annotation"],
+                                                  mrna_out, pep_out, threads=threads)
+            returncode = 0
+            msg = {"mrna": "Done, {} transcripts written in {}\n".format(num_transcripts, mrna_out),
+                   "protein": "Done, proteins written in {}\n".format(pep_out)}
+        except (OSError, ValueError, KeyError) as error:
+            returncode = 1
+            msg = {kind: "{}\n".format(error) for kind in out_fpaths}
+    return {"command": {kind: cmd for kind in out_fpaths},
+            "returncode": {kind: returncode for kind in out_fpaths},
+            "msg": {kind: msg[kind] for kind in out_fpaths},
+            "out_fpath": {kind: out_fpath.absolute() for kind, out_fpath in out_fpaths.items()}}
 
 
 def run_TEsorter(sequences_input, database, threads):
-    base_dir = Path(os.getcwd())
     tesorter_results = {}
     for label, values in sequences_input.items():
-        results = {}
-        input_mrna = values["out_fpath"]["mrna"]
-        out_mrna = Path("{}.{}.cls.tsv".format(input_mrna, database))
-        os.chdir(out_mrna.parents[0].absolute())
-        cmd = "TEsorter {} -db {} -p {}".format(input_mrna, database, str(threads))
-        if out_mrna.exists():
-            returncode = 99
-            msg = "File {} already exists\n".format(str(out_mrna))
-        else:
-            run_ = run(cmd, capture_output=True, shell=True)
-            returncode = run_.returncode
-            log = out_mrna.parents[0] / "{}_TEsorter.log.txt".format(label)
-            if returncode == 0:
-                msg = "Done, check {} for details \n".format(str(log))
-            else:
-                msg = run_.stderr.decode()
-            with open(log, "w") as log_fhand:
-                log_fhand.write(run_.stderr.decode())
-        results = {"command": cmd, "returncode": returncode,
-                   "msg": msg, "out_fpath": out_mrna}
-        tesorter_results[label] = results
-        os.chdir(base_dir)
+        tesorter_results[label] = run_TEsorter_label(label, values, database, threads)
     return tesorter_results
 
 
-def remove_stop_codons(sequences):
-    out_fpath = Path("{}/{}.nostop.fasta".format(sequences.parents[0], sequences.stem))
+def run_TEsorter_label(label, values, database, threads, chunk_size=None, workers=1, retries=1):
+    #TEsorter writes its outputs in the working dir, so it is run with cwd
+    #instead of os.chdir to keep the rest of the process untouched
+    input_mrna = values["out_fpath"]["mrna"]
+    out_mrna = Path("{}.{}.cls.tsv".format(input_mrna, database))
+    work_dir = out_mrna.parents[0].absolute()
+    log = work_dir / "{}_TEsorter.log.txt".format(label)
+    if chunk_size:
+        return run_TEsorter_sharded(input_mrna, out_mrna, log, database, threads,
+                                    chunk_size, workers, retries)
+    cmd = "TEsorter {} -db {} -p {}".format(Path(input_mrna).absolute(), database, str(threads))
+    if out_mrna.exists():
+        returncode = 99
+        msg = "File {} already exists\n".format(str(out_mrna))
+    else:
+        run_ = run_in_tmp_dir(cmd, out_mrna, work_dir)
+        returncode = run_.returncode
+        if returncode == 0:
+            msg = "Done, check {} for details \n".format(str(log))
+        else:
+            msg = run_.stderr.decode()
+        with open(log, "w") as log_fhand:
+            log_fhand.write(run_.stderr.decode())
+    return {"command": cmd, "returncode": returncode,
+            "msg": msg, "out_fpath": out_mrna}
+
+
+def run_TEsorter_cached(label, values, database, threads, cache, version, chunk_size=None,
+                        workers=1, retries=1):
+    #Only mRNAs missing from the cache are analyzed by TEsorter
+    input_mrna = values["out_fpath"]["mrna"]
+    out_mrna = Path("{}.{}.cls.tsv".format(input_mrna, database))
+    key = ("TEsorter", database, version)
+    if out_mrna.exists():
+        return {"command": "TEsorter on {} using cache".format(input_mrna), "returncode": 99,
+                "msg": "File {} already exists\n".format(str(out_mrna)), "out_fpath": out_mrna}
+    misses_fpath = input_mrna.parents[0] / "{}.cache_misses.fasta".format(input_mrna.stem)
+    misses_out = Path("{}.{}.cls.tsv".format(misses_fpath, database))
+    digests, cached, num_misses = write_cache_misses(input_mrna, misses_fpath, cache, key)
+    results = {"command": "TEsorter on {} using cache".format(input_mrna), "returncode": 0,
+               "msg": "Done, all sequences found in cache\n"}
+    new = {}
+    if num_misses:
+        results = run_TEsorter_label(label, {"out_fpath": {"mrna": misses_fpath}}, database, threads,
+                                     chunk_size=chunk_size, workers=workers, retries=retries)
+        if results["returncode"] not in (0, 99):
+            return results
+        new = {digest: "" for digest in get_fasta_digests(misses_fpath)}
+        with open(misses_out) as misses_fhand:
+            cache.set_header(key, misses_fhand.readline())
+            for line in misses_fhand:
+                digest, rest = line.split("\t", 1)
+                new[digest] = new.get(digest, "") + rest
+        cache.store(key, new)
+        os.remove(misses_out)
+    os.remove(misses_fpath)
+    header = cache.get_header(key)
+    if header is None:
+        header = "#TE\tOrder\tSuperfamily\tClade\tComplete\tStrand\tDomains\n"
+    write_cached_results(digests, cached, new, out_mrna, header=header)
+    msg = "{} ({} of {} sequences found in cache)\n".format(results["msg"].rstrip(), len(digests) - num_misses,
+                                                             len(digests))
+    return {"command": results["command"], "returncode": results["returncode"], "msg": msg,
+            "out_fpath": out_mrna}
+
+
+def run_TEsorter_shard(shard, database, threads):
+    out_fpath = Path("{}.{}.cls.tsv".format(shard, database))
+    cmd = "TEsorter {} -db {} -p {}".format(shard.absolute(), database, str(threads))
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists\n".format(out_fpath)}
+    run_ = run_in_tmp_dir(cmd, out_fpath, shard.parents[0].absolute())
+    return {"command": cmd, "returncode": run_.returncode, "out_fpath": out_fpath,
+            "msg": run_.stderr.decode()}
+
+
+def run_TEsorter_sharded(input_mrna, out_mrna, log, database, threads, chunk_size, workers, retries):
+    #Every chunk is run in its own dir and the .cls.tsv files are merged
+    #in chunk order, so the merged file is the same for repeated runs
+    shards_dir = input_mrna.parents[0] / "tesorter_shards"
+    cmd = "TEsorter on {} -db {} in chunks of {} bp, {} workers".format(input_mrna, database,
+                                                                        chunk_size, workers)
+    if out_mrna.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_mrna,
+                "msg": "File {} already exists\n".format(str(out_mrna))}
+    shards = split_fasta(input_mrna, shards_dir, chunk_size)
+    shard_threads = max(1, threads // max(1, workers))
+    results = run_shards(shards, partial(run_TEsorter_shard, database=database, threads=shard_threads),
+                         workers=workers, retries=retries)
+    with open(log, "w") as log_fhand:
+        for shard, result in zip(shards, results):
+            log_fhand.write("{} | {}\n{}".format(shard, result["command"], result["msg"]))
+    failed = [result for result in results if result["returncode"] not in (0, 99)]
+    if failed:
+        msg = "".join("{} | {}".format(result["command"], result["msg"]) for result in failed)
+        return {"command": cmd, "returncode": 1, "out_fpath": out_mrna, "msg": msg}
+    merge_files([result["out_fpath"] for result in results], out_mrna, skip_header=True)
+    return {"command": cmd, "returncode": 0, "out_fpath": out_mrna,
+            "msg": "Done, {} chunks merged, check {} for details \n".format(len(shards), str(log))}
+
+
+def remove_stop_codons(sequences, threads=1):
+    out_fpath = Path("{}/{}.nostop.fasta".format(sequences.parents[0], get_stem(sequences)))
     log_file = Path("{}/internal_stop_codons.log.txt".format(sequences.parents[0]))
     if out_fpath.exists():
         return {"command":  "Remove internal stop codons from {}".format(str(sequences)),
                 "msg": "File exists already, check {} for details".format(log_file),
                 "out_fpath": out_fpath}
-
-    else:
-        id = ""
-        sequences_log = []
-        stop = False
-        original_len = 0
-        new_len = 0
-        with open(out_fpath, "w") as out_fhand:
-            with open(sequences) as seqs_fhand:
-                for line in seqs_fhand:
-                    if line.startswith(">"):
-                        if id:
-                            sequences_log.append("{}\t{}\t{}\n".format(id, original_len, new_len))
-                            original_len = 0
-                            new_len = 0
-                        id = line.rstrip()[1:]
-                        out_fhand.write(line)
-                        stop = False
-                    else:
-                        original_len += len(line.rstrip())
-                        if stop:
-                            continue
-                        else:
-                            stop_codons = [".", "*"]
-                            for symbol in stop_codons:
-                                if symbol in line:
-                                    stop = True
-                                    seq = line.split(symbol)[0]
-                                    new_len += len(seq)
-                                    out_fhand.write(seq+"\n")
-                            if not stop:
-                                out_fhand.write(line)
-                                new_len += len(line.rstrip())
-    with open(log_file, "w") as log_fhand:
-        for line in sequences_log:
-            log_fhand.write(line)
+    trim_fasta(sequences, out_fpath, log_file, threads=threads)
     return {"command": "Remove internal stop codons", 
             "msg": "Done, check {} for details".format(log_file),
             "out_fpath": out_fpath}    
@@ -128,59 +300,409 @@ def remove_stop_codons(sequences):
 
 
 def run_interpro(sequences, threads):
-    exclude = ["AntiFam", "CDD", "Coils", "FunFam",
-               "Gene3D", "Hamap", "MobiDBLite",
-               "NCBIfam", "PANTHER", "PIRSF", 
-               "PIRSR", "PRINTS", "ProSitePatterns",
-               "ProSiteProfiles", "SFLD", "SMART", 
-               "SUPERFAMILY"]
-    base_dir = Path(os.getcwd())
-    
     interpro_results = {}
     for label, values in sequences.items():
-        sequences = values["out_fpath"]
-        os.chdir(sequences.parents[0].absolute())
-        out_fpath = Path("{}.tsv".format(values["out_fpath"]))
-        log_fpath = Path("{}/interpro.log.txt".format(out_fpath.parents[0]))
-        cmd = "interproscan.sh -i {} -cpu {} -exclappl {} --disable-precalc > {}".format(str(values["out_fpath"]), 
-                                                                                         threads, ",".join(exclude),
-                                                                                         log_fpath)
-        if out_fpath.exists():
-            returncode = 99
-            msg = "File {} already exists, check log {} for details".format(str(out_fpath),
-                                                                           str(log_fpath))
-        else:
-            run_ = run(cmd, shell=True, capture_output=True)
-            returncode = run_.returncode
-            if returncode == 0:
-                msg = "Done, check {} for details".format(log_fpath)
-            else:
-                msg = run_.stdout.decode()
-        interpro_results[label] = {"command": cmd, "msg": msg,
-                                   "out_fpath": out_fpath, "returncode": returncode}
-        
-        os.chdir(base_dir)
+        interpro_results[label] = run_interpro_label(label, values, threads)
     return interpro_results
+
+
+INTERPRO_EXCLUDE = ["AntiFam", "CDD", "Coils", "FunFam",
+                    "Gene3D", "Hamap", "MobiDBLite",
+                    "NCBIfam", "PANTHER", "PIRSF", 
+                    "PIRSR", "PRINTS", "ProSitePatterns",
+                    "ProSiteProfiles", "SFLD", "SMART", 
+                    "SUPERFAMILY"]
+#Default output formats of interproscan for proteins, written by whole runs.
+#Chunks only need the TSV
+INTERPRO_FORMATS = ("TSV", "XML", "JSON", "GFF3")
+
+
+def get_interpro_cmd(sequences, out_fpath, threads, log_fpath, formats=("TSV",)):
+    #Written in temporary files, see run_atomic and get_interpro_outputs
+    if formats == ("TSV",):
+        cmd = "interproscan.sh -i {} -o {}.tmp -f TSV -cpu {} -exclappl {} --disable-precalc > {}"
+        return cmd.format(Path(sequences).absolute(), Path(out_fpath).absolute(), threads,
+                          ",".join(INTERPRO_EXCLUDE), Path(log_fpath).absolute())
+    cmd = "interproscan.sh -i {} -b {}.tmp -f {} -cpu {} -exclappl {} --disable-precalc > {}"
+    return cmd.format(Path(sequences).absolute(), Path(out_fpath).with_suffix("").absolute(), ",".join(formats),
+                      threads, ",".join(INTERPRO_EXCLUDE), Path(log_fpath).absolute())
+
+
+def get_interpro_outputs(out_fpath, formats):
+    #(final, temporary) paths of every format, written by interproscan as
+    #"{base}.tmp.{format}". The TSV goes last, so it is only there once every
+    #other format is
+    base = Path(out_fpath).with_suffix("")
+    outputs = [(Path("{}.{}".format(base, fmt.lower())), Path("{}.tmp.{}".format(base, fmt.lower())))
+               for fmt in formats if fmt != "TSV"]
+    return outputs + [(Path(out_fpath), Path("{}.tmp.tsv".format(base)))]
+
+
+def run_interpro_label(label, values, threads, chunk_size=None, workers=1, retries=1):
+    sequences = values["out_fpath"]
+    out_fpath = Path("{}.tsv".format(values["out_fpath"]))
+    log_fpath = Path("{}/interpro.log.txt".format(out_fpath.parents[0]))
+    if chunk_size:
+        return run_interpro_sharded(sequences, out_fpath, log_fpath, threads,
+                                    chunk_size, workers, retries)
+    cmd = get_interpro_cmd(values["out_fpath"], out_fpath, threads, log_fpath, formats=INTERPRO_FORMATS)
+    if out_fpath.exists():
+        returncode = 99
+        msg = "File {} already exists, check log {} for details".format(str(out_fpath),
+                                                                       str(log_fpath))
+    else:
+        outputs = get_interpro_outputs(out_fpath, INTERPRO_FORMATS)
+        run_ = run_atomic(cmd, [output[0] for output in outputs], cwd=sequences.parents[0].absolute(),
+                          tmp_fpaths=[output[1] for output in outputs])
+        returncode = run_.returncode
+        if returncode == 0:
+            msg = "Done, check {} for details".format(log_fpath)
+        else:
+            msg = run_.stdout.decode()
+    return {"command": cmd, "msg": msg,
+            "out_fpath": out_fpath, "returncode": returncode}
+
+
+def run_interpro_deduplicated(label, values, threads, chunk_size=None, workers=1, retries=1):
+    #interproscan only sees one copy of every protein, hits are copied back
+    #to every transcript afterwards
+    sequences = values["out_fpath"]
+    out_fpath = Path("{}.tsv".format(sequences))
+    unique_fpath = sequences.parents[0] / "{}.unique.fasta".format(sequences.stem)
+    map_fpath = sequences.parents[0] / "{}.unique.map.tsv".format(sequences.name)
+    if out_fpath.exists():
+        return {"command": "interproscan on unique proteins from {}".format(sequences),
+                "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists".format(str(out_fpath))}
+    counts = deduplicate_proteins({label: sequences}, unique_fpath, {label: map_fpath})
+    results = run_interpro_label(label, {"out_fpath": unique_fpath}, threads,
+                                 chunk_size=chunk_size, workers=workers, retries=retries)
+    if results["returncode"] not in (0, 99):
+        return results
+    expand_interpro_tsv(results["out_fpath"], map_fpath, out_fpath)
+    msg = "{} ({} unique proteins out of {})".format(results["msg"], counts["num_unique"],
+                                                     counts["num_sequences"])
+    return {"command": results["command"], "returncode": results["returncode"],
+            "out_fpath": out_fpath, "msg": msg}
+
+
+def run_interpro_cached(label, values, threads, cache, version, chunk_size=None, workers=1, retries=1):
+    #Pfam hits are stored by protein digest, so only proteins missing from
+    #the cache are analyzed by interproscan
+    sequences = values["out_fpath"]
+    out_fpath = Path("{}.tsv".format(sequences))
+    key = ("interproscan", "Pfam", version)
+    if out_fpath.exists():
+        return {"command": "interproscan on {} using cache".format(sequences), "returncode": 99,
+                "out_fpath": out_fpath, "msg": "File {} already exists".format(str(out_fpath))}
+    misses_fpath = sequences.parents[0] / "{}.cache_misses.fasta".format(sequences.stem)
+    digests, cached, num_misses = write_cache_misses(sequences, misses_fpath, cache, key)
+    results = {"command": "interproscan on {} using cache".format(sequences), "returncode": 0,
+               "msg": "Done, all sequences found in cache"}
+    new = {}
+    if num_misses:
+        results = run_interpro_label(label, {"out_fpath": misses_fpath}, threads,
+                                     chunk_size=chunk_size, workers=workers, retries=retries)
+        if results["returncode"] not in (0, 99):
+            return results
+        new = {digest: "" for digest in get_fasta_digests(misses_fpath)}
+        with open(results["out_fpath"]) as misses_fhand:
+            for line in misses_fhand:
+                digest, rest = line.split("\t", 1)
+                if rest.split("\t", 3)[2] == "Pfam":
+                    new[digest] = new.get(digest, "") + rest
+        cache.store(key, new)
+        os.remove(results["out_fpath"])
+    os.remove(misses_fpath)
+    write_cached_results(digests, cached, new, out_fpath)
+    msg = "{} ({} of {} sequences found in cache)".format(results["msg"], len(digests) - num_misses,
+                                                          len(digests))
+    return {"command": results["command"], "returncode": results["returncode"],
+            "out_fpath": out_fpath, "msg": msg}
+
+
+def write_cache_misses(fasta, misses_fpath, cache, key):
+    #Sequences without results in the cache are written once, named by digest
+    digests = {}
+    for name, seq in read_fasta(fasta):
+        digests[name.split()[0]] = get_digest(seq) if seq else None
+    cached = cache.lookup(key, [digest for digest in digests.values() if digest])
+    written = set()
+    with open(misses_fpath, "w") as misses_fhand:
+        for name, seq in read_fasta(fasta):
+            digest = digests[name.split()[0]]
+            if digest and digest not in cached and digest not in written:
+                written.add(digest)
+                misses_fhand.write(">{}\n{}\n".format(digest, seq))
+    return digests, cached, len(written)
+
+
+def get_fasta_digests(fasta):
+    return [name.split()[0] for name, _ in read_fasta(fasta)]
+
+
+def write_cached_results(digests, cached, new, out_fpath, header=None):
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        if header is not None:
+            out_fhand.write(header)
+        for name, digest in digests.items():
+            payload = cached.get(digest, new.get(digest, "")) if digest else ""
+            for line in payload.splitlines(keepends=True):
+                out_fhand.write("{}\t{}".format(name, line))
+    os.replace(tmp_fpath, out_fpath)
+
+
+def run_interpro_shard(shard, threads):
+    out_fpath = Path("{}.tsv".format(shard))
+    log_fpath = shard.parents[0] / "interpro.log.txt"
+    cmd = get_interpro_cmd(shard, out_fpath, threads, log_fpath)
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists".format(out_fpath)}
+    run_ = run_atomic(cmd, [out_fpath], cwd=shard.parents[0].absolute())
+    return {"command": cmd, "returncode": run_.returncode, "out_fpath": out_fpath,
+            "msg": run_.stdout.decode()}
+
+
+def run_interpro_sharded(sequences, out_fpath, log_fpath, threads, chunk_size, workers, retries):
+    #Proteins are split in chunks with a similar number of residues that are
+    #analyzed by concurrent interproscan runs and merged into a single tsv
+    shards_dir = sequences.parents[0] / "interpro_shards"
+    cmd = "interproscan.sh on {} in chunks of {} residues, {} workers".format(sequences, chunk_size,
+                                                                              workers)
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists, check log {} for details".format(str(out_fpath),
+                                                                                 str(log_fpath))}
+    shards = split_fasta(sequences, shards_dir, chunk_size)
+    shard_threads = max(1, threads // max(1, workers))
+    results = run_shards(shards, partial(run_interpro_shard, threads=shard_threads),
+                         workers=workers, retries=retries)
+    with open(log_fpath, "w") as log_fhand:
+        for result in results:
+            log_fhand.write("{} | returncode {}\n".format(result["command"], result["returncode"]))
+    failed = [result for result in results if result["returncode"] not in (0, 99)]
+    if failed:
+        msg = "".join("{} | {}\n".format(result["command"], result["msg"]) for result in failed)
+        return {"command": cmd, "returncode": 1, "out_fpath": out_fpath, "msg": msg}
+    merge_files([result["out_fpath"] for result in results], out_fpath)
+    return {"command": cmd, "returncode": 0, "out_fpath": out_fpath,
+            "msg": "Done, {} chunks merged, check {} for details".format(len(shards), log_fpath)}
     
-        
+
+def run_interpro_pooled(label, values, threads, pool, chunk_size=None, workers=1, retries=1):
+    #Proteins are split in batches queued to the long lived workers of pool,
+    #shared with every other label. threads, workers and retries are those of
+    #the pool, which restarts and retries its workers
+    sequences = values["out_fpath"]
+    out_fpath = Path("{}.tsv".format(sequences))
+    log_fpath = sequences.parents[0] / "interpro.log.txt"
+    chunk_size = chunk_size if chunk_size else POOL_BATCH_SIZE
+    cmd = "interproscan workers ({}) on {} in batches of {} residues".format(pool.cmd, sequences, chunk_size)
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists, check log {} for details".format(str(out_fpath),
+                                                                                 str(log_fpath))}
+    shards = split_fasta(sequences, sequences.parents[0] / "interpro_pool", chunk_size)
+    existing = {}
+    futures = {}
+    for shard in shards:
+        shard_out = Path("{}.tsv".format(shard))
+        if shard_out.exists():
+            existing[shard] = {"command": "Batch {}".format(shard), "returncode": 99, "out_fpath": shard_out,
+                               "msg": "File {} already exists".format(shard_out)}
+        else:
+            futures[shard] = pool.submit(shard, shard_out)
+    #In the order of the shards, as their names stop sorting by index past 999
+    results = [existing[shard] if shard in existing else futures[shard].result() for shard in shards]
+    with open(log_fpath, "w") as log_fhand:
+        for result in results:
+            log_fhand.write("{} | returncode {}\n".format(result["command"], result["returncode"]))
+    failed = [result for result in results if result["returncode"] not in (0, 99)]
+    if failed:
+        msg = "".join("{} | {}\n".format(result["command"], result["msg"]) for result in failed)
+        return {"command": cmd, "returncode": 1, "out_fpath": out_fpath, "msg": msg}
+    merge_files([result["out_fpath"] for result in results], out_fpath)
+    return {"command": cmd, "returncode": 0, "out_fpath": out_fpath,
+            "msg": "Done, {} batches merged, check {} for details".format(len(shards), log_fpath)}
+
+
+
+STREAM_CHUNK_SIZE = 1000000
+
+
+def iter_protein_blocks(values, extractor="gffread", threads=1):
+    #Blocks of FASTA records of proteins as soon as they are extracted,
+    #gffread writes them to a pipe instead of a file
+    if extractor == "native":
+        for _, proteins in iter_extracted(values["assembly"], values["annotation"], threads=threads):
+            if proteins:
+                yield proteins
+        return
+    cmd = "gffread -y /dev/stdout -g {} {}".format(str(values["assembly"]), str(values["annotation"]))
+    start = time.perf_counter()
+    with tempfile.TemporaryFile() as stderr_fhand:
+        process = Popen(cmd, shell=True, stdout=PIPE, stderr=stderr_fhand)
+        try:
+            yield from iter_blocks(io.TextIOWrapper(process.stdout))
+        finally:
+            process.stdout.close()
+            returncode = wait_command(cmd, process, start)
+        if returncode != 0:
+            stderr_fhand.seek(0)
+            raise RuntimeError("{} failed: {}".format(cmd, stderr_fhand.read().decode()))
+
+
+def write_stream_shard(shards_dir, idx, records):
+    shard_dir = shards_dir / "shard_{:03d}".format(idx)
+    shard_dir.mkdir(exist_ok=True)
+    shard = shard_dir / "shard_{:03d}.fasta".format(idx)
+    out_fhand = open("{}.tmp".format(shard), "w")
+    out_fhand.write("".join(records))
+    close_shard(out_fhand, shard)
+    return shard
+
+
+def run_interpro_streaming(label, values, output, threads, chunk_size=None, workers=1, retries=1,
+                           extractor="gffread", keep_intermediates=False, representatives=None):
+    #Proteins go from the extractor to the stop codon trimming and to
+    #interproscan chunks without intermediate files: every chunk is analyzed
+    #as soon as it has chunk_size residues, while extraction goes on.
+    #Proteins of transcripts in the representatives file are left out
+    _, pep_out = get_sequence_paths(label, values, output)
+    nostop_out = pep_out.parents[0] / "{}.nostop.fasta".format(pep_out.stem)
+    out_fpath = Path("{}.tsv".format(nostop_out))
+    log_fpath = out_fpath.parents[0] / "interpro.log.txt"
+    chunk_size = chunk_size if chunk_size else STREAM_CHUNK_SIZE
+    cmd = "interproscan.sh on proteins streamed from {} in chunks of {} residues, {} workers".format(extractor, chunk_size,
+                                                                                                   workers)
+    if out_fpath.exists():
+        return {"command": cmd, "returncode": 99, "out_fpath": out_fpath,
+                "msg": "File {} already exists, check log {} for details".format(str(out_fpath),
+                                                                                 str(log_fpath))}
+    shards_dir = out_fpath.parents[0] / "interpro_stream"
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    shard_threads = max(1, threads // max(1, workers))
+    function = bind(partial(run_with_retries, partial(run_interpro_shard, threads=shard_threads),
+                            retries=retries))
+    intermediates = [pep_out, nostop_out, pep_out.parents[0] / "internal_stop_codons.log.txt"]
+    keep_fhands = [open("{}.tmp".format(fpath), "w") for fpath in intermediates] if keep_intermediates else []
+    excluded = read_representatives(representatives) if representatives is not None else {}
+    shards = []
+    futures = []
+    records = []
+    residues = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        try:
+            for block in iter_protein_blocks(values, extractor=extractor, threads=threads):
+                if excluded:
+                    block = exclude_block(block, excluded)
+                fasta, log = trim_block(block)
+                for fhand, text in zip(keep_fhands, (block, fasta, log)):
+                    fhand.write(text)
+                records.append(fasta)
+                residues += sum(int(line.rsplit("\t", 1)[1]) for line in log.splitlines())
+                if residues >= chunk_size:
+                    shards.append(write_stream_shard(shards_dir, len(shards), records))
+                    futures.append(executor.submit(function, shards[-1]))
+                    records = []
+                    residues = 0
+            if residues or "".join(records).strip():
+                shards.append(write_stream_shard(shards_dir, len(shards), records))
+                futures.append(executor.submit(function, shards[-1]))
+        except (OSError, RuntimeError, ValueError, KeyError) as error:
+            for future in futures:
+                future.cancel()
+            for fhand in keep_fhands:
+                fhand.close()
+                os.remove(fhand.name)
+            return {"command": cmd, "returncode": 1, "out_fpath": out_fpath, "msg": "{}\n".format(error)}
+        results = [future.result() for future in futures]
+    for fhand, fpath in zip(keep_fhands, intermediates):
+        fhand.close()
+        os.replace(fhand.name, fpath)
+    with open(log_fpath, "w") as log_fhand:
+        for result in results:
+            log_fhand.write("{} | returncode {}\n".format(result["command"], result["returncode"]))
+    failed = [result for result in results if result["returncode"] not in (0, 99)]
+    if failed:
+        msg = "".join("{} | {}\n".format(result["command"], result["msg"]) for result in failed)
+        return {"command": cmd, "returncode": 1, "out_fpath": out_fpath, "msg": msg}
+    merge_files([result["out_fpath"] for result in results], out_fpath)
+    if not keep_intermediates:
+        shutil.rmtree(shards_dir)
+    return {"command": cmd, "returncode": 0, "out_fpath": out_fpath,
+            "msg": "Done, {} chunks merged, check {} for details".format(len(shards), log_fpath)}
+
+
+def run_stats_label(label, summary, annotations, mode="native"):
+    #Number of transcripts of the annotation, counted in a single streaming
+    #pass. AGAT can still be used instead or as a cross-check
+    if mode == "agat":
+        results = run_agat_label(label, summary, annotations)
+        if results["returncode"] in (0, 99):
+            results["num_transcripts"] = get_num_transcripts_from_agat(results["out_fpath"])
+        return results
+    annot_file = annotations[label]["annotation"]
+    out_fpath = summary.parents[0].absolute() / "{}.feature_counts.tsv".format(label)
+    cmd = "Count features of {}".format(str(annot_file))
+    if out_fpath.exists():
+        returncode = 99
+        msg = "File {} already exists".format(str(out_fpath))
+        features = read_feature_counts(out_fpath)
+    else:
+        with open_file(annot_file) as annot_fhand:
+            features = count_features(annot_fhand)
+        write_feature_counts(features, out_fpath)
+        returncode = 0
+        msg = "Done"
+    results = {"command": cmd, "msg": msg, "out_fpath": out_fpath, "returncode": returncode,
+               "num_transcripts": features["num_transcripts"]}
+    if mode == "both":
+        agat_results = run_agat_label(label, summary, annotations)
+        results["command"] += " and {}".format(agat_results["command"])
+        if agat_results["returncode"] not in (0, 99):
+            results["msg"] += ", AGAT failed: {}".format(agat_results["msg"])
+        else:
+            agat_transcripts = get_num_transcripts_from_agat(agat_results["out_fpath"])
+            if agat_transcripts != features["num_transcripts"]:
+                results["msg"] += ", WARNING: {} transcripts counted but AGAT found {}".format(features["num_transcripts"],
+                                                                                              agat_transcripts)
+            else:
+                results["msg"] += ", same number of transcripts found by AGAT"
+    return results
+
+
 def run_agat(summaries, annotations):
     agat_results = {}
     for label, summary in summaries.items():
-        base_dir = summary.parents[0].absolute()
-        agat_out = base_dir / "{}.agat.stats.txt".format(label)
-        annot_file = annotations[label]["annotation"]
-        cmd = "agat_sp_statistics.pl --gff {} -o {}".format(str(annot_file), 
+        agat_results[label] = run_agat_label(label, summary, annotations)
+    return agat_results
+
+
+def run_agat_label(label, summary, annotations):
+    base_dir = summary.parents[0].absolute()
+    agat_out = base_dir / "{}.agat.stats.txt".format(label)
+    annot_file = annotations[label]["annotation"]
+    if is_gzipped(annot_file):
+        #AGAT only reads uncompressed annotations, a copy is kept while it runs
+        annot_file = base_dir / "{}.agat_input{}".format(label, annot_file.with_suffix("").suffix or ".gff")
+    cmd = "agat_sp_statistics.pl --gff {} -o {}.tmp".format(str(annot_file), 
                                                             agat_out)
-        if agat_out.exists():
-            returncode = 99
-            msg = "File {} already exists".format(str(agat_out))
+    if agat_out.exists():
+        returncode = 99
+        msg = "File {} already exists".format(str(agat_out))
+    else:
+        if annot_file != annotations[label]["annotation"]:
+            decompress_file(annotations[label]["annotation"], annot_file)
+        run_ = run_atomic(cmd, [agat_out])
+        if annot_file != annotations[label]["annotation"]:
+            os.remove(annot_file)
+        returncode = run_.returncode
+        if returncode == 0:
+            msg = "Done"
         else:
-            run_ = run(cmd, shell=True, capture_output=True)
-            returncode = run_.returncode
-            if returncode == 0:
-                msg = "Done"
-            else:
-                msg = run_.stdout.decode()
-        agat_results[label] = {"command": cmd, "msg": msg,
-                               "out_fpath": agat_out, "returncode": returncode}
-    return agat_results 
\ No newline at end of file
+            msg = run_.stdout.decode()
+    return {"command": cmd, "msg": msg,
+            "out_fpath": agat_out, "returncode": returncode}
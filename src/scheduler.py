@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Task:
+    def __init__(self, label, stage, function, requires=None, after=None, threads=1, memory=0,
+                 callback=None):
+        self.label = label
+        self.stage = stage
+        self.function = function
+        self.requires = requires if requires is not None else []
+        #Tasks in after only have to be finished, even if they failed
+        self.after = after if after is not None else []
+        self.threads = threads
+        self.memory = memory
+        #callback(task, result) is run in the main thread when the task ends,
+        #it must return True if the label has to be removed from the pipeline
+        self.callback = callback
+
+    @property
+    def key(self):
+        return (self.label, self.stage)
+
+
+class Scheduler:
+    '''Runs (label, stage) tasks as a dependency graph under a global
+    thread budget and, optionally, a memory budget in GB'''
+    def __init__(self, threads, memory=None, stages=None):
+        self.threads = threads
+        self.memory = memory
+        self.stages = stages if stages is not None else []
+        self.tasks = {}
+        self.order = []
+
+    def add(self, task):
+        self.tasks[task.key] = task
+        self.order.append(task.key)
+
+    def priority(self, key):
+        task = self.tasks[key]
+        stage_idx = self.stages.index(task.stage) if task.stage in self.stages else len(self.stages)
+        return (stage_idx, self.order.index(key))
+
+    def fits(self, task, used_threads, used_memory, running):
+        if not running:
+            return True
+        if used_threads + min(task.threads, self.threads) > self.threads:
+            return False
+        if self.memory is not None and used_memory + task.memory > self.memory:
+            return False
+        return True
+
+    def settled(self, key, done, pending, running):
+        return key not in self.tasks or key in done or (key not in pending and key not in running.values())
+
+    def run(self):
+        results = {}
+        failed_labels = set()
+        skipped = []
+        pending = sorted(self.order, key=self.priority)
+        done = set()
+        running = {}
+        used_threads = 0
+        used_memory = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.threads)) as executor:
+            while pending or running:
+                for key in list(pending):
+                    if self.tasks[key].label in failed_labels:
+                        pending.remove(key)
+                        skipped.append(key)
+                for key in list(pending):
+                    task = self.tasks[key]
+                    if any(require not in done for require in task.requires):
+                        continue
+                    if any(not self.settled(key_, done, pending, running) for key_ in task.after):
+                        continue
+                    if not self.fits(task, used_threads, used_memory, running):
+                        continue
+                    pending.remove(key)
+                    future = executor.submit(task.function)
+                    running[future] = key
+                    used_threads += min(task.threads, self.threads)
+                    used_memory += task.memory
+                if not running:
+                    #Nothing can be started: remaining tasks depend on failed ones
+                    skipped += pending
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    task = self.tasks[key]
+                    used_threads -= min(task.threads, self.threads)
+                    used_memory -= task.memory
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        result = {"command": task.stage, "returncode": 1,
+                                  "msg": "{}: {}\n".format(type(error).__name__, error)}
+                    results[key] = result
+                    failed = task.callback(task, result) if task.callback else False
+                    if failed:
+                        failed_labels.add(task.label)
+                        for dependant in self.order:
+                            if key in self.tasks[dependant].requires:
+                                failed_labels.add(self.tasks[dependant].label)
+                    else:
+                        done.add(key)
+        return {"results": results, "failed": failed_labels, "skipped": skipped}
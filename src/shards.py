@@ -0,0 +1,88 @@
+import filecmp
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.fasta import read_fasta
+from src.metrics import bind
+
+
+def split_fasta(fpath, out_dir, chunk_size):
+    #Contiguous chunks of ~chunk_size residues, so the original order of
+    #the records is kept when the outputs are merged back. Each shard gets
+    #its own dir and previous outputs are only kept if the shard is unchanged
+    total = sum(len(seq) for _, seq in read_fasta(fpath))
+    num_chunks = max(1, -(-total // chunk_size))
+    target = total / num_chunks
+    out_dir.mkdir(parents=True, exist_ok=True)
+    shards = []
+    out_fhand = None
+    residues = 0
+    for name, seq in read_fasta(fpath):
+        if out_fhand is None or (residues >= target * len(shards) and len(shards) < num_chunks):
+            if out_fhand is not None:
+                close_shard(out_fhand, shards[-1])
+            shard_dir = out_dir / "shard_{:03d}".format(len(shards))
+            shard_dir.mkdir(exist_ok=True)
+            shards.append(shard_dir / "shard_{:03d}.fasta".format(len(shards)))
+            out_fhand = open("{}.tmp".format(shards[-1]), "w")
+        out_fhand.write(">{}\n{}\n".format(name, seq))
+        residues += len(seq)
+    if out_fhand is not None:
+        close_shard(out_fhand, shards[-1])
+    return shards
+
+
+def close_shard(out_fhand, shard):
+    out_fhand.close()
+    tmp_fpath = out_fhand.name
+    if shard.exists() and filecmp.cmp(tmp_fpath, shard, shallow=False):
+        os.remove(tmp_fpath)
+        return
+    for path in shard.parents[0].iterdir():
+        if path.name != Path(tmp_fpath).name:
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    os.replace(tmp_fpath, shard)
+
+
+def run_shards(shards, function, workers=1, retries=1):
+    #function(shard) returns a result dict with a returncode, failed
+    #shards are retried on their own
+    results = {}
+    pending = list(shards)
+    function = bind(function)
+    for _ in range(retries + 1):
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for shard, result in zip(pending, executor.map(function, pending)):
+                results[shard] = result
+        pending = [shard for shard in pending if results[shard]["returncode"] not in (0, 99)]
+        if not pending:
+            break
+    return [results[shard] for shard in shards]
+
+
+def run_with_retries(function, shard, retries=1):
+    #For shards that are run as soon as they are written
+    for _ in range(retries + 1):
+        result = function(shard)
+        if result["returncode"] in (0, 99):
+            break
+    return result
+
+
+def merge_files(in_fpaths, out_fpath, skip_header=False):
+    tmp_fpath = Path("{}.tmp".format(out_fpath))
+    with open(tmp_fpath, "w") as out_fhand:
+        for idx, in_fpath in enumerate(in_fpaths):
+            with open(in_fpath) as in_fhand:
+                if skip_header and idx > 0:
+                    in_fhand.readline()
+                for line in in_fhand:
+                    out_fhand.write(line)
+    os.replace(tmp_fpath, out_fpath)
+    return out_fpath
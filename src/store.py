@@ -0,0 +1,125 @@
+import sqlite3
+import time
+
+from threading import Lock
+
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS runs (label TEXT PRIMARY KEY, genome TEXT, annotation TEXT,
+                                              num_transcripts INTEGER, finished REAL);
+            CREATE TABLE IF NOT EXISTS transcripts (label TEXT, transcript TEXT, interpro_status TEXT,
+                                                    tesort_class TEXT, tesort_domains TEXT,
+                                                    tesort_complete TEXT, tesort_strand TEXT,
+                                                    status TEXT);
+            CREATE TABLE IF NOT EXISTS pfams (label TEXT, transcript TEXT, pfam TEXT, description TEXT);
+            CREATE INDEX IF NOT EXISTS transcripts_label_status ON transcripts (label, status);
+            CREATE INDEX IF NOT EXISTS transcripts_transcript ON transcripts (transcript);
+            CREATE INDEX IF NOT EXISTS transcripts_status ON transcripts (status);
+            CREATE INDEX IF NOT EXISTS pfams_pfam ON pfams (pfam);
+            CREATE INDEX IF NOT EXISTS pfams_label_transcript ON pfams (label, transcript);"""
+STATUSES = ("PcpM0", "PteM0", "PchM0", "PcpMte", "PteMte", "PchMte", "P0Mte")
+BATCH_ROWS = 10000
+
+
+class ResultStore:
+    '''Summaries of every run in a single sqlite file, indexed by label,
+    transcript, DeTEnGA status and Pfam ID so they can be queried across
+    genomes without reading the summary files'''
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(fpath), check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def clear_label(self, label):
+        with self.lock:
+            for table in ("runs", "transcripts", "pfams"):
+                self.conn.execute("DELETE FROM {} WHERE label=?".format(table), (label,))
+            self.conn.commit()
+
+    def add_rows(self, label, rows):
+        #rows are summary tuples as yielded by parsers.iter_summary_rows.
+        #Each batch is inserted in a single transaction
+        transcripts = []
+        pfams = []
+        for row in rows:
+            transcripts.append((label, row[0], row[1], row[2], row[5], row[6], row[7], row[8]))
+            if row[3] != "NA":
+                for pfam, description in zip(row[3].split("|"), row[4].split("|")):
+                    pfams.append((label, row[0], pfam, description))
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("INSERT INTO transcripts VALUES (?, ?, ?, ?, ?, ?, ?, ?)", transcripts)
+                self.conn.executemany("INSERT INTO pfams VALUES (?, ?, ?, ?)", pfams)
+
+    def tee_rows(self, label, rows, batch_rows=BATCH_ROWS):
+        #Yields rows while they are stored, so the summary file and the store
+        #are written in the same pass
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                self.add_rows(label, batch)
+                batch = []
+            yield row
+        self.add_rows(label, batch)
+
+    def set_run(self, label, genome, annotation, num_transcripts):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                                  (label, genome, annotation, num_transcripts, time.time()))
+
+    def get_stats(self, label):
+        #Same dict as parsers.get_stats
+        with self.lock:
+            row = self.conn.execute("SELECT num_transcripts FROM runs WHERE label=?", (label,)).fetchone()
+            counts = self.conn.execute("SELECT status, COUNT(*) FROM transcripts WHERE label=? GROUP BY status",
+                                       (label,)).fetchall()
+        stats = {status: 0 for status in STATUSES}
+        stats["num_transcripts"] = row[0] if row else 0
+        for status, count in counts:
+            if status in stats:
+                stats[status] += count
+        return stats
+
+    def get_runs(self):
+        with self.lock:
+            return self.conn.execute("SELECT label, genome, annotation, num_transcripts FROM runs ORDER BY label").fetchall()
+
+    def get_conditions(self, pfam=None, status=None, label=None, transcript=None):
+        #WHERE clause of the transcripts matching every given filter
+        conditions = []
+        values = []
+        if pfam is not None:
+            conditions.append("EXISTS (SELECT 1 FROM pfams q WHERE q.label = t.label AND q.transcript = t.transcript AND q.pfam = ?)")
+            values.append(pfam)
+        if status is not None:
+            conditions.append("t.status = ?")
+            values.append(status)
+        if label is not None:
+            conditions.append("t.label = ?")
+            values.append(label)
+        if transcript is not None:
+            conditions.append("t.transcript = ?")
+            values.append(transcript)
+        return ("WHERE " + " AND ".join(conditions) if conditions else ""), values
+
+    def query(self, pfam=None, status=None, label=None, transcript=None):
+        #Transcripts matching every given filter, with their Pfam domains
+        where, values = self.get_conditions(pfam=pfam, status=status, label=label, transcript=transcript)
+        query = ["SELECT t.label, t.transcript, t.status, t.interpro_status, t.tesort_class,",
+                 "GROUP_CONCAT(p.pfam, '|') FROM transcripts t",
+                 "LEFT JOIN pfams p ON p.label = t.label AND p.transcript = t.transcript", where,
+                 "GROUP BY t.label, t.transcript, t.rowid ORDER BY t.label, t.transcript"]
+        with self.lock:
+            return self.conn.execute(" ".join(query), values).fetchall()
+
+    def count_labels(self, pfam=None, status=None, label=None, transcript=None):
+        #Number of transcripts per label matching the filters
+        where, values = self.get_conditions(pfam=pfam, status=status, label=label, transcript=transcript)
+        query = " ".join(["SELECT t.label, COUNT(*) FROM transcripts t", where, "GROUP BY t.label ORDER BY t.label"])
+        with self.lock:
+            return self.conn.execute(query, values).fetchall()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import select
+import shlex
+import signal
+import sys
+import threading
+import time
+
+from concurrent.futures import Future
+from pathlib import Path
+from subprocess import Popen, PIPE, TimeoutExpired
+
+
+#Workers read one JSON request per line from stdin and write one answer per
+#line to stdout, with the id of the request:
+#  {"ready": true} is written once the worker is loaded
+#  {"id": 1, "sequences": FASTA, "out": TSV, "threads": 4} -> {"id": 1, "returncode": 0, "msg": "..."}
+#  {"id": 2, "ping": true} -> {"id": 2, "pong": true}
+#and they exit when stdin is closed. Anything else goes to stderr
+DEFAULT_WORKER = "{} {}".format(sys.executable, Path(__file__).absolute().parents[0] / "interpro_worker.py")
+#interproscan loads its member databases before it is ready
+STARTUP_TIMEOUT = 900
+#Workers idle for longer than this are pinged before they get a batch
+PING_SECONDS = 60
+PING_TIMEOUT = 30
+#Seconds a batch can take before its worker is killed and the batch retried
+BATCH_TIMEOUT = 6 * 3600
+#The process is checked this often while an answer is waited for
+POLL_SECONDS = 5
+#Residues per batch queued to the pool
+POOL_BATCH_SIZE = 200000
+
+
+class Worker:
+    '''A long lived worker process, it only has one request at a time'''
+    def __init__(self, cmd, name, log_fpath=None):
+        self.cmd = cmd
+        self.name = name
+        self.log_fpath = log_fpath
+        self.process = None
+        self.request_id = 0
+        self.last_answer = 0
+        self.starts = 0
+
+    def start(self, timeout=STARTUP_TIMEOUT):
+        self.stop()
+        stderr = open(self.log_fpath, "a") if self.log_fpath is not None else None
+        try:
+            #In a session of its own, so the tools it runs are killed with it
+            self.process = Popen(shlex.split(self.cmd), stdin=PIPE, stdout=PIPE, stderr=stderr, text=True, bufsize=1,
+                                 start_new_session=True)
+        finally:
+            if stderr is not None:
+                stderr.close()
+        self.starts += 1
+        if not self.read(timeout).get("ready"):
+            raise RuntimeError("{} did not start: {}".format(self.name, self.cmd))
+
+    def read(self, timeout=None):
+        #A worker that dies in the middle of a batch is found even if the
+        #tools it started keep its stdout open
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait = POLL_SECONDS if deadline is None else max(0, min(POLL_SECONDS, deadline - time.monotonic()))
+            ready, _, _ = select.select([self.process.stdout], [], [], wait)
+            if ready:
+                break
+            if self.process.poll() is not None:
+                raise RuntimeError("{} exited with code {}".format(self.name, self.process.returncode))
+            if deadline is not None and time.monotonic() >= deadline:
+                raise RuntimeError("{} did not answer in {} s".format(self.name, timeout))
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("{} exited with code {}".format(self.name, self.process.wait()))
+        self.last_answer = time.monotonic()
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise RuntimeError("{} wrote something that is not an answer: {}".format(self.name, line.strip()))
+
+    def request(self, values, timeout=None):
+        self.request_id += 1
+        try:
+            self.process.stdin.write(json.dumps(dict(values, id=self.request_id)) + "\n")
+            self.process.stdin.flush()
+        except OSError:
+            raise RuntimeError("{} exited with code {}".format(self.name, self.process.wait()))
+        answer = self.read(timeout)
+        if answer.get("id") != self.request_id:
+            raise RuntimeError("{} answered request {} instead of {}".format(self.name, answer.get("id"),
+                                                                             self.request_id))
+        return answer
+
+    def is_healthy(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        if time.monotonic() - self.last_answer < PING_SECONDS:
+            return True
+        try:
+            return bool(self.request({"ping": True}, timeout=PING_TIMEOUT).get("pong"))
+        except RuntimeError:
+            return False
+
+    def stop(self, kill=False):
+        #Hung or dead workers are killed with every process they started
+        if self.process is None:
+            return
+        if kill:
+            self.kill()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=10)
+        except TimeoutExpired:
+            self.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class WorkerPool:
+    '''Long lived domain search workers shared by every label. Batches are
+    queued and run by the first free worker, which is only started when it
+    gets its first batch. Workers that exit or stop answering are started
+    again and their batch is retried, as are batches that take longer than
+    timeout seconds'''
+    def __init__(self, cmd, workers, threads=1, retries=1, timeout=BATCH_TIMEOUT, log_fpath=None):
+        self.cmd = cmd
+        self.threads = threads
+        self.retries = retries
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.workers = [Worker(cmd, "worker {}".format(idx), log_fpath=log_fpath) for idx in range(workers)]
+        self.serving = [threading.Thread(target=self.serve, args=(worker,), daemon=True) for worker in self.workers]
+        for thread in self.serving:
+            thread.start()
+
+    def submit(self, sequences, out_fpath):
+        future = Future()
+        self.queue.put((future, Path(sequences).absolute(), Path(out_fpath).absolute()))
+        return future
+
+    def serve(self, worker):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            future, sequences, out_fpath = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.run_batch(worker, sequences, out_fpath))
+            except Exception as error:
+                future.set_exception(error)
+        worker.stop()
+
+    def run_batch(self, worker, sequences, out_fpath):
+        #The worker writes in a temporary file, renamed once it succeeds
+        cmd = "{} ({}) on {}".format(worker.name, self.cmd, sequences)
+        tmp_fpath = Path("{}.tmp".format(out_fpath))
+        msg = ""
+        for _ in range(self.retries + 1):
+            try:
+                if not worker.is_healthy():
+                    worker.start()
+                answer = worker.request({"sequences": str(sequences), "out": str(tmp_fpath),
+                                         "threads": self.threads}, timeout=self.timeout)
+            except (OSError, RuntimeError) as error:
+                #It is started again for the next try
+                worker.stop(kill=True)
+                msg = str(error)
+                continue
+            if answer.get("returncode") == 0 and tmp_fpath.exists():
+                os.replace(tmp_fpath, out_fpath)
+                return {"command": cmd, "returncode": 0, "out_fpath": out_fpath, "msg": answer.get("msg", "")}
+            msg = answer.get("msg", "returncode {}".format(answer.get("returncode")))
+        if tmp_fpath.exists():
+            os.remove(tmp_fpath)
+        return {"command": cmd, "returncode": 1, "out_fpath": out_fpath, "msg": msg}
+
+    def get_restarts(self):
+        return sum(max(0, worker.starts - 1) for worker in self.workers)
+
+    def close(self):
+        for _ in self.serving:
+            self.queue.put(None)
+        for thread in self.serving:
+            thread.join()
+
+
+def serve(handle, in_fhand=sys.stdin, out_fhand=sys.stdout):
+    #Worker side of the protocol. handle(request) returns (returncode, msg)
+    out_fhand.write(json.dumps({"ready": True}) + "\n")
+    out_fhand.flush()
+    for line in in_fhand:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if request.get("ping"):
+            answer = {"id": request["id"], "pong": True}
+        else:
+            returncode, msg = handle(request)
+            answer = {"id": request["id"], "returncode": returncode, "msg": msg}
+        out_fhand.write(json.dumps(answer) + "\n")
+        out_fhand.flush()
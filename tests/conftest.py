@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+#DeTEnGA.py and src/ are imported from the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,33 @@
+import gzip
+
+import pytest
+
+from src.compression import PipedFile
+
+
+def write_gzip(fpath, num_lines):
+    with gzip.open(fpath, "wt") as fhand:
+        fhand.write("".join(">seq{}\nACGT\n".format(idx) for idx in range(num_lines)))
+
+
+def test_piped_file_reads_whole_file(tmp_path):
+    fpath = tmp_path / "seqs.fa.gz"
+    write_gzip(fpath, 10)
+    with PipedFile(["gzip", "-dc", str(fpath)], "rt") as fhand:
+        assert len(fhand.readlines()) == 20
+
+
+def test_piped_file_closed_before_the_end(tmp_path):
+    fpath = tmp_path / "seqs.fa.gz"
+    write_gzip(fpath, 200000)
+    with PipedFile(["gzip", "-dc", str(fpath)], "rt") as fhand:
+        assert fhand.readline() == ">seq0\n"
+
+
+def test_piped_file_truncated(tmp_path):
+    fpath = tmp_path / "seqs.fa.gz"
+    write_gzip(fpath, 1000)
+    fpath.write_bytes(fpath.read_bytes()[:-100])
+    with pytest.raises(OSError, match="gzip -dc"):
+        with PipedFile(["gzip", "-dc", str(fpath)], "rt") as fhand:
+            fhand.read()
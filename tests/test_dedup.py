@@ -0,0 +1,25 @@
+import DeTEnGA
+
+
+PROTEINS = {"a": ">a.t1\nMKV\n>a.t2\nMLL\n", "b": ">b.t1\nMAA\n>b.t2\nMKV\n", "c": ">c.t1\nMCC\n"}
+
+
+def deduplicate(tmp_path, trimmed_order):
+    #trimmed_order is the order in which the proteins of every label were trimmed
+    out_dir = tmp_path / "".join(trimmed_order)
+    out_dir.mkdir()
+    sequences = {}
+    for label in trimmed_order:
+        fasta = out_dir / "{}.nostop.fasta".format(label)
+        fasta.write_text(PROTEINS[label])
+        sequences[label] = {"out_fpath": fasta}
+    state = {"no_stop_codons_sequences": sequences}
+    files = {label: {} for label in PROTEINS}
+    results = DeTEnGA.deduplicate_fof(files, state, out_dir)
+    return results["out_fpath"].read_text()
+
+
+def test_unique_proteins_in_fof_order(tmp_path):
+    unique = deduplicate(tmp_path, ["a", "b", "c"])
+    assert unique == deduplicate(tmp_path, ["c", "b", "a"])
+    assert unique.count(">") == 4
@@ -0,0 +1,92 @@
+import gzip
+import shutil
+import struct
+import zlib
+
+from subprocess import run
+
+import pytest
+
+from src.extract import extract_transcripts
+from src.fasta import read_fasta
+
+
+#chr1: ATGAAA at 5-10 and GGGTAA at 15-20 (+ strand transcript), chr2 has
+#its reverse complement (- strand transcript)
+SEQUENCES = {"chr1": "CCCCATGAAACCCCGGGTAACCCC", "chr2": "GGGGTTACCCGGGGTTTCATGGGG"}
+ANNOTATION = ("##gff-version 3\n"
+              "chr1\ttest\tmRNA\t5\t20\t.\t+\t.\tID=t1\n"
+              "chr1\ttest\texon\t5\t10\t.\t+\t.\tParent=t1\n"
+              "chr1\ttest\texon\t15\t20\t.\t+\t.\tParent=t1\n"
+              "chr1\ttest\tCDS\t5\t10\t.\t+\t0\tParent=t1\n"
+              "chr1\ttest\tCDS\t15\t20\t.\t+\t0\tParent=t1\n"
+              "chr2\ttest\tmRNA\t5\t20\t.\t-\t.\tID=t2\n"
+              "chr2\ttest\texon\t5\t10\t.\t-\t.\tParent=t2\n"
+              "chr2\ttest\texon\t15\t20\t.\t-\t.\tParent=t2\n"
+              "chr2\ttest\tCDS\t5\t10\t.\t-\t0\tParent=t2\n"
+              "chr2\ttest\tCDS\t15\t20\t.\t-\t0\tParent=t2\n")
+MRNAS = {"t1": "ATGAAAGGGTAA", "t2": "ATGAAAGGGTAA"}
+PROTEINS = {"t1": "MKG.", "t2": "MKG."}
+
+
+def get_fasta(width=7):
+    #Wrapped lines, so offsets have to be computed from the index
+    return "".join(">{} description\n{}".format(name, "".join("{}\n".format(seq[idx:idx + width])
+                                                              for idx in range(0, len(seq), width)))
+                   for name, seq in SEQUENCES.items())
+
+
+def write_bgzf(fpath, data, block_size=20):
+    #Small blocks, so sequences are split between blocks
+    with open(fpath, "wb") as fhand:
+        for idx in range(0, len(data) + 1, block_size):
+            chunk = data[idx:idx + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(chunk) + compressor.flush()
+            fhand.write(b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00")
+            fhand.write(struct.pack("<H", len(cdata) + 25))
+            fhand.write(cdata)
+            fhand.write(struct.pack("<II", zlib.crc32(chunk), len(chunk)))
+
+
+def write_assembly(tmp_path, kind):
+    data = get_fasta().encode()
+    if kind == "plain":
+        fpath = tmp_path / "genome.fa"
+        fpath.write_bytes(data)
+    elif kind == "gzip":
+        fpath = tmp_path / "genome.fa.gz"
+        fpath.write_bytes(gzip.compress(data))
+    else:
+        fpath = tmp_path / "genome.fa.bgz"
+        write_bgzf(fpath, data)
+    return fpath
+
+
+def extract(tmp_path, assembly, threads=1):
+    annotation = tmp_path / "genes.gff3"
+    annotation.write_text(ANNOTATION)
+    mrna_out = tmp_path / "mrna.{}.fasta".format(threads)
+    pep_out = tmp_path / "pep.{}.fasta".format(threads)
+    num_transcripts = extract_transcripts(assembly, annotation, mrna_out, pep_out, threads=threads)
+    return num_transcripts, dict(read_fasta(mrna_out)), dict(read_fasta(pep_out))
+
+
+@pytest.mark.parametrize("kind", ["plain", "gzip", "bgzf"])
+@pytest.mark.parametrize("threads", [1, 2])
+def test_native_extraction(tmp_path, kind, threads):
+    assembly = write_assembly(tmp_path, kind)
+    num_transcripts, mrnas, proteins = extract(tmp_path, assembly, threads=threads)
+    assert num_transcripts == 2
+    assert mrnas == MRNAS
+    assert proteins == PROTEINS
+
+
+@pytest.mark.skipif(shutil.which("gffread") is None, reason="gffread is not installed")
+def test_native_extraction_same_as_gffread(tmp_path):
+    assembly = write_assembly(tmp_path, "plain")
+    _, mrnas, proteins = extract(tmp_path, assembly)
+    for option, sequences in (("-w", mrnas), ("-y", proteins)):
+        out_fpath = tmp_path / "gffread{}.fasta".format(option)
+        run(["gffread", option, str(out_fpath), "-g", str(assembly), str(tmp_path / "genes.gff3")], check=True)
+        assert {name.split()[0]: seq for name, seq in read_fasta(out_fpath)} == sequences
@@ -0,0 +1,46 @@
+import pytest
+
+from src.fasta import read_fasta, trim_fasta
+
+
+#Wrapped records, stop codons in the middle of a line, at the end of a line,
+#at the start of a line and in a later line, and records without residues
+PROTEINS = (">t1 gene=g1\nMKVLA\nAGT.K\nLLL\n"
+            ">t2\nMKKKK\nAAAAA*\n"
+            ">t3\nMKV\n.AAA\nCCC\n"
+            ">t4\n"
+            ">t5 partial\nMAAAA\nCCCCC\nDDD*E\nFFF\n"
+            ">t6\nMNNNN\nPPP\n")
+
+
+def trim_lines(fpath):
+    #Line by line trimming that DeTEnGA used before FASTA files were read in
+    #blocks: every line after a stop codon is removed
+    records = []
+    for line in open(fpath):
+        if line.startswith(">"):
+            records.append([line.rstrip()[1:], "", False])
+            continue
+        record = records[-1]
+        if record[2]:
+            continue
+        for symbol in (".", "*"):
+            if symbol in line:
+                record[2] = True
+                line = line.split(symbol)[0]
+        record[1] += line.rstrip()
+    return [(header, seq) for header, seq, _ in records]
+
+
+@pytest.mark.parametrize("buffer_size", [7, 16, 1024])
+@pytest.mark.parametrize("threads", [1, 2])
+def test_trim_fasta_same_as_line_trimming(tmp_path, buffer_size, threads):
+    in_fpath = tmp_path / "proteins.fasta"
+    in_fpath.write_text(PROTEINS)
+    out_fpath = tmp_path / "proteins.nostop.fasta"
+    log_fpath = tmp_path / "internal_stop_codons.log.txt"
+    trim_fasta(in_fpath, out_fpath, log_fpath, threads=threads, buffer_size=buffer_size)
+    assert list(read_fasta(out_fpath)) == trim_lines(in_fpath)
+    log = [line.split("\t") for line in log_fpath.read_text().splitlines()]
+    assert log == [[header, str(len(seq)), str(len(trimmed))] for (header, seq), (_, trimmed)
+                   in zip(read_fasta(in_fpath), trim_lines(in_fpath))]
@@ -0,0 +1,33 @@
+import gzip
+
+import pytest
+
+from src import fastparse
+from src.fastparse import get_pfams_from_interpro_file, parse_TEsort_file
+from src.parsers import get_pfams_from_interpro_query, parse_TEsort_output
+from test_merge import SORTED_INTERPRO, TESORTER_NA, merge_sorted
+
+
+def write(fpath, text, compressed=False):
+    fpath.write_bytes(gzip.compress(text.encode()) if compressed else text.encode())
+    return fpath
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_fast_parsers_same_as_python(tmp_path, monkeypatch, threads, compressed):
+    #Tiny chunks, so files are split in several ranges
+    monkeypatch.setattr(fastparse, "MIN_CHUNK_SIZE", 60)
+    interpro_fpath = write(tmp_path / "interpro.tsv", SORTED_INTERPRO * 3, compressed=compressed)
+    tesorter_fpath = write(tmp_path / "tesorter.tsv", TESORTER_NA, compressed=compressed)
+    with gzip.open(interpro_fpath, "rt") if compressed else open(interpro_fpath) as fhand:
+        assert get_pfams_from_interpro_file(interpro_fpath, threads=threads) == get_pfams_from_interpro_query(fhand)
+    with gzip.open(tesorter_fpath, "rt") if compressed else open(tesorter_fpath) as fhand:
+        assert parse_TEsort_file(tesorter_fpath, threads=threads) == parse_TEsort_output(fhand)
+
+
+def test_fast_merge_same_as_python(tmp_path, monkeypatch):
+    monkeypatch.setattr(fastparse, "MIN_CHUNK_SIZE", 60)
+    python = merge_sorted(tmp_path, "memory")
+    assert merge_sorted(tmp_path, "memory", parser="fast") == python
+    assert merge_sorted(tmp_path, "memory", parser="validate") == python
@@ -0,0 +1,80 @@
+from src.filter import filter_annotation, get_relations, read_flagged
+
+
+GFF3 = ("##gff-version 3\n"
+        "chr1\ttest\tgene\t1\t100\t.\t+\t.\tID=g1\n"
+        "chr1\ttest\tmRNA\t1\t100\t.\t+\t.\tID=g1.t1;Parent=g1\n"
+        "chr1\ttest\tmRNA\t1\t80\t.\t+\t.\tID=g1.t2;Parent=g1\n"
+        "chr1\ttest\texon\t1\t50\t.\t+\t.\tID=g1.e1;Parent=g1.t1,g1.t2\n"
+        "chr1\ttest\texon\t60\t100\t.\t+\t.\tID=g1.e2;Parent=g1.t1\n"
+        "chr1\ttest\texon\t60\t80\t.\t+\t.\tID=g1.e3;Parent=g1.t2\n"
+        "###\n"
+        "chr1\ttest\tgene\t200\t300\t.\t-\t.\tID=g2\n"
+        "chr1\ttest\tmRNA\t200\t300\t.\t-\t.\tID=g2.t1;Parent=g2\n"
+        "chr1\ttest\texon\t200\t300\t.\t-\t.\tID=g2.e1;Parent=g2.t1\n"
+        "chr1\ttest\tgene\t400\t500\t.\t+\t.\tID=g3\n"
+        "chr1\ttest\tmRNA\t400\t500\t.\t+\t.\tID=g3.t1;Parent=g3\n"
+        "chr1\ttest\texon\t400\t500\t.\t+\t.\tID=g3.e1;Parent=g3.t1\n")
+GTF = ('chr1\ttest\ttranscript\t1\t100\t.\t+\t.\tgene_id "g1"; transcript_id "g1.t1";\n'
+       'chr1\ttest\texon\t1\t100\t.\t+\t.\tgene_id "g1"; transcript_id "g1.t1";\n'
+       'chr1\ttest\texon\t1\t80\t.\t+\t.\tgene_id "g1"; transcript_id "g1.t2";\n'
+       'chr1\ttest\texon\t200\t300\t.\t-\t.\tgene_id "g2"; transcript_id "g2.t1";\n')
+SUMMARY = ("Transcript_ID;Interpro_status;TEsort_class;Pfams_IDs;Pfams_descriptions;TEsort_domains;"
+           "TEsort_complete;TEsort_strand;DeTEnGA_status\n"
+           "g1.t1;transposable_element;NA;PF00078;RT;NA;NA;NA;PteM0\n"
+           "g1.t2;coding_sequence;NA;PF00001;CDS;NA;NA;NA;PcpM0\n"
+           "g2.t1;NA;LTR|Gypsy|Athila;NA;NA;RT;yes;+;P0Mte\n"
+           "g3.t1;coding_sequence;NA;PF00001;CDS;NA;NA;NA;PcpM0\n")
+
+
+def get_lines(fpath):
+    return [line.split("\t") for line in fpath.read_text().splitlines() if not line.startswith("#")]
+
+
+def get_transcripts(fpath):
+    return {get_relations(fields)[0] for fields in get_lines(fpath) if fields[2] in ("mRNA", "transcript")}
+
+
+def filter_text(tmp_path, text, suffix, statuses=("PteM0", "PteMte", "P0Mte")):
+    annotation = tmp_path / "genes{}".format(suffix)
+    annotation.write_text(text)
+    summary = tmp_path / "summary.csv"
+    summary.write_text(SUMMARY)
+    flagged = read_flagged(summary, statuses)
+    clean_out = tmp_path / "genes.filtered{}".format(suffix)
+    te_out = tmp_path / "genes.TE{}".format(suffix)
+    num_removed, num_lines = filter_annotation(annotation, flagged, clean_out, te_out=te_out)
+    return num_removed, num_lines, clean_out, te_out
+
+
+def test_filter_gff3(tmp_path):
+    num_removed, num_lines, clean_out, te_out = filter_text(tmp_path, GFF3, ".gff3")
+    assert num_removed == 2
+    clean = clean_out.read_text()
+    assert num_lines == len(clean.splitlines())
+    #Every kept transcript is still there, with all its features
+    assert get_transcripts(clean_out) == {"g1.t2", "g3.t1"}
+    assert [fields[8] for fields in get_lines(clean_out)] == ["ID=g1", "ID=g1.t2;Parent=g1", "ID=g1.e1;Parent=g1.t2",
+                                                             "ID=g1.e3;Parent=g1.t2", "ID=g3", "ID=g3.t1;Parent=g3",
+                                                             "ID=g3.e1;Parent=g3.t1"]
+    assert clean.startswith("##gff-version 3\n")
+    te = [fields[8] for fields in get_lines(te_out)]
+    assert te == ["ID=g1", "ID=g1.t1;Parent=g1;detenga_status=PteM0", "ID=g1.e1;Parent=g1.t1",
+                  "ID=g1.e2;Parent=g1.t1", "ID=g2", "ID=g2.t1;Parent=g2;detenga_status=P0Mte",
+                  "ID=g2.e1;Parent=g2.t1"]
+
+
+def test_filter_without_flagged_transcripts(tmp_path):
+    num_removed, _, clean_out, te_out = filter_text(tmp_path, GFF3, ".gff3", statuses=("PchMte",))
+    assert num_removed == 0
+    assert clean_out.read_text() == GFF3
+    assert get_lines(te_out) == []
+
+
+def test_filter_gtf(tmp_path):
+    num_removed, _, clean_out, te_out = filter_text(tmp_path, GTF, ".gtf")
+    assert num_removed == 2
+    assert clean_out.read_text() == GTF.splitlines(keepends=True)[2]
+    te = te_out.read_text().splitlines()
+    assert len(te) == 3
+    assert all('detenga_status "' in line for line in te)
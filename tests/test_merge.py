@@ -0,0 +1,83 @@
+from functools import partialmethod
+
+import DeTEnGA
+
+from src.matrix import PfamCounter, read_status_counts
+from src.store import ResultStore
+
+
+TESORTER = ("#TE\tOrder\tSuperfamily\tClade\tComplete\tStrand\tDomains\n"
+            "t2\tLTR\tGypsy\tAthila\tyes\t+\tGAG|RT\n"
+            "t5\tLTR\tCopia\tAle\tno\t-\tRT\n")
+#Hits of t1 are not together, so the streaming merge fails after some rows
+INTERPRO = ("t1\tmd5\t100\tPfam\tPF00001\tNon TE\t1\t50\t1e-10\n"
+            "t2\tmd5\t100\tPfam\tPF00078\tReverse transcriptase\t1\t50\t1e-10\n"
+            "t3\tmd5\t100\tPfam\tPF00001\tNon TE\t1\t50\t1e-10\n"
+            "t4\tmd5\t100\tPfam\tPF00078\tReverse transcriptase\t1\t50\t1e-10\n"
+            "t1\tmd5\t100\tPfam\tPF00078\tReverse transcriptase\t60\t90\t1e-10\n")
+TE_PFAMS = {"PF00078": "Reverse transcriptase"}
+
+
+def merge(tmp_path, mode):
+    out_dir = tmp_path / mode
+    (out_dir / "sample").mkdir(parents=True)
+    tesorter_fpath = out_dir / "sample.cls.tsv"
+    tesorter_fpath.write_text(TESORTER)
+    interpro_fpath = out_dir / "sample.tsv"
+    interpro_fpath.write_text(INTERPRO)
+    store = ResultStore(out_dir / "store.db")
+    state = {"sequences": {}, "store": store,
+             "TEsorter_results": {"sample": {"out_fpath": tesorter_fpath}},
+             "interpro_results": {"sample": {"out_fpath": interpro_fpath}}}
+    results = DeTEnGA.merge_evidences("sample", state, TE_PFAMS, out_dir, mode=mode, pfam_counts=True)
+    stats = store.get_stats("sample")
+    store.close()
+    return results, stats
+
+
+def test_unsorted_interpro_streaming_fallback(tmp_path, monkeypatch):
+    #Small batches, so rows are stored and counted before the merge fails
+    monkeypatch.setattr(PfamCounter, "tee_rows", partialmethod(PfamCounter.tee_rows, batch_rows=1))
+    monkeypatch.setattr(ResultStore, "tee_rows", partialmethod(ResultStore.tee_rows, batch_rows=1))
+    streaming, streaming_stats = merge(tmp_path, "streaming")
+    memory, memory_stats = merge(tmp_path, "memory")
+    assert streaming["returncode"] == 0
+    assert "streaming failed" in streaming["command"]
+    assert streaming_stats == memory_stats
+    assert sum(streaming_stats[status] for status in streaming_stats if status != "num_transcripts") == 5
+    assert read_status_counts(streaming["pfam_counts"]) == read_status_counts(memory["pfam_counts"])
+    assert streaming["pfam_counts"].read_text().split("\n")[1:] == memory["pfam_counts"].read_text().split("\n")[1:]
+
+
+#Hits of every transcript together, as interproscan writes them, with TE,
+#non-TE and mixed proteins, non Pfam hits and TEsorter only transcripts
+SORTED_INTERPRO = ("t1\tmd5\t100\tPfam\tPF00001\tNon TE\t1\t50\t1e-10\n"
+                   "t1\tmd5\t100\tGene3D\tG3DSA:1.10\t-\t1\t20\t1e-5\n"
+                   "t2\tmd5\t100\tPfam\tPF00078\tReverse transcriptase\t40\t90\t1e-10\n"
+                   "t2\tmd5\t100\tPfam\tPF00001\tNon TE; with semicolon\t1\t30\t1e-10\n"
+                   "t3\tmd5\t100\tPfam\tPF00078\tReverse transcriptase\t1\t50\t1e-10\n"
+                   "t6\tmd5\t100\tGene3D\tG3DSA:1.10\t-\t1\t20\t1e-5\n"
+                   "t4\tmd5\t100\tPfam\tPF00001\tNon TE\t1\t50\t1e-10\n")
+TESORTER_NA = TESORTER + "t7\tLTR\tunknown\tunknown\tno\t+\tNA\n"
+
+
+def merge_sorted(tmp_path, mode, parser="python"):
+    out_dir = tmp_path / "{}_{}".format(mode, parser)
+    (out_dir / "sample").mkdir(parents=True)
+    tesorter_fpath = out_dir / "sample.cls.tsv"
+    tesorter_fpath.write_text(TESORTER_NA)
+    interpro_fpath = out_dir / "sample.tsv"
+    interpro_fpath.write_text(SORTED_INTERPRO)
+    state = {"sequences": {}, "store": None,
+             "TEsorter_results": {"sample": {"out_fpath": tesorter_fpath}},
+             "interpro_results": {"sample": {"out_fpath": interpro_fpath}}}
+    results = DeTEnGA.merge_evidences("sample", state, TE_PFAMS, out_dir, mode=mode, parser=parser)
+    assert results["returncode"] == 0
+    return results["out_fpath"].read_text()
+
+
+def test_streaming_merge_same_as_memory(tmp_path):
+    streaming = merge_sorted(tmp_path, "streaming")
+    assert "streaming failed" not in streaming
+    assert streaming == merge_sorted(tmp_path, "memory")
+    assert [line.split(";")[0] for line in streaming.splitlines()[1:]] == ["t1", "t2", "t3", "t4", "t5", "t7"]
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+from pathlib import Path
+
+import DeTEnGA
+
+
+STUBS_DIR = Path(__file__).absolute().parents[1] / "benchmarks" / "stubs"
+ASSEMBLY = ">chr1\n" + "ATGGCTAAACCCGGGTTTAGCGATCGATGCATGCA" * 20 + "\n"
+ANNOTATION = ("##gff-version 3\n"
+              "chr1\ttest\tgene\t1\t60\t.\t+\t.\tID=gene0\n"
+              "chr1\ttest\tmRNA\t1\t60\t.\t+\t.\tID=gene0.t1;Parent=gene0\n"
+              "chr1\ttest\texon\t1\t60\t.\t+\t.\tID=gene0.t1.exon1;Parent=gene0.t1\n"
+              "chr1\ttest\tCDS\t1\t60\t.\t+\t0\tID=gene0.t1.cds;Parent=gene0.t1\n"
+              "chr1\ttest\tgene\t101\t190\t.\t-\t.\tID=gene1\n"
+              "chr1\ttest\tmRNA\t101\t190\t.\t-\t.\tID=gene1.t1;Parent=gene1\n"
+              "chr1\ttest\texon\t101\t190\t.\t-\t.\tID=gene1.t1.exon1;Parent=gene1.t1\n"
+              "chr1\ttest\tCDS\t101\t190\t.\t-\t0\tID=gene1.t1.cds;Parent=gene1.t1\n")
+
+
+def run_detenga(tmp_path, monkeypatch, labels, options=()):
+    #labels maps every label to the (assembly, annotation) written in the
+    #file of files. Tools are the stand-ins used by the benchmarks
+    monkeypatch.setenv("PATH", "{}{}{}".format(STUBS_DIR, os.pathsep, os.environ["PATH"]))
+    fof = tmp_path / "fof.txt"
+    fof.write_text("".join("{}\t{}\t{}\n".format(label, *paths) for label, paths in labels.items()))
+    out_dir = tmp_path / "out"
+    monkeypatch.setattr(sys, "argv", ["DeTEnGA.py", "-i", str(fof), "-o", str(out_dir)] + list(options))
+    return DeTEnGA.main(), out_dir
+
+
+def write_inputs(tmp_path):
+    assembly = tmp_path / "genome.fasta"
+    assembly.write_text(ASSEMBLY)
+    annotation = tmp_path / "genes.gff3"
+    annotation.write_text(ANNOTATION)
+    return assembly, annotation
+
+
+def test_missing_assembly_only_removes_its_label(tmp_path, monkeypatch):
+    assembly, annotation = write_inputs(tmp_path)
+    labels = {"good": (assembly, annotation), "missing": (tmp_path / "missing.fasta", annotation)}
+    results, out_dir = run_detenga(tmp_path, monkeypatch, labels)
+    assert results["failed"] == {"missing"}
+    rows = (out_dir / "combined_summaries.tsv").read_text().splitlines()
+    assert [row.split("\t")[0] for row in rows[1:]] == ["good"]
+    assert "Removed missing from pipeline" in (out_dir / "log.txt").read_text()
+
+
+def test_interproscan_default_formats_are_kept(tmp_path, monkeypatch):
+    assembly, annotation = write_inputs(tmp_path)
+    results, out_dir = run_detenga(tmp_path, monkeypatch, {"sample": (assembly, annotation)})
+    assert not results["failed"]
+    names = {path.name for path in (out_dir / "sample").iterdir()}
+    for fmt in ("tsv", "xml", "json", "gff3"):
+        assert "genome.pep.nostop.fasta.{}".format(fmt) in names
+    assert not [name for name in names if ".tmp" in name]
+
+
+def read_task_events(out_dir):
+    events = [json.loads(line) for line in (out_dir / "metrics.jsonl").read_text().splitlines()]
+    return [event for event in events if event["event"] == "task" and "input" in event]
+
+
+def test_residues_only_counted_for_throughput_history(tmp_path, monkeypatch):
+    assembly, annotation = write_inputs(tmp_path)
+    for run_dir in ("plain", "history"):
+        (tmp_path / run_dir).mkdir()
+    _, out_dir = run_detenga(tmp_path / "plain", monkeypatch, {"sample": (assembly, annotation)})
+    events = read_task_events(out_dir)
+    assert events and all("residues" not in event for event in events)
+    assert all(event["input_bytes"] == os.stat(event["input"]).st_size for event in events)
+
+    history = tmp_path / "history.json"
+    _, out_dir = run_detenga(tmp_path / "history", monkeypatch, {"sample": (assembly, annotation)},
+                             options=["--throughput_history", str(history)])
+    assert any(event.get("residues") for event in read_task_events(out_dir))
+    assert json.loads(history.read_text())
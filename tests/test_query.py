@@ -0,0 +1,43 @@
+import sys
+
+import DeTEnGA_query
+from src.store import ResultStore
+
+
+#Summary rows as yielded by parsers.iter_summary_rows
+ROWS = {"genome1": [("gene0.t1", "TE", "LTR|Copia|Ale", "PF00078", "RVT_1", "GAG", "yes", "+", "PteMte"),
+                    ("gene1.t1", "coding", "NA", "NA", "NA", "NA", "NA", "NA", "PcpM0")],
+        "genome2": [("gene0.t1", "coding", "NA", "NA", "NA", "NA", "NA", "NA", "PcpM0"),
+                    ("gene2.t1", "TE", "NA", "PF00078", "RVT_1", "NA", "NA", "NA", "PteM0")]}
+
+
+def run_query(tmp_path, monkeypatch, capsys, options):
+    store_fpath = tmp_path / "store.db"
+    if not store_fpath.exists():
+        store = ResultStore(store_fpath)
+        for label, rows in ROWS.items():
+            store.add_rows(label, rows)
+        store.close()
+    monkeypatch.setattr(sys, "argv", ["DeTEnGA_query.py", "--store", str(store_fpath)] + options)
+    DeTEnGA_query.main()
+    return [line.split("\t") for line in capsys.readouterr().out.splitlines()[1:]]
+
+
+def test_count_uses_every_filter(tmp_path, monkeypatch, capsys):
+    assert run_query(tmp_path, monkeypatch, capsys, ["--count"]) == [["genome1", "2"], ["genome2", "2"]]
+    rows = run_query(tmp_path, monkeypatch, capsys, ["--count", "--transcript", "gene0.t1"])
+    assert rows == [["genome1", "1"], ["genome2", "1"]]
+    rows = run_query(tmp_path, monkeypatch, capsys, ["--count", "--transcript", "gene2.t1"])
+    assert rows == [["genome2", "1"]]
+    rows = run_query(tmp_path, monkeypatch, capsys, ["--count", "--pfam", "PF00078", "--label", "genome1"])
+    assert rows == [["genome1", "1"]]
+
+
+def test_count_matches_query(tmp_path, monkeypatch, capsys):
+    for options in (["--transcript", "gene0.t1"], ["--pfam", "PF00078"], ["--status", "PcpM0", "--label", "genome2"]):
+        rows = run_query(tmp_path, monkeypatch, capsys, options)
+        counts = run_query(tmp_path, monkeypatch, capsys, options + ["--count"])
+        expected = {}
+        for row in rows:
+            expected[row[0]] = expected.get(row[0], 0) + 1
+        assert counts == [[label, str(count)] for label, count in sorted(expected.items())]
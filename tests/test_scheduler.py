@@ -0,0 +1,40 @@
+from functools import partial
+
+import DeTEnGA
+
+from src.scheduler import Scheduler, Task
+
+
+def extracted(label):
+    return {"command": {"mrna": "extract {}".format(label)}, "msg": {"mrna": "Done"},
+            "returncode": {"mrna": 0}, "out_fpath": {"mrna": label}}
+
+
+def broken():
+    raise OSError("assembly not found")
+
+
+def test_raising_task_only_removes_its_label(tmp_path):
+    state = {"logged_steps": set(), "sequences": {}}
+    with open(tmp_path / "log.txt", "w") as log_fhand:
+        scheduler = Scheduler(2, stages=list(DeTEnGA.STEPS))
+        callback = partial(DeTEnGA.gffread_done, state=state, log_fhand=log_fhand)
+        scheduler.add(Task("bad", "gffread", broken, callback=callback))
+        scheduler.add(Task("good", "gffread", partial(extracted, "good"), callback=callback))
+        scheduler.add(Task("bad", "stats", lambda: {}, requires=[("bad", "gffread")]))
+        scheduler.add(Task("good", "stats", lambda: {}, requires=[("good", "gffread")]))
+        results = scheduler.run()
+    assert results["failed"] == {"bad"}
+    assert results["skipped"] == [("bad", "stats")]
+    assert ("good", "stats") in results["results"]
+    assert list(state["sequences"]) == ["good"]
+    log = (tmp_path / "log.txt").read_text()
+    assert "gffread | OSError: assembly not found\n" in log
+    assert "Removed bad from pipeline" in log
+
+
+def test_default_task_threads_share_the_budget():
+    files = {"a": {}, "b": {}}
+    assert DeTEnGA.get_task_threads({"threads": 8, "task_threads": None}, files) == 4
+    assert DeTEnGA.get_task_threads({"threads": 1, "task_threads": None}, files) == 1
+    assert DeTEnGA.get_task_threads({"threads": 8, "task_threads": 8}, files) == 8
@@ -0,0 +1,57 @@
+import sys
+import time
+
+from src import workers
+from src.workers import WorkerPool
+
+
+#Answers pings, but batches of sequences named "hang" never end and batches
+#of sequences named "die" start a tool that keeps stdout open and exit
+WORKER = """
+import json, subprocess, sys, time
+print(json.dumps({"ready": True}), flush=True)
+for line in sys.stdin:
+    request = json.loads(line)
+    if request.get("ping"):
+        print(json.dumps({"id": request["id"], "pong": True}), flush=True)
+    elif request["sequences"].endswith("hang"):
+        time.sleep(60)
+    elif request["sequences"].endswith("die"):
+        subprocess.Popen(["sleep", "60"])
+        sys.exit(3)
+    else:
+        open(request["out"], "w").write("hits")
+        print(json.dumps({"id": request["id"], "returncode": 0, "msg": "Done"}), flush=True)
+"""
+
+
+def get_pool(tmp_path, timeout=None):
+    worker_fpath = tmp_path / "worker.py"
+    worker_fpath.write_text(WORKER)
+    return WorkerPool("{} {}".format(sys.executable, worker_fpath), 1, retries=1, timeout=timeout,
+                      log_fpath=tmp_path / "workers.log")
+
+
+def test_hung_worker_is_killed(tmp_path):
+    pool = get_pool(tmp_path, timeout=1)
+    start = time.monotonic()
+    result = pool.submit(tmp_path / "hang", tmp_path / "hang.tsv").result()
+    assert result["returncode"] == 1
+    assert "did not answer in 1 s" in result["msg"]
+    assert time.monotonic() - start < 30
+    #The worker is started again for the next batch
+    assert pool.submit(tmp_path / "ok", tmp_path / "ok.tsv").result()["returncode"] == 0
+    assert (tmp_path / "ok.tsv").read_text() == "hits"
+    pool.close()
+    assert pool.get_restarts() == 2
+
+
+def test_dead_worker_is_found_before_eof(tmp_path, monkeypatch):
+    monkeypatch.setattr(workers, "POLL_SECONDS", 0.1)
+    pool = get_pool(tmp_path)
+    start = time.monotonic()
+    result = pool.submit(tmp_path / "die", tmp_path / "die.tsv").result()
+    assert result["returncode"] == 1
+    assert "exited with code 3" in result["msg"]
+    assert time.monotonic() - start < 30
+    pool.close()